@@ -0,0 +1,1054 @@
+"""Benchmarks the checkers package and the training components.
+
+Times the hot paths of the project and writes the results as JSON along
+with metadata describing the machine they were run on. A previous
+results file may be passed as a baseline, in which case every benchmark
+is compared against it and the script exits with a nonzero status if
+any of them slowed down by more than the allowed threshold.
+
+Example Usage:
+    python benchmark.py --output baseline.json
+    python benchmark.py --baseline baseline.json --threshold 0.1
+    python benchmark.py --only match_random --threshold-for \
+match_random=0.25
+
+Each benchmark is a function taking the minimum time (in seconds) to
+spend on a single timing run and returning a result dictionary with the
+keys value, unit and higher_is_better. Further benchmarks may be added
+by registering them in the BENCHMARKS dictionary.
+
+Functions:
+    sample_positions: Returns gamestates sampled from random games.
+    random_games: Returns the moves of games of random full moves.
+    legacy_encode: Encodes a position as ModelPlayer once did.
+    fill_replay: Fills a replay memory with random transitions.
+    time_rate: Returns the number of calls per second of a function.
+    run_benchmarks: Runs the chosen benchmarks and collects results.
+    environment: Returns metadata describing the current machine.
+    compare: Compares results against a baseline.
+    main: Command line entry point.
+"""
+
+import argparse
+import contextlib
+import datetime
+import itertools
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import checkers
+
+
+def sample_positions(count, seed=0):
+    """Returns gamestates sampled from games of random moves.
+
+    Args:
+        count: The number of gamestates to return.
+        seed: Seed for the random moves so that every run benchmarks
+            the same positions.
+
+    Returns:
+        A list of count Gamestate objects, none of which are finished.
+    """
+
+    rng = random.Random(seed)
+    positions = []
+    while len(positions) < count:
+        gamestate = checkers.game.Gamestate()
+        while gamestate.is_game_over() == 2 and len(positions) < count:
+            positions.append(gamestate.copy())
+            move_list = gamestate.get_valid_moves()
+            gamestate.update(move_list[rng.randrange(len(move_list))])
+    return positions
+
+
+def time_rate(func, min_time):
+    """Returns the number of calls per second of a function.
+
+    The function is called repeatedly until at least min_time seconds
+    have passed.
+
+    Args:
+        func: A function taking no arguments.
+        min_time: The minimum number of seconds to spend calling func.
+
+    Returns:
+        The number of calls per second as a float.
+    """
+
+    calls = 0
+    start = time.perf_counter()
+    end = start + min_time
+    while True:
+        func()
+        calls += 1
+        now = time.perf_counter()
+        if now >= end:
+            return calls / (now - start)
+
+
+def _cycle(items):
+    """Returns a function returning the next item of items on each call,
+    wrapping around at the end.
+    """
+    state = [0]
+
+    def next_item():
+        item = items[state[0]]
+        state[0] = (state[0] + 1) % len(items)
+        return item
+    return next_item
+
+
+def bench_move_generation(min_time):
+    next_position = _cycle(sample_positions(500))
+    rate = time_rate(lambda: next_position().get_valid_moves(), min_time)
+    return {'value': rate, 'unit': 'positions/s', 'higher_is_better': True}
+
+
+def bench_full_move_generation(min_time):
+    next_position = _cycle(sample_positions(500))
+    rate = time_rate(lambda: next_position().get_full_moves(), min_time)
+    return {'value': rate, 'unit': 'positions/s', 'higher_is_better': True}
+
+
+def bench_gamestate_copy(min_time):
+    next_position = _cycle(sample_positions(500))
+    rate = time_rate(lambda: next_position().copy(), min_time)
+    return {'value': rate, 'unit': 'copies/s', 'higher_is_better': True}
+
+
+def bench_gamestate_update(min_time):
+    positions = sample_positions(500)
+    next_pair = _cycle([(gamestate, move)
+                        for gamestate in positions
+                        for move in gamestate.get_valid_moves()])
+
+    def copy_and_update():
+        gamestate, move = next_pair()
+        gamestate.copy().update(move)
+
+    rate = time_rate(copy_and_update, min_time)
+    return {'value': rate, 'unit': 'updates/s', 'higher_is_better': True}
+
+
+def _count_nodes(node):
+    count = 1
+    for child in node.child_ply.values():
+        count += _count_nodes(child)
+    return count
+
+
+def _tree_player_benchmark(player_class):
+    """Returns a benchmark of the nodes per second searched by a
+    TreePlayer subclass at its opening search depth.
+    """
+
+    def bench_tree_player(min_time):
+        positions = sample_positions(20)
+        player = player_class(False)
+        nodes = 0
+        elapsed = 0
+        while elapsed < min_time:
+            for gamestate in positions:
+                root = checkers.players.Node(gamestate.copy())
+                start = time.perf_counter()
+                player.gen_child_ply(root, player.plys_ini)
+                elapsed += time.perf_counter() - start
+                nodes += _count_nodes(root) - 1
+        return {'value': nodes / elapsed,
+                'unit': 'nodes/s',
+                'higher_is_better': True}
+    return bench_tree_player
+
+
+def bench_match_random(min_time):
+    player_1 = checkers.players.RandomPlayer(False)
+    player_2 = checkers.players.RandomPlayer(False)
+    random.seed(0)
+
+    def play_game():
+        checkers.game.CheckersMatch(player_1, player_2, 1, False).match_loop()
+
+    rate = time_rate(play_game, min_time)
+    return {'value': rate, 'unit': 'games/s', 'higher_is_better': True}
+
+
+def random_games(count, seed=0):
+    """Returns the moves of games of random full moves.
+
+    Args:
+        count: The number of games to return.
+        seed: Seed for the random moves.
+
+    Returns:
+        A list of count lists of full moves.
+    """
+
+    rng = random.Random(seed)
+    games = []
+    for ind in range(count):
+        gamestate = checkers.game.Gamestate()
+        moves = []
+        while gamestate.is_game_over() == 2:
+            move_list = gamestate.get_full_moves()
+            move = move_list[rng.randrange(len(move_list))]
+            for step in range(0, len(move), 2):
+                gamestate.update(move[step:step + 2])
+            moves.append(move)
+        games.append(moves)
+    return games
+
+
+def bench_record_write(min_time):
+    next_moves = _cycle(random_games(10))
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'games.ckr')
+        with checkers.record.GameWriter(path) as writer:
+            rate = time_rate(lambda: writer.write(next_moves(), 1,
+                                                  'Random Player',
+                                                  'Random Player',
+                                                  0),
+                             min_time)
+    return {'value': rate, 'unit': 'games/s', 'higher_is_better': True}
+
+
+def bench_record_read(min_time):
+    games = random_games(10)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'games.ckr')
+        with checkers.record.GameWriter(path) as writer:
+            for moves in games * 1000:
+                writer.write(moves, 1, 'Random Player', 'Random Player', 0)
+        start = time.perf_counter()
+        count = 0
+        while time.perf_counter() - start < min_time:
+            for record in checkers.record.read_games(path):
+                count += 1
+        rate = count / (time.perf_counter() - start)
+    return {'value': rate, 'unit': 'games/s', 'higher_is_better': True}
+
+
+def bench_engine_protocol(min_time):
+    """Drives the engine protocol of checkers.engine in a subprocess,
+    timing requests to search sampled positions two plys deep.
+
+    The result includes the 50th and 99th percentile request latencies
+    and the time from starting the process until it is ready.
+    """
+
+    start = time.perf_counter()
+    engine = subprocess.Popen(
+        [sys.executable, '-m', 'checkers.engine'],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        text=True,
+        bufsize=1,
+        cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    def request(lines, last):
+        engine.stdin.write(''.join(line + '\n' for line in lines))
+        engine.stdin.flush()
+        while not engine.stdout.readline().startswith(last):
+            pass
+
+    try:
+        request(['isready'], 'readyok')
+        startup = time.perf_counter() - start
+        next_position = _cycle(sample_positions(200))
+        latencies = []
+        start = time.perf_counter()
+        while time.perf_counter() - start < min_time:
+            gamestate = next_position()
+            request_start = time.perf_counter()
+            request(['position board {} turn {}'.format(
+                         ','.join(map(str, gamestate.board)),
+                         gamestate.turn),
+                     'go depth 2'],
+                    'bestmove')
+            latencies.append(time.perf_counter() - request_start)
+        elapsed = time.perf_counter() - start
+        engine.stdin.write('quit\n')
+        engine.stdin.flush()
+    finally:
+        engine.stdin.close()
+        engine.wait()
+    latencies.sort()
+    return {'value': len(latencies) / elapsed,
+            'unit': 'requests/s',
+            'higher_is_better': True,
+            'latency_p50': latencies[len(latencies) // 2],
+            'latency_p99': latencies[int(len(latencies) * 0.99)],
+            'startup': startup}
+
+
+def bench_model_inference(min_time):
+    import model
+
+    player = model.ModelPlayer(False)
+    next_position = _cycle(sample_positions(500))
+
+    def next_turn():
+        player.gamestate = next_position()
+        player.get_next_turn()
+
+    rate = time_rate(next_turn, min_time)
+    player.compile('frozen')
+    frozen_rate = time_rate(next_turn, min_time)
+    return {'value': 1e6 / rate, 'unit': 'us/move', 'higher_is_better': False,
+            'frozen': 1e6 / frozen_rate}
+
+
+def bench_inference_latency(min_time):
+    """Times single forward passes of the DQN with each inference backend
+    at batch sizes from 1 to 1024, reporting the median and 99th
+    percentile latency of each. The value is the median latency of the
+    frozen backend at batch size 1, the cost of choosing one move.
+    """
+
+    import torch
+    import model
+
+    net = model.DQN()
+    backends = {backend: model.compile_model(net, backend)
+                for backend in model.INFERENCE_BACKENDS}
+    batch_sizes = (1, 4, 16, 64, 256, 1024)
+    result = {'unit': 'us', 'higher_is_better': False}
+    for batch_size in batch_sizes:
+        boards = torch.randint(-3, 4, (batch_size, 32)).float()
+        for backend, compiled in backends.items():
+            latencies = []
+            with torch.inference_mode():
+                for _ in range(10):
+                    compiled(boards)
+                start = time.perf_counter()
+                while (len(latencies) < 100 or time.perf_counter() - start
+                       < min_time / len(batch_sizes) / len(backends)):
+                    call_start = time.perf_counter()
+                    compiled(boards)
+                    latencies.append(time.perf_counter() - call_start)
+            latencies.sort()
+            name = '{}_{}'.format(backend, batch_size)
+            result[name + '_p50'] = latencies[len(latencies) // 2] * 1e6
+            result[name + '_p99'] = (
+                latencies[int(len(latencies) * 0.99)] * 1e6)
+    result['value'] = result['frozen_1_p50']
+    return result
+
+
+def bench_quantized_inference(min_time):
+    """Compares the quantized backend with the frozen one, reporting the
+    latency of single moves and of batches of 256 positions, the size of
+    the weights and how often both choose the same move.
+    """
+
+    import torch
+    import export
+    import model
+
+    net = model.DQN()
+    frozen = model.compile_model(net, 'frozen')
+    quantized = model.compile_model(net, 'quantized')
+    result = {'unit': 'us', 'higher_is_better': False}
+    for batch_size in (1, 256):
+        boards = torch.randint(-3, 4, (batch_size, 32)).float()
+        for backend, compiled in (('frozen', frozen),
+                                  ('quantized', quantized)):
+            with torch.inference_mode():
+                rate = time_rate(lambda: compiled(boards), min_time / 4)
+            result['{}_{}'.format(backend, batch_size)] = 1e6 / rate
+    result['value'] = result['quantized_256']
+    result['frozen_bytes'] = export.archive_size(frozen)
+    result['quantized_bytes'] = export.archive_size(quantized)
+    result['agreement'] = export.move_agreement(
+        net, quantized, *export.sample_boards(2000))
+    return result
+
+
+def legacy_encode(gamestate):
+    """Encodes a position as ModelPlayer did before it reused buffers,
+    allocating a new board tensor and building the mask from a tuple.
+
+    Args:
+        gamestate: A Gamestate object.
+
+    Returns:
+        A pair of the oriented board as a float32 tensor of shape (1, 32)
+        and the mask of the valid moves as an int64 tensor of shape
+        (1, 128), 0 for valid moves and -2 for the others.
+    """
+    import torch
+
+    board_tensor = torch.tensor([gamestate.board], dtype=torch.float32)
+    if gamestate.turn == -1:
+        board_tensor.mul_(-1)
+        board_tensor = board_tensor.flip(1)
+    valid_ind = []
+    for pos, dir in gamestate.get_valid_moves():
+        if gamestate.turn == -1:
+            pos, dir = 31 - pos, (dir + 2) % 4
+        valid_ind.append(pos*4 + dir)
+    mask = tuple(map(lambda s: s not in valid_ind, range(128)))
+    return board_tensor, torch.tensor([mask], dtype=torch.int64) * -2
+
+
+def bench_model_encoding(min_time):
+    import model
+
+    player = model.ModelPlayer(False)
+    positions = sample_positions(500)
+    # Move generation is cached on each gamestate so that only the
+    # encoding itself is timed.
+    for gamestate in positions:
+        valid_moves = gamestate.get_valid_moves()
+        gamestate.get_valid_moves = lambda moves=valid_moves: moves
+    next_position = _cycle(positions)
+
+    def encode():
+        player.gamestate = next_position()
+        player.orient_board()
+        player.get_mask()
+
+    rate = time_rate(encode, min_time)
+    legacy_rate = time_rate(lambda: legacy_encode(next_position()),
+                            min_time)
+    return {'value': 1e6 / rate,
+            'unit': 'us/move',
+            'higher_is_better': False,
+            'legacy_us_per_move': 1e6 / legacy_rate}
+
+
+def _legacy_push_game(memory, temp_memory, step_rewards, last_rewards):
+    """Pushes the transitions of a game as model.py did before they were
+    built together, with reward tensors per team and a push per
+    transition.
+    """
+    import torch
+
+    for team_memory, step, last in zip(temp_memory, step_rewards,
+                                       last_rewards):
+        step = torch.tensor([step], dtype=torch.int64)
+        last = torch.tensor([last], dtype=torch.int64)
+        for ind in range(len(team_memory) - 1):
+            memory.push(team_memory[ind][0],
+                        team_memory[ind][2],
+                        step,
+                        team_memory[ind + 1][0],
+                        team_memory[ind + 1][1])
+        memory.push(team_memory[-1][0], team_memory[-1][2], last, None, None)
+
+
+def bench_game_transitions(min_time):
+    """Times turning the moves of an 80 move self-play game into
+    transitions and storing them in replay memory, against pushing each
+    transition separately.
+    """
+
+    import torch
+    import model
+
+    temp_memory = [[(torch.randint(-2, 3, (1, 32)).to(torch.float32),
+                     torch.full((1, 128), -2, dtype=torch.int64),
+                     torch.randint(128, (1, 1)))
+                    for ind in range(40)]
+                   for team in range(2)]
+    memory = model.ReplayMemory(10000)
+
+    def push_game():
+        memory.push_batch(*model.game_transitions(temp_memory,
+                                                  (1, 0, 1, 0, 0)))
+
+    rate = time_rate(push_game, min_time)
+    legacy_rate = time_rate(
+        lambda: _legacy_push_game(memory,
+                                  temp_memory,
+                                  (model.WIN_STEP, model.LOSS_STEP),
+                                  (model.WIN_REWARD, model.LOSS_REWARD)),
+        min_time)
+    return {'value': 1e6 / rate,
+            'unit': 'us/game',
+            'higher_is_better': False,
+            'legacy_us_per_game': 1e6 / legacy_rate}
+
+
+def bench_replay_sampling(min_time):
+    import torch
+    import model
+
+    memory = model.ReplayMemory(25000)
+    mask = torch.full((1, 128), -2, dtype=torch.int64)
+    mask[0, :7] = 0
+    for ind in range(25000):
+        memory.push(torch.randint(-2, 3, (1, 32)).to(torch.float32),
+                    torch.randint(128, (1, 1)),
+                    torch.tensor([model.WIN_STEP]),
+                    torch.randint(-2, 3, (1, 32)).to(torch.float32),
+                    mask)
+
+    rate = time_rate(lambda: memory.sample(model.BATCH_SIZE), min_time)
+    return {'value': rate,
+            'unit': 'batches/s',
+            'higher_is_better': True,
+            'bytes_per_transition': memory.nbytes() / memory.capacity}
+
+
+def bench_prefetch(min_time):
+    """Times optimization steps on a full replay memory, with batches
+    sampled when needed and sampled ahead by a BatchPrefetcher, reporting
+    the replay samples trained on per second with prefetching and the
+    fraction of steps that waited for a batch.
+    """
+
+    import model
+
+    trainer = model.Trainer()
+    trainer.memory = model.ReplayMemory(25000)
+    fill_replay(trainer.memory, 25000)
+    synchronous = time_rate(trainer.optimize_model, min_time)
+    trainer.start_prefetching(4)
+    prefetched = time_rate(trainer.optimize_model, min_time)
+    starvation = trainer.prefetcher.starved / trainer.prefetcher.requested
+    trainer.stop_prefetching()
+    return {'value': prefetched * model.BATCH_SIZE,
+            'unit': 'samples/s',
+            'higher_is_better': True,
+            'synchronous': synchronous * model.BATCH_SIZE,
+            'starvation': starvation}
+
+
+def bench_learner(min_time):
+    """Times gradient steps on a full replay memory with batches of 128
+    and 1024 transitions, and with 1024 reached by accumulating eight
+    batches of 128, reporting the transitions trained on per second. The
+    value is for batches of 128.
+    """
+
+    import model
+
+    config = model.current_config()
+    result = {'unit': 'samples/s', 'higher_is_better': True}
+    try:
+        for name, batch_size, accumulation in (('batch_128', 128, 1),
+                                               ('batch_1024', 1024, 1),
+                                               ('accumulated_1024', 128, 8)):
+            model.configure({'BATCH_SIZE': batch_size,
+                             'ACCUMULATION_STEPS': accumulation})
+            trainer = model.Trainer()
+            trainer.memory = model.ReplayMemory(25000)
+            fill_replay(trainer.memory, 25000)
+            rate = time_rate(trainer.optimize_model, min_time / 3)
+            result[name] = rate * batch_size * accumulation
+    finally:
+        model.configure(config)
+    result['value'] = result['batch_128']
+    return result
+
+
+def bench_distributed_scaling(min_time):
+    """Times data-parallel gradient steps with one rank and with two
+    ranks on this machine, reporting the transitions trained on per
+    second by both ranks together and their scaling efficiency. Each
+    rank uses one thread.
+    """
+
+    import distributed
+
+    scaling = distributed.measure_scaling((1, 2),
+                                          max(int(min_time * 100), 20))
+    return {'value': scaling[2][0],
+            'unit': 'samples/s',
+            'higher_is_better': True,
+            'one_rank': scaling[1][0],
+            'efficiency': scaling[2][1]}
+
+
+def bench_self_play(min_time):
+    import model
+
+    player = model.TrainPlayer(False)
+    self_play = model.LockstepSelfPlay(player, model.SELF_PLAY_BATCH)
+
+    def play_games():
+        start_iters = player.iters
+        for transitions, match_result in self_play.games(
+                model.SELF_PLAY_BATCH):
+            pass
+        return player.iters - start_iters
+
+    def play_sequential():
+        start_iters = player.iters
+        checkers_match = checkers.game.CheckersMatch(player,
+                                                     player,
+                                                     1,
+                                                     False)
+        checkers_match.match_loop()
+        player.temp_memory = [[], []]
+        return player.iters - start_iters
+
+    rates = {}
+    for key, play in (('lockstep', play_games),
+                      ('sequential', play_sequential)):
+        moves = 0
+        start = time.perf_counter()
+        while True:
+            moves += play()
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        rates[key] = moves / elapsed
+    return {'value': rates['lockstep'],
+            'unit': 'moves/s',
+            'higher_is_better': True,
+            'sequential_moves_per_s': rates['sequential']}
+
+
+def fill_replay(memory, count, chunk=1000000):
+    """Fills a replay memory with random transitions.
+
+    Args:
+        memory: A replay memory of the model module, or anything else
+            with its push_batch method such as a BatchPrefetcher.
+        count: The number of transitions to push.
+        chunk: The most transitions pushed in one batch.
+    """
+
+    import torch
+    import model
+
+    for start in range(0, count, chunk):
+        size = min(chunk, count - start)
+        memory.push_batch(
+            torch.randint(-2, 3, (size, 32), dtype=torch.int8),
+            torch.randint(128, (size,), dtype=torch.uint8),
+            torch.full((size,), model.WIN_STEP),
+            torch.randint(-2, 3, (size, 32), dtype=torch.int8),
+            torch.randint(256, (size, 16), dtype=torch.uint8),
+            torch.ones(size, dtype=torch.bool))
+
+
+def bench_prioritized_sampling(min_time):
+    """Times sampling a batch and updating its priorities in prioritized
+    replay memories from 25 thousand to 10 million transitions, along
+    with uniform sampling from memories of the same sizes.
+    """
+    import torch
+    import model
+
+    result = {'unit': 'batches/s', 'higher_is_better': True}
+    for capacity in (25000, 250000, 2500000, 10000000):
+        memory = model.PrioritizedReplayMemory(capacity)
+        fill_replay(memory, capacity)
+        errors = torch.rand(model.BATCH_SIZE)
+
+        def sample_update():
+            batch = memory.sample(model.BATCH_SIZE)
+            memory.update_priorities(batch.indices, errors)
+
+        rate = time_rate(sample_update, min_time)
+        uniform_rate = time_rate(
+            lambda: model.ReplayMemory.sample(memory, model.BATCH_SIZE),
+            min_time)
+        result.setdefault('value', rate)
+        result['prioritized_{}'.format(capacity)] = rate
+        result['uniform_{}'.format(capacity)] = uniform_rate
+        del memory
+    return result
+
+
+def bench_disk_replay_sampling(min_time):
+    import torch
+    import model
+
+    capacity = 1000000
+    chunk = 100000
+    with tempfile.TemporaryDirectory() as directory:
+        memory = model.DiskReplayMemory(os.path.join(directory, 'replay.mem'),
+                                        capacity)
+        for start in range(0, capacity, chunk):
+            memory.push_batch(
+                torch.randint(-2, 3, (chunk, 32), dtype=torch.int8),
+                torch.randint(128, (chunk,), dtype=torch.uint8),
+                torch.full((chunk,), model.WIN_STEP),
+                torch.randint(-2, 3, (chunk, 32), dtype=torch.int8),
+                torch.randint(256, (chunk, 16), dtype=torch.uint8),
+                torch.ones(chunk, dtype=torch.bool))
+        rate = time_rate(lambda: memory.sample(model.BATCH_SIZE), min_time)
+        memory.close()
+    return {'value': rate,
+            'unit': 'batches/s',
+            'higher_is_better': True,
+            'capacity': capacity,
+            'bytes_per_transition': memory.nbytes() / capacity}
+
+
+def bench_distill_labeling(min_time):
+    """Times labeling positions with the medium teacher of the distill
+    module in this process; generation with several workers labels
+    about this many positions per second per worker.
+    """
+
+    import distill
+
+    positions = list(itertools.islice(
+        distill.sample_positions([], 0.1, seed=0), 20))
+    rate = time_rate(lambda: distill.label_positions(positions, 'medium'),
+                     min_time)
+    return {'value': rate * len(positions),
+            'unit': 'positions/s',
+            'higher_is_better': True}
+
+
+def bench_mcts_self_play(min_time):
+    """Times self-play with tree search in worker processes sharing an
+    inference server, reporting the positions evaluated per second with
+    one worker and with one worker per CPU, and the mean batch size.
+    """
+
+    import mcts
+
+    net = mcts.PolicyValueNet()
+    result = {'unit': 'positions/s', 'higher_is_better': True}
+    for workers in sorted({1, os.cpu_count() or 1}):
+        server = mcts.InferenceServer(net)
+        # Start timing once every worker is running.
+        games = mcts.self_play(server, 1000000, workers, seed=0,
+                               parallel_games=4, simulations=8)
+        next(games)
+        start = time.perf_counter()
+        positions = server.positions
+        batches = server.batches
+        while time.perf_counter() - start < min_time:
+            next(games)
+        elapsed = time.perf_counter() - start
+        games.close()
+        server.close()
+        rate = (server.positions - positions) / elapsed
+        result.setdefault('value', rate)
+        result['workers_{}'.format(workers)] = rate
+        result['mean_batch_{}'.format(workers)] = (
+            (server.positions - positions)
+            / max(server.batches - batches, 1))
+    return result
+
+
+def _startup_time(args, min_time):
+    """Returns the median wall time in seconds of running a new Python
+    process with the arguments args, run repeatedly for at least min_time
+    seconds and at least five times.
+    """
+
+    times = []
+    start = time.perf_counter()
+    while len(times) < 5 or time.perf_counter() - start < min_time:
+        run_start = time.perf_counter()
+        subprocess.run([sys.executable] + args,
+                       check=True,
+                       stdout=subprocess.DEVNULL,
+                       cwd=os.path.dirname(os.path.abspath(__file__)))
+        times.append(time.perf_counter() - run_start)
+    times.sort()
+    return times[len(times) // 2]
+
+
+def _peak_memory(code):
+    """Returns the peak resident memory in megabytes of a new Python
+    process running code, on Linux.
+    """
+
+    # The peak of ru_maxrss survives exec, so it may be the parent's.
+    code += ('\nfor line in open("/proc/self/status"):\n'
+             '    if line.startswith("VmHWM:"):\n'
+             '        print(line.split()[1])')
+    output = subprocess.run([sys.executable, '-c', code],
+                            check=True,
+                            capture_output=True,
+                            text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    return int(output.stdout.split()[-1]) / 1024
+
+
+def bench_numpy_inference(min_time):
+    """Compares playing with the NumPy evaluator against the frozen torch
+    model, reporting the time per move, the positions evaluated per
+    second in batches of 256, and the import time and peak memory of a
+    process that loads a player. The value is the time per move of the
+    NumPy player.
+    """
+
+    import torch
+    import export
+    import model
+    import numpy_model
+
+    with tempfile.TemporaryDirectory() as directory:
+        weights_path = os.path.join(directory, 'model_params.pt')
+        numpy_path = os.path.join(directory, 'model_params.npz')
+        net = model.DQN()
+        torch.save(net.state_dict(), weights_path)
+        numpy_net = export.export_numpy(net.state_dict(), numpy_path)
+        frozen = model.compile_model(net, 'frozen')
+        players = {'torch': model.ModelPlayer(False, frozen),
+                   'numpy': numpy_model.NumpyPlayer(net=numpy_net)}
+        result = {'unit': 'us/move', 'higher_is_better': False}
+        next_position = _cycle(sample_positions(500))
+        for name, player in players.items():
+            def next_turn():
+                player.gamestate = next_position()
+                player.get_next_turn()
+
+            result[name] = 1e6 / time_rate(next_turn, min_time / 4)
+        result['value'] = result['numpy']
+
+        boards = torch.randint(-3, 4, (256, 32)).float()
+        numpy_boards = boards.numpy()
+        with torch.inference_mode():
+            result['torch_batch_positions'] = 256 * time_rate(
+                lambda: frozen(boards), min_time / 4)
+        result['numpy_batch_positions'] = 256 * time_rate(
+            lambda: numpy_net(numpy_boards), min_time / 4)
+
+        loaders = {
+            'torch': 'import model\nmodel.load_inference_player('
+                     'False, {!r}, "frozen", 1, 1)'.format(weights_path),
+            'numpy': 'import numpy_model\nnumpy_model.NumpyPlayer('
+                     'path={!r})'.format(numpy_path),
+        }
+        for name, code in loaders.items():
+            result[name + '_startup_ms'] = _startup_time(['-c', code],
+                                                         min_time / 4) * 1e3
+            result[name + '_peak_mb'] = _peak_memory(code)
+    return result
+
+
+def _cold_start_benchmark(args):
+    """Returns a benchmark of the time a new process takes to run with
+    the arguments args, such as importing a module, in milliseconds. The
+    result includes the start up time of a bare interpreter, which is
+    part of every measurement.
+    """
+
+    def bench_cold_start(min_time):
+        return {'value': _startup_time(args, min_time) * 1e3,
+                'unit': 'ms',
+                'higher_is_better': False,
+                'interpreter': _startup_time(['-c', 'pass'], min_time) * 1e3}
+    return bench_cold_start
+
+
+BENCHMARKS = {
+    'move_generation': bench_move_generation,
+    'full_move_generation': bench_full_move_generation,
+    'gamestate_copy': bench_gamestate_copy,
+    'gamestate_update': bench_gamestate_update,
+    'tree_easy': _tree_player_benchmark(checkers.players.EasyPlayer),
+    'tree_medium': _tree_player_benchmark(checkers.players.MediumPlayer),
+    'tree_hard': _tree_player_benchmark(checkers.players.HardPlayer),
+    'match_random': bench_match_random,
+    'record_write': bench_record_write,
+    'record_read': bench_record_read,
+    'engine_protocol': bench_engine_protocol,
+    'model_inference': bench_model_inference,
+    'inference_latency': bench_inference_latency,
+    'quantized_inference': bench_quantized_inference,
+    'numpy_inference': bench_numpy_inference,
+    'model_encoding': bench_model_encoding,
+    'replay_sampling': bench_replay_sampling,
+    'game_transitions': bench_game_transitions,
+    'disk_replay_sampling': bench_disk_replay_sampling,
+    'prioritized_sampling': bench_prioritized_sampling,
+    'prefetch': bench_prefetch,
+    'learner': bench_learner,
+    'distributed_scaling': bench_distributed_scaling,
+    'self_play': bench_self_play,
+    'distill_labeling': bench_distill_labeling,
+    'mcts_self_play': bench_mcts_self_play,
+    'import_checkers': _cold_start_benchmark(['-c', 'import checkers']),
+    'import_model': _cold_start_benchmark(
+        ['-c', 'from model import ModelPlayer']),
+    'train_help': _cold_start_benchmark(['train.py', '--help']),
+}
+
+
+def run_benchmarks(names, repeat, min_time):
+    """Runs the chosen benchmarks and collects their results.
+
+    Each benchmark is run repeat times and the best run is kept, as it
+    is the least affected by other activity on the machine. Benchmarks
+    whose dependencies are not installed are skipped.
+
+    Args:
+        names: An iterable of keys of the BENCHMARKS dictionary.
+        repeat: The number of timing runs per benchmark.
+        min_time: The minimum number of seconds per timing run.
+
+    Returns:
+        A dictionary from benchmark names to result dictionaries.
+    """
+
+    results = {}
+    for name in names:
+        runs = []
+        try:
+            for run in range(repeat):
+                runs.append(BENCHMARKS[name](min_time))
+        except ImportError as error:
+            print('{}: skipped ({})'.format(name, error), file=sys.stderr)
+            continue
+        if runs[0]['higher_is_better']:
+            best = max(runs, key=lambda result: result['value'])
+        else:
+            best = min(runs, key=lambda result: result['value'])
+        best['runs'] = [result['value'] for result in runs]
+        results[name] = best
+        print('{}: {:.6g} {}'.format(name, best['value'], best['unit']),
+              file=sys.stderr)
+    return results
+
+
+def environment():
+    """Returns metadata describing the machine the benchmarks ran on.
+
+    Returns:
+        A dictionary of strings and integers that can be saved as JSON.
+    """
+
+    metadata = {
+        'timestamp': datetime.datetime.now(
+            datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+    }
+    try:
+        metadata['commit'] = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        metadata['commit'] = None
+    try:
+        import torch
+        metadata['torch'] = torch.__version__
+        metadata['torch_threads'] = torch.get_num_threads()
+    except ImportError:
+        metadata['torch'] = None
+    return metadata
+
+
+def compare(results, baseline, threshold, thresholds=None):
+    """Compares benchmark results against a baseline.
+
+    The slowdown of a benchmark is the relative increase in the time it
+    takes, so that a slowdown of 0.1 means 10% slower regardless of
+    whether the benchmark reports a rate or a latency.
+
+    Args:
+        results: A dictionary of results as returned by run_benchmarks.
+        baseline: A dictionary of results of the same format.
+        threshold: The largest allowed slowdown as a float.
+        thresholds: An optional dictionary from benchmark names to
+            thresholds which overrides threshold for those benchmarks.
+
+    Returns:
+        A dictionary from the names of benchmarks present in both
+        arguments to dictionaries with the keys baseline, current,
+        slowdown, threshold and regression.
+    """
+
+    if thresholds is None:
+        thresholds = {}
+    comparison = {}
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        base_value = baseline[name]['value']
+        value = result['value']
+        if result['higher_is_better']:
+            slowdown = base_value / value - 1
+        else:
+            slowdown = value / base_value - 1
+        limit = thresholds.get(name, threshold)
+        comparison[name] = {
+            'baseline': base_value,
+            'current': value,
+            'slowdown': slowdown,
+            'threshold': limit,
+            'regression': slowdown > limit,
+        }
+    return comparison
+
+
+def _parse_threshold(arg):
+    name, sep, value = arg.partition('=')
+    if not sep or name not in BENCHMARKS:
+        raise argparse.ArgumentTypeError(
+            'Expected NAME=FLOAT with NAME a benchmark.')
+    return name, float(value)
+
+
+def main(argv=None):
+    """Runs the benchmarks from the command line.
+
+    Returns:
+        The exit status; 1 if a regression was found and 0 otherwise.
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--output', help='file to write JSON results to')
+    parser.add_argument('--baseline', help='results file to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='largest allowed slowdown (default 0.1)')
+    parser.add_argument('--threshold-for', type=_parse_threshold,
+                        action='append', default=[], metavar='NAME=FLOAT',
+                        help='largest allowed slowdown for one benchmark')
+    parser.add_argument('--only', action='append', choices=BENCHMARKS,
+                        help='benchmark to run; may be repeated')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='timing runs per benchmark (default 3)')
+    parser.add_argument('--min-time', type=float, default=0.5,
+                        help='seconds per timing run (default 0.5)')
+    args = parser.parse_args(argv)
+
+    # Keep stdout clean for the JSON report when no output file is given.
+    with contextlib.redirect_stdout(sys.stderr):
+        results = run_benchmarks(args.only or BENCHMARKS,
+                                 args.repeat,
+                                 args.min_time)
+    report = {'environment': environment(), 'results': results}
+
+    status = 0
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+        report['comparison'] = compare(results,
+                                       baseline,
+                                       args.threshold,
+                                       dict(args.threshold_for))
+        for name, entry in report['comparison'].items():
+            if entry['regression']:
+                status = 1
+                print('REGRESSION {}: {:.1%} slower (limit {:.1%})'.format(
+                    name, entry['slowdown'], entry['threshold']),
+                    file=sys.stderr)
+
+    report_str = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(report_str + '\n')
+    else:
+        print(report_str)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -37,6 +37,62 @@ Example Usage:
                                False)
     results = test_match.match_loop()
 
+Passing collect_stats=True to CheckersMatch records counters of the work
+done (move generation calls, gamestate copies, search tree nodes) and
+histograms of the time each player takes per move. These are available
+from the stats attribute of the match after match_loop, as a MatchStats
+object from the stats module.
+
+Example Usage:
+    test_match = CheckersMatch(player1,
+                               player2,
+                               10,
+                               False,
+                               collect_stats=True)
+    test_match.match_loop()
+    print(test_match.stats.summary())
+
+The moves of every finished game can be kept by passing a recorder such
+as a GameWriter from the record module, which streams the games to a
+compact binary file. The read_games function of that module yields the
+recorded games back lazily. Passing a seed to CheckersMatch seeds the
+random module before each game, and the seed is saved with the game.
+
+Example Usage:
+    with record.GameWriter('games.ckr') as writer:
+        test_match = CheckersMatch(player1,
+                                   player2,
+                                   10,
+                                   False,
+                                   recorder=writer,
+                                   seed=0)
+        test_match.match_loop()
+    for game_record in record.read_games('games.ckr'):
+        print(game_record.moves, game_record.result)
+
+Many matches can be hosted at once by the asyncio server in the server
+module, where remote clients connect over a socket to play against the
+engines or each other. Engine moves are computed in a pool of worker
+processes. It is run with:
+    python -m checkers.server serve --port 8765
+
+The engine module runs a tree search engine as a long running process
+answering a text protocol on stdin and stdout, keeping its search tree
+between requests. It is run with:
+    python -m checkers.engine
+
+Two players can be compared with the sprt module, which plays games
+with alternating teams until a sequential probability ratio test
+accepts one of two hypotheses about their difference in Elo, usually
+long before a fixed number of games would be finished.
+
+Example Usage:
+    result = sprt.sprt_match(players.MediumPlayer,
+                             players.EasyPlayer,
+                             0,
+                             100)
+    print(result.decision, result.games, result.confidence)
+
 Some implementation conventions: 
 
 Initial checker board:
@@ -95,3 +151,6 @@ and directions.
 
 from . import game
 from . import players
+from . import record
+from . import sprt
+from . import stats
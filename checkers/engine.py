@@ -0,0 +1,340 @@
+"""Runs a tree search engine over a text protocol on stdin and stdout.
+
+The engine is a long running process that answers analysis requests, so
+that external tools pay for Python start up and player set up once. The
+search tree and a table of previously searched positions persist
+between requests; analysing a position reached from an earlier one
+continues from the work already done.
+
+Commands are read one per line:
+
+    engine <name>       Uses the scoring parameters of a key of the
+                        ENGINES dictionary; tree by default.
+    new                 Discards all search state.
+    position start [moves <move> ...]
+    position board <board> turn <1|-1> [cont <pos>] [moves <move> ...]
+                        Sets the position to search, optionally followed
+                        by full moves played from it.
+    go [depth <plys>] [nodes <count>] [movetime <ms>] [infinite]
+                        Searches the position in the background. Without
+                        limits the depth is that of the chosen engine.
+    stop                Stops the search once the current move of the
+                        position has been searched.
+    isready             Answered with readyok.
+    quit                Exits.
+
+Boards and moves use the format of the server module: the 32 board
+integers separated by commas and full moves as comma separated integers.
+While searching the engine writes a line
+
+    info depth <plys> score <score> nodes <count> time <ms> pv <move>
+
+after each completed depth, and finally
+
+    bestmove <move>
+
+or bestmove none if there are no valid moves. Scores are from the
+perspective of team 1, as in TreePlayer, and nodes counts the nodes
+scored by the search. Errors are reported as lines starting with error.
+
+Example Usage:
+    python -m checkers.engine
+
+Classes:
+    Engine: Holds the search state and answers commands.
+
+Functions:
+    main: Runs the engine on stdin and stdout.
+"""
+
+import sys
+import threading
+import time
+
+from . import game
+from . import players
+from . import stats as match_stats
+
+
+ENGINES = {
+    'tree': players.TreePlayer,
+    'easy': players.EasyPlayer,
+    'medium': players.MediumPlayer,
+    'hard': players.HardPlayer,
+}
+
+MAX_DEPTH = 64
+
+
+def format_move(move):
+    return ','.join(map(str, move))
+
+
+def parse_move(move_str):
+    return tuple(int(entry) for entry in move_str.split(','))
+
+
+class Engine():
+    """Holds the search state and answers protocol commands.
+
+    Attributes:
+        player: The TreePlayer whose scoring methods are used.
+        root: The Node of the position to search.
+        table: A dictionary from position keys to the Node objects of
+            previously searched positions. It is cleared once it holds
+            more than table_size entries.
+        table_size: The largest number of entries kept in table.
+        stats: A MatchStats object attached to every searched gamestate
+            that counts the nodes searched.
+        output: A function writing a line of output.
+    """
+
+    def __init__(self, output=print, table_size=100000):
+        self.player = ENGINES['tree'](False)
+        self.table = {}
+        self.table_size = table_size
+        self.stats = match_stats.MatchStats()
+        self.output = output
+        self.root = None
+        self._output_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._search_thread = None
+        self.set_position(game.Gamestate())
+
+    def send(self, line):
+        with self._output_lock:
+            self.output(line)
+
+    @staticmethod
+    def position_key(gamestate):
+        return (tuple(gamestate.board), gamestate.turn, gamestate.cont)
+
+    def set_position(self, gamestate):
+        """Sets the position to search, reusing the stored node of that
+        position if it has been searched before.
+        """
+        key = self.position_key(gamestate)
+        node = self.table.get(key)
+        if node is None:
+            gamestate.stats = self.stats
+            node = players.Node(gamestate)
+            self.table[key] = node
+        self.root = node
+
+    def _store_children(self, node, plys):
+        """Adds the nodes up to plys below node to the table."""
+        if plys == 0 or len(self.table) > self.table_size:
+            return
+        for child in node.child_ply.values():
+            self.table.setdefault(self.position_key(child.gamestate), child)
+            self._store_children(child, plys - 1)
+
+    def _default_depth(self):
+        ply_count = self.root.gamestate.ply_count
+        if ply_count > self.player.late_cutoff:
+            return self.player.plys_late
+        elif ply_count > self.player.mid_cutoff:
+            return self.player.plys_mid
+        return self.player.plys_ini
+
+    def _best_move(self):
+        child_items = list(self.root.child_ply.items())
+        if self.root.gamestate.turn == 1:
+            return max(child_items, key=lambda item: item[1].score)
+        return min(child_items, key=lambda item: item[1].score)
+
+    def _search_depth(self, depth, node_limit):
+        """Searches the root to the given depth.
+
+        Returns:
+            True if the depth was completed, or False if the search was
+            stopped first.
+        """
+        if not self.root.child_ply:
+            self.player.gen_child_ply(self.root, 1)
+        for child in self.root.child_ply.values():
+            if (self._stop.is_set()
+                    or self.stats.nodes_scored >= node_limit):
+                return False
+            if depth > 1 and not child.terminal:
+                child_scores = self.player.gen_child_ply(child, depth - 1)
+                self.player.score_branch(child, child_scores)
+        return True
+
+    def search(self, depth=None, nodes=None, movetime=None):
+        """Searches the root by iterative deepening, sending an info line
+        after each completed depth and the best move at the end.
+
+        Args:
+            depth: The deepest search in plys, or None for no limit.
+            nodes: The largest number of nodes to score, or None.
+            movetime: The longest search time in seconds, or None.
+        """
+        start = time.perf_counter()
+        start_nodes = self.stats.nodes_scored
+        node_limit = float('inf') if nodes is None else start_nodes + nodes
+        timer = None
+        if movetime is not None:
+            timer = threading.Timer(movetime, self._stop.set)
+            timer.start()
+
+        best = None
+        searched = 0
+        root_gamestate = self.root.gamestate
+        if root_gamestate.get_valid_moves():
+            while depth is None or searched < depth:
+                if not self._search_depth(searched + 1, node_limit):
+                    break
+                searched += 1
+                best = self._best_move()
+                self.send('info depth {} score {:.6g} nodes {} time {} pv {}'
+                          .format(searched,
+                                  best[1].score,
+                                  self.stats.nodes_scored - start_nodes,
+                                  int((time.perf_counter() - start) * 1e3),
+                                  format_move(best[0])))
+                if searched >= MAX_DEPTH:
+                    break
+            if best is None:
+                # Stopped before the first depth; fall back on the
+                # shallow scores of the root's children.
+                best = self._best_move()
+        if timer is not None:
+            timer.cancel()
+        self._store_children(self.root, 2)
+        if len(self.table) > self.table_size:
+            self.table.clear()
+            self.table[self.position_key(root_gamestate)] = self.root
+        self.send('bestmove {}'.format('none' if best is None
+                                       else format_move(best[0])))
+
+    def stop(self):
+        """Stops a running search and waits for its best move."""
+        if self._search_thread is not None:
+            self._stop.set()
+            self._search_thread.join()
+            self._search_thread = None
+
+    def _parse_position(self, args):
+        moves = []
+        if 'moves' in args:
+            ind = args.index('moves')
+            moves = [parse_move(move_str) for move_str in args[ind + 1:]]
+            args = args[:ind]
+        gamestate = game.Gamestate()
+        if args[0] == 'board':
+            board = list(parse_move(args[1]))
+            if len(board) != 32 or any(piece not in (-2, -1, 0, 1, 2)
+                                       for piece in board):
+                raise ValueError('expected 32 pieces')
+            gamestate.board = board
+            options = dict(zip(args[2::2], args[3::2]))
+            gamestate.turn = int(options.get('turn', 1))
+            if gamestate.turn not in (1, -1):
+                raise ValueError('turn should be 1 or -1')
+            if 'cont' in options:
+                gamestate.cont = int(options['cont'])
+        elif args[0] != 'start':
+            raise ValueError('expected start or board')
+        for move in moves:
+            if move not in gamestate.get_full_moves():
+                raise ValueError('invalid move {}'.format(format_move(move)))
+            for ind in range(0, len(move), 2):
+                gamestate.update(move[ind:ind + 2])
+        return gamestate
+
+    def _parse_go(self, args):
+        limits = {'depth': None, 'nodes': None, 'movetime': None}
+        infinite = False
+        ind = 0
+        while ind < len(args):
+            if args[ind] == 'infinite':
+                infinite = True
+                ind += 1
+            elif args[ind] in limits:
+                limits[args[ind]] = int(args[ind + 1])
+                ind += 2
+            else:
+                raise ValueError('unknown limit {}'.format(args[ind]))
+        if limits['movetime'] is not None:
+            limits['movetime'] /= 1e3
+        if not infinite and all(limit is None for limit in limits.values()):
+            limits['depth'] = self._default_depth()
+        return limits
+
+    def handle(self, line):
+        """Answers a single command.
+
+        Returns:
+            False if the command was quit, and True otherwise.
+        """
+        args = line.split()
+        if not args:
+            return True
+        command = args[0]
+        if (self._search_thread is not None
+                and not self._search_thread.is_alive()):
+            self._search_thread.join()
+            self._search_thread = None
+        if command == 'quit':
+            self.stop()
+            return False
+        elif command == 'isready':
+            self.send('readyok')
+        elif command == 'stop':
+            self.stop()
+        elif self._search_thread is not None:
+            # Other commands wait for the search to finish on its own.
+            self.wait()
+            return self.handle(line)
+        elif command == 'go':
+            try:
+                limits = self._parse_go(args[1:])
+            except (IndexError, ValueError) as error:
+                self.send('error {}'.format(error))
+                return True
+            self._stop.clear()
+            self._search_thread = threading.Thread(target=self.search,
+                                                   kwargs=limits,
+                                                   daemon=True)
+            self._search_thread.start()
+        elif command == 'position':
+            try:
+                self.set_position(self._parse_position(args[1:]))
+            except (IndexError, ValueError) as error:
+                self.send('error {}'.format(error))
+        elif command == 'engine':
+            if len(args) < 2 or args[1] not in ENGINES:
+                self.send('error engines are {}'.format(' '.join(ENGINES)))
+            elif self.player.name != ENGINES[args[1]].name:
+                self.player = ENGINES[args[1]](False)
+                self.table.clear()
+                self.set_position(self.root.gamestate)
+        elif command == 'new':
+            self.table.clear()
+            self.set_position(game.Gamestate())
+        else:
+            self.send('error unknown command {}'.format(command))
+        return True
+
+    def wait(self):
+        """Waits for a running search to finish on its own."""
+        if self._search_thread is not None:
+            self._search_thread.join()
+            self._search_thread = None
+
+
+def main():
+    def output(line):
+        sys.stdout.write(line + '\n')
+        sys.stdout.flush()
+
+    engine = Engine(output)
+    for line in sys.stdin:
+        if not engine.handle(line):
+            return
+    engine.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -14,6 +14,23 @@ Functions:
         on the map.
 """
 
+import random
+import time
+
+from . import stats as match_stats
+
+# Networks playing checkers see every board from the perspective of team
+# 1. For team 2 the board is reversed and negated, and the move
+# (pos, dir) becomes (31 - pos, DIR_TRANSLATOR[dir]). MOVE_INDEX[turn]
+# maps the index 4*pos + dir of a move to its index as seen by such a
+# network, and back.
+DIR_TRANSLATOR = (2, 3, 0, 1)
+MOVE_INDEX = {
+    1: tuple(range(128)),
+    -1: tuple(4*(31 - ind // 4) + DIR_TRANSLATOR[ind % 4]
+              for ind in range(128)),
+}
+
 # TODO: Add piece_count method that returns the number of each piece as
 # a tuple.
 
@@ -104,8 +121,13 @@ class Gamestate():
         record full move in prev_move.
     invalid_flag: A boolean that is True if the last attempted move was
         invalid.
+    stats: A MatchStats object from the stats module counting the work
+        done on this gamestate and its copies, or None if statistics
+        are not being collected.
     """
 
+    stats = None
+
     # Some dictionaries used in the class methods.
     piece_dirs = {
         1: (2, 3),
@@ -305,6 +327,8 @@ class Gamestate():
             A list of all valid moves from this gamestate. The moves are
             represented as tuples of length two.
         """
+        if self.stats is not None:
+            self.stats.valid_moves_calls += 1
         valid_moves = []
         # Iterate through all possible moves
         for pos in range(32):
@@ -406,6 +430,9 @@ class Gamestate():
         copy_gamestate.plys_since_capture = self.plys_since_capture
         copy_gamestate.prev_move = self.prev_move
         copy_gamestate.move_mem = self.move_mem
+        if self.stats is not None:
+            self.stats.copies += 1
+            copy_gamestate.stats = self.stats
         return copy_gamestate
 
     def get_full_moves(self):
@@ -416,6 +443,8 @@ class Gamestate():
             tuples of even length, where lengths longer than two are
             multiple jumps.
         """
+        if self.stats is not None:
+            self.stats.full_moves_calls += 1
         full_moves = []
         valid_moves = self.get_valid_moves()
         for move in valid_moves:
@@ -453,9 +482,20 @@ class CheckersMatch():
     score_2: Same as score_1 but for team 2.
     best_of: A boolean, where True indicates the match is a "best of"
         system.
+    stats: A MatchStats object from the stats module holding the
+        statistics collected over the match, or None if they are not
+        being collected.
+    recorder: An object with a write method, such as a GameWriter from
+        the record module, that each finished game is passed to, or
+        None if games are not recorded.
+    seed: An integer; if not None, the random module is seeded with
+        seed + played_count before each game.
+    game_moves: A list of the full moves played in the current game
+        when it is being recorded.
     """
 
-    def __init__(self, player_1, player_2, game_count, best_of):
+    def __init__(self, player_1, player_2, game_count, best_of,
+                 collect_stats=False, recorder=None, seed=None):
         """Initializes the checkers match.
         
         Args:
@@ -465,6 +505,14 @@ class CheckersMatch():
             game_count: The total number of games to be played.
             best_of: A boolean, where True indicates the match is a "best of"
                 system.
+            collect_stats: A boolean, where True indicates statistics on
+                the work done by the gamestates and players should be
+                collected into the stats attribute.
+            recorder: An object with a write method taking the moves,
+                result, player names and seed of a finished game, such
+                as a GameWriter from the record module.
+            seed: An integer used to seed the random module before each
+                game so that games can be reproduced, or None.
         
         Raises:
             TypeError: If game_count is not an integer or best_of is not
@@ -490,6 +538,13 @@ class CheckersMatch():
         self.score_1 = 0
         self.score_2 = 0
         self.best_of = best_of
+        if collect_stats:
+            self.stats = match_stats.MatchStats()
+        else:
+            self.stats = None
+        self.recorder = recorder
+        self.seed = seed
+        self.game_moves = []
 
     def game_loop(self):
         """The loop over moves in each individual game of checkers.
@@ -502,6 +557,8 @@ class CheckersMatch():
         0: Draw
         1: Team 1 wins.
         """
+        stats = self.stats
+        record = self.recorder is not None
         while True:
             result = self.gamestate.is_game_over()
             if result != 2:
@@ -512,13 +569,21 @@ class CheckersMatch():
             else:
                 current_player = self.player_2
 
-            next_move = current_player.get_next_turn()
+            if stats is None:
+                next_move = current_player.get_next_turn()
+            else:
+                start = time.perf_counter()
+                next_move = current_player.get_next_turn()
+                stats.move_times[self.gamestate.turn].add(
+                    time.perf_counter() - start)
             if not self.gamestate.is_valid(next_move):
                 self.gamestate.invalid_flag = True
                 continue
             else:
                 self.gamestate.invalid_flag = False
                 self.gamestate.update(next_move)
+                if record and self.gamestate.cont is None:
+                    self.game_moves.append(self.gamestate.prev_move)
 
     def is_match_over(self):
         """Tests whether the match is over.
@@ -534,34 +599,58 @@ class CheckersMatch():
                 return True
         return False
 
-    def match_loop(self):
-        """The loop over the games of checkers in the match.
-
-        Each iteration of the loop is a single game of checkers.
+    def start_game(self):
+        """Sets up a new game of the match.
 
-        Returns:
-            A tuple containing the score for team 1, the score for team
-            2, team 1 wins, team 2 wins, and draws, in that order.
+        Creates a new gamestate and passes it to both players, seeding
+        the random module first if a seed was given.
         """
-        while not self.is_match_over():
-            self.gamestate = Gamestate()
-            self.player_1.gamestate = self.gamestate
-            self.player_2.gamestate = self.gamestate
-
-            game_result = self.game_loop()
-            match game_result:
-                case 1:
-                    self.wins_1 += 1
-                    self.score_1 += 1
-                case -1:
-                    self.wins_2 += 1
-                    self.score_2 += 1
-                case 0:
-                    self.draws += 1
-                    self.score_1 += 0.5
-                    self.score_2 += 0.5
-            self.played_count += 1
+        self.gamestate = Gamestate()
+        if self.stats is not None:
+            self.gamestate.stats = self.stats
+        self.player_1.gamestate = self.gamestate
+        self.player_2.gamestate = self.gamestate
+        if self.seed is not None:
+            random.seed(self.seed + self.played_count)
+        self.game_moves = []
+
+    def end_game(self, game_result):
+        """Records the result of a finished game in the match.
 
+        Args:
+            game_result: The result of the game as returned by
+                game_loop.
+        """
+        if self.recorder is not None:
+            if self.seed is None:
+                game_seed = None
+            else:
+                game_seed = self.seed + self.played_count
+            self.recorder.write(self.game_moves,
+                                game_result,
+                                self.player_1.name,
+                                self.player_2.name,
+                                game_seed)
+        match game_result:
+            case 1:
+                self.wins_1 += 1
+                self.score_1 += 1
+            case -1:
+                self.wins_2 += 1
+                self.score_2 += 1
+            case 0:
+                self.draws += 1
+                self.score_1 += 0.5
+                self.score_2 += 0.5
+        self.played_count += 1
+        if self.stats is not None:
+            self.stats.games += 1
+            self.stats.plys += self.gamestate.ply_count
+
+    def results(self):
+        """Returns a tuple containing the score for team 1, the score
+        for team 2, team 1 wins, team 2 wins, and draws, in that order.
+        """
         return (
             self.score_1,
             self.score_2,
@@ -569,3 +658,17 @@ class CheckersMatch():
             self.wins_2,
             self.draws
             )
+
+    def match_loop(self):
+        """The loop over the games of checkers in the match.
+
+        Each iteration of the loop is a single game of checkers.
+
+        Returns:
+            A tuple containing the score for team 1, the score for team
+            2, team 1 wins, team 2 wins, and draws, in that order.
+        """
+        while not self.is_match_over():
+            self.start_game()
+            self.end_game(self.game_loop())
+        return self.results()
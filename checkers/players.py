@@ -198,6 +198,8 @@ class TreePlayer(Player):
             node: An instance of the Node class to be scored.
         """
 
+        if node.gamestate.stats is not None:
+            node.gamestate.stats.nodes_scored += 1
         score = 0
         for piece in node.gamestate.board:
             match piece:
@@ -219,6 +221,8 @@ class TreePlayer(Player):
             child_scores: A list of the scores of its child nodes.
         """
 
+        if node.gamestate.stats is not None:
+            node.gamestate.stats.nodes_scored += 1
         if node.gamestate.turn == 1:
             node.score = max(child_scores)
         else:
@@ -246,6 +250,8 @@ class TreePlayer(Player):
         score_list = []
         if not node.child_ply:
             # Ply has not been generated
+            if node.gamestate.stats is not None:
+                node.gamestate.stats.nodes_expanded += 1
             move_list = node.gamestate.get_full_moves()
             if not move_list:
                 node.terminal = True
@@ -268,9 +274,11 @@ class TreePlayer(Player):
                     score_list.append(child.score)
 
         else:
-            # Ply has previously been generated
+            # Ply has previously been generated. If this is the last ply
+            # to search, the children already have scores at least as
+            # deep as required.
             for child in node.child_ply.values():
-                if not child.terminal:
+                if plys > 1 and not child.terminal:
                     # Need to update non-terminal nodes
                     child_scores = self.gen_child_ply(child, plys - 1)
                     self.score_branch(child, child_scores)
@@ -320,6 +328,8 @@ class TreePlayer(Player):
                 self.plys = self.plys_late
             elif self.gamestate.ply_count > self.mid_cutoff:
                 self.plys = self.plys_mid
+            if self.gamestate.stats is not None:
+                self.gamestate.stats.add_search(self.plys)
             child_scores = self.gen_child_ply(self.parent_node, self.plys)
 
             # Debug code to visualize tree:
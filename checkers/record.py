@@ -0,0 +1,276 @@
+"""Records finished games of checkers to a compact binary file.
+
+Games are appended one at a time to a record file as they finish, so a
+match of any length can be recorded with constant memory. The file is
+only ever appended to; a game cut off by a crash while it was being
+written is ignored by the reader and removed when the file is next
+opened for writing.
+
+A record file begins with the 5 byte header b'CKGR' followed by the
+format version. Each game is then stored as a fixed size header, the
+names of both players encoded in UTF-8, and the moves. Every move
+tuple (pos, dir) of a full move is stored as the single byte
+4*pos + dir, with the high bit set on the last tuple of each full move.
+A typical game is therefore about as many bytes as it has plys.
+
+Example Usage:
+    with GameWriter('games.ckr') as writer:
+        test_match = CheckersMatch(player1,
+                                   player2,
+                                   10,
+                                   False,
+                                   recorder=writer)
+        test_match.match_loop()
+
+    for record in read_games('games.ckr'):
+        print(record.result, len(record.moves))
+
+Classes:
+    GameRecord: A named tuple holding a single recorded game.
+    GameWriter: Appends finished games to a record file.
+
+Functions:
+    encode_moves: Encodes a sequence of full moves as bytes.
+    decode_moves: Decodes bytes from encode_moves to full moves.
+    read_games: Lazily yields the games stored in a record file.
+    replay: Yields the gamestates of a recorded game.
+"""
+
+import struct
+from collections import namedtuple
+
+from . import game
+
+
+MAGIC = b'CKGR'
+VERSION = 1
+
+# result, flags, name 1 length, name 2 length, seed, move byte count
+_GAME_HEADER = struct.Struct('<bBBBqI')
+_HAS_SEED = 1
+
+GameRecord = namedtuple('GameRecord',
+                        ('moves', 'result', 'player_1', 'player_2', 'seed'))
+GameRecord.__doc__ = """A single recorded game of checkers.
+
+Attributes:
+    moves: A tuple of the full moves of the game in order, as recorded
+        in the prev_move attribute of the Gamestate.
+    result: The result of the game as returned by
+        CheckersMatch.game_loop; 1, -1 or 0 for a draw.
+    player_1: The name of the player of team 1.
+    player_2: The name of the player of team 2.
+    seed: The integer the random module was seeded with before the
+        game, or None if it was not seeded.
+"""
+
+
+def encode_moves(moves):
+    """Encodes a sequence of full moves as bytes.
+
+    Args:
+        moves: An iterable of full moves; tuples of even length
+            alternating positions and directions.
+
+    Returns:
+        A bytes object with one byte per move tuple.
+    """
+
+    encoded = bytearray()
+    for move in moves:
+        for ind in range(0, len(move) - 2, 2):
+            encoded.append(4*move[ind] + move[ind + 1])
+        encoded.append(0x80 | (4*move[-2] + move[-1]))
+    return bytes(encoded)
+
+
+def decode_moves(encoded):
+    """Decodes bytes from encode_moves back to full moves.
+
+    Args:
+        encoded: A bytes-like object returned by encode_moves.
+
+    Returns:
+        A tuple of full moves.
+    """
+
+    moves = []
+    move = ()
+    for byte in encoded:
+        move += ((byte & 0x7f) >> 2, byte & 3)
+        if byte & 0x80:
+            moves.append(move)
+            move = ()
+    return tuple(moves)
+
+
+class GameWriter():
+    """Appends finished games to a record file.
+
+    Writes are buffered, so records only reach the disk on flush or
+    close. The writer may be used as a context manager.
+
+    Attributes:
+        path: The path of the record file.
+        games_written: The number of games written by this writer.
+    """
+
+    def __init__(self, path, buffer_size=1 << 16):
+        """Opens the record file for appending, creating it if needed.
+
+        If the file ends with a partially written game, it is truncated
+        to the end of the last complete game.
+
+        Args:
+            path: The path of the record file.
+            buffer_size: The size in bytes of the write buffer.
+
+        Raises:
+            ValueError: If the file exists and is not a record file.
+        """
+
+        self.path = path
+        self.games_written = 0
+        try:
+            with open(path, 'r+b') as check_file:
+                if check_file.read(1):
+                    check_file.seek(0)
+                    _read_file_header(check_file)
+                    check_file.truncate(_complete_length(check_file))
+        except FileNotFoundError:
+            pass
+        self._file = open(path, 'ab', buffering=buffer_size)
+        if self._file.tell() == 0:
+            self._file.write(MAGIC + bytes((VERSION,)))
+
+    def write(self, moves, result, player_1, player_2, seed=None):
+        """Appends a finished game to the file.
+
+        Args:
+            moves: A sequence of the full moves of the game.
+            result: The result of the game; 1, -1 or 0.
+            player_1: The name of the player of team 1.
+            player_2: The name of the player of team 2.
+            seed: The integer the random module was seeded with before
+                the game, or None.
+        """
+
+        name_1 = _encode_name(player_1)
+        name_2 = _encode_name(player_2)
+        encoded = encode_moves(moves)
+        if seed is None:
+            flags = 0
+            seed = 0
+        else:
+            flags = _HAS_SEED
+        self._file.write(_GAME_HEADER.pack(result,
+                                           flags,
+                                           len(name_1),
+                                           len(name_2),
+                                           seed,
+                                           len(encoded))
+                         + name_1 + name_2 + encoded)
+        self.games_written += 1
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _encode_name(name):
+    # Names are cut to 255 bytes on a character boundary, so a name cut
+    # within a multibyte character still decodes.
+    return name.encode()[:255].decode('utf-8', 'ignore').encode()
+
+
+def _read_file_header(record_file):
+    header = record_file.read(len(MAGIC) + 1)
+    if len(header) < len(MAGIC) + 1 or header[:len(MAGIC)] != MAGIC:
+        raise ValueError('Not a checkers game record file.')
+    if header[len(MAGIC)] != VERSION:
+        raise ValueError('Unsupported record version {}.'.format(
+            header[len(MAGIC)]))
+
+
+def _complete_length(record_file):
+    """Returns the length of a record file up to the end of its last
+    complete game, reading only the game headers.
+    """
+    end = record_file.seek(0, 2)
+    position = len(MAGIC) + 1
+    while position + _GAME_HEADER.size <= end:
+        record_file.seek(position)
+        header = _GAME_HEADER.unpack(record_file.read(_GAME_HEADER.size))
+        next_position = (position + _GAME_HEADER.size
+                         + header[2] + header[3] + header[5])
+        if next_position > end:
+            break
+        position = next_position
+    return position
+
+
+def read_games(path, buffer_size=1 << 16):
+    """Lazily yields the games stored in a record file.
+
+    Only one game is held in memory at a time. A partially written game
+    at the end of the file is ignored.
+
+    Args:
+        path: The path of the record file.
+        buffer_size: The size in bytes of the read buffer.
+
+    Yields:
+        GameRecord named tuples in the order they were written.
+
+    Raises:
+        ValueError: If the file is not a record file.
+    """
+
+    with open(path, 'rb', buffering=buffer_size) as record_file:
+        _read_file_header(record_file)
+        while True:
+            header = record_file.read(_GAME_HEADER.size)
+            if len(header) < _GAME_HEADER.size:
+                return
+            (result, flags, name_1_len, name_2_len, seed,
+             move_len) = _GAME_HEADER.unpack(header)
+            body_len = name_1_len + name_2_len + move_len
+            body = record_file.read(body_len)
+            if len(body) < body_len:
+                return
+            yield GameRecord(
+                decode_moves(body[name_1_len + name_2_len:]),
+                result,
+                body[:name_1_len].decode(),
+                body[name_1_len:name_1_len + name_2_len].decode(),
+                seed if flags & _HAS_SEED else None)
+
+
+def replay(moves):
+    """Yields the gamestates of a recorded game.
+
+    Args:
+        moves: A sequence of full moves, such as the moves attribute of
+            a GameRecord.
+
+    Yields:
+        Pairs (gamestate, move) for every full move of the game, where
+        gamestate is a Gamestate object before the move is played. The
+        final gamestate is yielded last, paired with None.
+    """
+
+    gamestate = game.Gamestate()
+    for move in moves:
+        yield gamestate.copy(), move
+        for ind in range(0, len(move), 2):
+            gamestate.update(move[ind:ind + 2])
+    yield gamestate, None
+
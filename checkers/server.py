@@ -0,0 +1,554 @@
+"""Hosts many concurrent matches of checkers over sockets.
+
+Runs an asyncio server on a local TCP port or Unix socket. Every
+connection is a remote player that may play matches against one of the
+engines (the random and tree search players) or against another remote
+player. Engine moves are computed in a pool of worker processes, so a
+slow tree search never stalls the other games hosted by the server.
+
+The protocol is line based. A client starts a match with
+
+    play <opponent> <team> [games]
+
+where opponent is a key of the ENGINES dictionary or 'client' to be
+paired with the next remote player that asks for a client opponent,
+team is 1 or 2 and games defaults to 1. The server then sends
+
+    game <number>                 at the start of each game,
+    turn <board> <moves>          when it is the client's turn,
+    over <result>                 at the end of each game, and
+    result <score_1> <score_2> <wins_1> <wins_2> <draws>
+
+at the end of the match. The board is the 32 integers of the gamestate
+board separated by commas and moves are the valid full moves, each as
+comma separated integers, separated by spaces. The client answers a
+turn with
+
+    move <full move>
+
+using the same format as the listed moves. An invalid move is answered
+with an error line and the turn is sent again. The client may send quit
+at any time outside a match to close the connection.
+
+The module can be run as a script to start a server or to run a load
+test against a running server:
+
+    python -m checkers.server serve --port 8765 --workers 4
+    python -m checkers.server load-test --port 8765 --clients 200
+
+Classes:
+    GameServer: Accepts connections and hosts their matches.
+
+Functions:
+    engine_move: Computes the full move of an engine player.
+    play_game: Plays a single game of a match asynchronously.
+    play_match: Plays a whole match asynchronously.
+    load_test: Plays many concurrent matches against a server.
+    main: Command line entry point.
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import random
+import time
+
+from . import game
+from . import players
+
+
+ENGINES = {
+    'random': players.RandomPlayer,
+    'easy': players.EasyPlayer,
+    'medium': players.MediumPlayer,
+    'hard': players.HardPlayer,
+}
+
+
+def format_move(move):
+    return ','.join(map(str, move))
+
+
+def parse_move(move_str):
+    """Returns the full move tuple written by format_move.
+
+    Raises:
+        ValueError: If move_str is not integers separated by commas.
+    """
+    return tuple(int(entry) for entry in move_str.split(','))
+
+
+def engine_move(player, gamestate):
+    """Computes the full move of an engine player.
+
+    This is run in the worker pool. The player keeps its own copy of
+    the gamestate, so that a TreePlayer reuses its search tree between
+    the moves of a game. The opponent's last move is applied to that
+    copy; if it then differs from the given gamestate, such as at the
+    start of a game, the player starts afresh from a copy of it.
+
+    Args:
+        player: A Player object, left as it is after the move.
+        gamestate: The Gamestate object of the game. It is not
+            modified.
+
+    Returns:
+        A tuple of the full move chosen by the player and the player.
+        The player is a copy of the given one if the worker pool is a
+        process pool.
+    """
+
+    own = player.gamestate
+    if own is not None and gamestate.prev_move is not None:
+        move = gamestate.prev_move
+        for ind in range(0, len(move), 2):
+            own.update(move[ind:ind + 2])
+    if (own is None or own.board != gamestate.board
+            or own.turn != gamestate.turn
+            or own.ply_count != gamestate.ply_count):
+        player.gamestate = own = gamestate.copy()
+    turn = own.turn
+    full_move = ()
+    while own.turn == turn:
+        move = player.get_next_turn()
+        own.update(move)
+        full_move += move
+    return full_move, player
+
+
+class _RemotePlayer(players.Player):
+    """Stands in for a player connected to the server.
+
+    The moves of remote players are supplied through the connection
+    rather than get_next_turn, so this only carries the connection and
+    a name for the match records.
+    """
+
+    name = 'Remote Player'
+
+    def __init__(self, reader, writer):
+        super().__init__()
+        self.reader = reader
+        self.writer = writer
+
+    async def send(self, line):
+        self.writer.write(line.encode() + b'\n')
+        await self.writer.drain()
+
+    async def receive(self):
+        """Returns the next line from the connection, or None if it has
+        closed.
+        """
+        line = await self.reader.readline()
+        if not line:
+            return None
+        return line.decode().strip()
+
+    def connected(self):
+        """Returns whether the connection is still open both ways."""
+        return not (self.reader.at_eof() or self.writer.is_closing())
+
+    async def get_full_move(self, gamestate, full_moves):
+        """Asks the client for its next move until it gives a valid one.
+
+        Raises:
+            ConnectionError: If the connection closes first.
+        """
+        turn_line = 'turn {} {}'.format(
+            format_move(gamestate.board),
+            ' '.join(map(format_move, full_moves)))
+        while True:
+            await self.send(turn_line)
+            line = await self.receive()
+            if line is None:
+                raise ConnectionError('Player disconnected.')
+            command, _, move_str = line.partition(' ')
+            try:
+                move = parse_move(move_str)
+            except ValueError:
+                move = None
+            if command == 'move' and move in full_moves:
+                return move
+            await self.send('error invalid move')
+
+
+class _EnginePlayer(players.Player):
+    """Stands in for an engine player computed in the worker pool.
+
+    One engine player is kept for the whole match, and is passed to
+    engine_move with each move.
+    """
+
+    def __init__(self, engine, executor):
+        super().__init__()
+        self.engine = ENGINES[engine](False)
+        self.executor = executor
+        self.name = self.engine.name
+
+    async def get_full_move(self, gamestate, full_moves):
+        loop = asyncio.get_running_loop()
+        full_move, self.engine = await loop.run_in_executor(
+            self.executor, engine_move, self.engine, gamestate.copy())
+        return full_move
+
+
+async def play_game(match):
+    """Plays a single game of a match asynchronously.
+
+    Both players of the match must have an asynchronous get_full_move
+    method taking the gamestate and its valid full moves. The game
+    should already be set up with the start_game method of the match.
+
+    Args:
+        match: A CheckersMatch object.
+
+    Returns:
+        The result of the game, as returned by CheckersMatch.game_loop.
+    """
+
+    gamestate = match.gamestate
+    while True:
+        full_moves = gamestate.get_full_moves()
+        if not full_moves:
+            return -1 * gamestate.turn
+        if gamestate.plys_since_capture >= 80:
+            return 0
+
+        if gamestate.turn == 1:
+            current_player = match.player_1
+        else:
+            current_player = match.player_2
+        move = await current_player.get_full_move(gamestate, full_moves)
+        for ind in range(0, len(move), 2):
+            gamestate.update(move[ind:ind + 2])
+        if match.recorder is not None:
+            match.game_moves.append(gamestate.prev_move)
+
+
+async def play_match(match, remote_players):
+    """Plays a whole match asynchronously.
+
+    Args:
+        match: A CheckersMatch object whose players are as described in
+            play_game.
+        remote_players: The remote players of the match, which are sent
+            the progress of the match.
+
+    Returns:
+        The results of the match, as returned by
+        CheckersMatch.match_loop.
+    """
+
+    while not match.is_match_over():
+        match.start_game()
+        for remote_player in remote_players:
+            await remote_player.send('game {}'.format(match.played_count))
+        game_result = await play_game(match)
+        match.end_game(game_result)
+        for remote_player in remote_players:
+            await remote_player.send('over {}'.format(game_result))
+    results = match.results()
+    for remote_player in remote_players:
+        await remote_player.send('result {} {} {} {} {}'.format(*results))
+    return results
+
+
+class GameServer():
+    """Accepts connections and hosts the matches they request.
+
+    Attributes:
+        executor: The concurrent.futures executor that engine moves are
+            computed in.
+        recorder: An optional GameWriter from the record module that
+            every finished game is written to.
+        matches_played: The number of matches finished so far.
+        games_played: The number of games finished so far.
+    """
+
+    def __init__(self, executor, recorder=None):
+        self.executor = executor
+        self.recorder = recorder
+        self.matches_played = 0
+        self.games_played = 0
+        self._waiting = None
+
+    async def handle_connection(self, reader, writer):
+        """Serves the commands of a single connection until it closes."""
+        remote_player = _RemotePlayer(reader, writer)
+        try:
+            while True:
+                line = await remote_player.receive()
+                if line is None or line == 'quit':
+                    break
+                args = line.split()
+                if not args or args[0] != 'play':
+                    await remote_player.send('error unknown command')
+                    continue
+                try:
+                    opponent = args[1]
+                    team = int(args[2])
+                    game_count = int(args[3]) if len(args) > 3 else 1
+                    if (opponent not in ENGINES and opponent != 'client'
+                            or team not in (1, 2) or game_count < 1):
+                        raise ValueError
+                except (IndexError, ValueError):
+                    await remote_player.send(
+                        'error usage: play <opponent> <team> [games]')
+                    continue
+                if opponent == 'client':
+                    await self._play_client(remote_player, team, game_count)
+                else:
+                    await self._play_engine(remote_player, opponent, team,
+                                            game_count)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def _new_match(self, player_1, player_2, game_count):
+        return game.CheckersMatch(player_1,
+                                  player_2,
+                                  game_count,
+                                  False,
+                                  recorder=self.recorder)
+
+    async def _run_match(self, match, remote_players):
+        await play_match(match, remote_players)
+        self.matches_played += 1
+        self.games_played += match.played_count
+
+    async def _play_engine(self, remote_player, engine, team, game_count):
+        engine_player = _EnginePlayer(engine, self.executor)
+        if team == 1:
+            match = self._new_match(remote_player, engine_player, game_count)
+        else:
+            match = self._new_match(engine_player, remote_player, game_count)
+        await self._run_match(match, (remote_player,))
+
+    async def _play_client(self, remote_player, team, game_count):
+        """Pairs the remote player with the next one asking for a client
+        opponent. The first of the pair runs the match while the second
+        waits; the first player's team and game count are used.
+
+        The first player's connection is read while it waits, so it is
+        no longer paired if it disconnects. If either player disconnects
+        during the match, the other is sent an error and may play again.
+
+        Raises:
+            ConnectionError: If the player disconnects while waiting.
+        """
+        if self._waiting is not None:
+            paired = self._waiting
+            self._waiting = None
+            finished = asyncio.get_running_loop().create_future()
+            paired.set_result((remote_player, finished))
+            await finished
+            return
+        paired = asyncio.get_running_loop().create_future()
+        self._waiting = paired
+        receiving = None
+        try:
+            while True:
+                receiving = asyncio.ensure_future(remote_player.receive())
+                await asyncio.wait((paired, receiving),
+                                   return_when=asyncio.FIRST_COMPLETED)
+                if paired.done():
+                    # Only the match may read the connection from now.
+                    receiving.cancel()
+                    await asyncio.wait((receiving,))
+                    break
+                line = receiving.result()
+                if line is None or line == 'quit':
+                    raise ConnectionError('Player disconnected.')
+                await remote_player.send('error waiting for an opponent')
+        finally:
+            if self._waiting is paired:
+                self._waiting = None
+            if receiving is not None:
+                receiving.cancel()
+        other_player, finished = paired.result()
+        try:
+            if team == 1:
+                match = self._new_match(remote_player, other_player,
+                                        game_count)
+            else:
+                match = self._new_match(other_player, remote_player,
+                                        game_count)
+            await self._run_match(match, (remote_player, other_player))
+        except ConnectionError:
+            for player in (remote_player, other_player):
+                if player.connected():
+                    try:
+                        await player.send('error opponent disconnected')
+                    except ConnectionError:
+                        pass
+        finally:
+            if not finished.done():
+                finished.set_result(None)
+
+    async def serve(self, host='127.0.0.1', port=8765, path=None):
+        """Runs the server until it is cancelled.
+
+        Args:
+            host, port: The address to listen on for TCP connections.
+            path: If given, listens on a Unix socket at this path
+                instead of TCP.
+        """
+        if path is None:
+            server = await asyncio.start_server(self.handle_connection,
+                                                host,
+                                                port,
+                                                backlog=4096)
+        else:
+            server = await asyncio.start_unix_server(self.handle_connection,
+                                                     path,
+                                                     backlog=4096)
+        async with server:
+            await server.serve_forever()
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    ind = min(int(fraction * len(sorted_values)), len(sorted_values) - 1)
+    return sorted_values[ind]
+
+
+async def _load_test_client(connect, opponent, team, game_count,
+                            latencies):
+    reader, writer = await connect()
+    sent = None
+    writer.write('play {} {} {}\n'.format(opponent, team,
+                                          game_count).encode())
+    await writer.drain()
+    while True:
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError('Server disconnected.')
+        args = line.decode().split()
+        if args[0] == 'turn':
+            if sent is not None:
+                latencies.append(time.perf_counter() - sent)
+            move = random.choice(args[2:])
+            sent = time.perf_counter()
+            writer.write('move {}\n'.format(move).encode())
+            await writer.drain()
+        elif args[0] == 'over':
+            sent = None
+        elif args[0] == 'result':
+            break
+        elif args[0] == 'error':
+            raise RuntimeError(line.decode().strip())
+    writer.write(b'quit\n')
+    await writer.drain()
+    writer.close()
+
+
+async def load_test(clients, game_count, opponent='random', host='127.0.0.1',
+                    port=8765, path=None):
+    """Plays many concurrent matches against a running server.
+
+    Every client chooses its moves uniformly randomly. The move latency
+    is the time from a client sending its move until the server sends
+    its next turn, which includes the opponent's move.
+
+    Args:
+        clients: The number of concurrent connections.
+        game_count: The number of games each client plays.
+        opponent: The opponent requested by each client; an engine key
+            or 'client'.
+        host, port, path: The address of the server, as in
+            GameServer.serve.
+
+    Returns:
+        A dictionary with the number of games played, the elapsed time
+        in seconds, games per second and the 50th, 90th and 99th
+        percentile move latencies in seconds.
+    """
+
+    if path is None:
+        def connect():
+            return asyncio.open_connection(host, port)
+    else:
+        def connect():
+            return asyncio.open_unix_connection(path)
+
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        _load_test_client(connect, opponent, 1 + ind % 2, game_count,
+                          latencies)
+        for ind in range(clients)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    games = clients * game_count
+    if opponent == 'client':
+        games //= 2
+    return {
+        'games': games,
+        'elapsed': elapsed,
+        'games_per_second': games / elapsed,
+        'latency_p50': _percentile(latencies, 0.5),
+        'latency_p90': _percentile(latencies, 0.9),
+        'latency_p99': _percentile(latencies, 0.99),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Hosts or load tests concurrent checkers matches.')
+    parser.add_argument('command', choices=('serve', 'load-test'))
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', metavar='PATH',
+                        help='use a Unix socket at PATH instead of TCP')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='engine worker processes (default: CPUs)')
+    parser.add_argument('--threads', action='store_true',
+                        help='compute engine moves in threads instead')
+    parser.add_argument('--record', metavar='PATH',
+                        help='record every finished game to PATH')
+    parser.add_argument('--clients', type=int, default=100,
+                        help='load test connections (default 100)')
+    parser.add_argument('--games', type=int, default=1,
+                        help='load test games per client (default 1)')
+    parser.add_argument('--opponent', default='random',
+                        choices=(*ENGINES, 'client'),
+                        help='load test opponent (default random)')
+    args = parser.parse_args(argv)
+
+    if args.command == 'load-test':
+        report = asyncio.run(load_test(args.clients, args.games,
+                                       args.opponent, args.host,
+                                       args.port, args.unix))
+        print('Games: {games}, elapsed: {elapsed:.2f}s, '
+              'games/s: {games_per_second:.2f}'.format(**report))
+        print('Move latency p50: {:.2f}ms, p90: {:.2f}ms, p99: {:.2f}ms'
+              .format(report['latency_p50'] * 1e3,
+                      report['latency_p90'] * 1e3,
+                      report['latency_p99'] * 1e3))
+        return
+
+    if args.threads:
+        executor = concurrent.futures.ThreadPoolExecutor(args.workers)
+    else:
+        executor = concurrent.futures.ProcessPoolExecutor(args.workers)
+    recorder = None
+    if args.record:
+        from . import record
+        recorder = record.GameWriter(args.record)
+    server = GameServer(executor, recorder)
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        executor.shutdown(cancel_futures=True)
+        if recorder is not None:
+            recorder.close()
+        print('Matches: {}, games: {}'.format(server.matches_played,
+                                              server.games_played))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+"""Compares two players with a sequential probability ratio test.
+
+Rather than playing a fixed number of games, games are played until the
+results are strong enough evidence for one of two hypotheses about the
+Elo difference between the players: H0, that the player under test is
+elo_0 stronger than its opponent, or H1, that it is elo_1 stronger. The
+test accepts a hypothesis with error rates of at most alpha (accepting
+H1 when H0 holds) and beta (accepting H0 when H1 holds). A clear
+difference in strength is usually settled within a few dozen games.
+
+The log-likelihood ratio uses the normal approximation of the
+generalized SPRT over win, draw and loss results, with the Elo
+difference converted to an expected score by the logistic model.
+
+Example Usage:
+    result = sprt_match(players.MediumPlayer,
+                        players.EasyPlayer,
+                        0,
+                        100)
+    print(result.decision, result.games, result.confidence)
+
+Classes:
+    SPRT: Accumulates game results and tests the hypotheses.
+    SPRTResult: A named tuple holding the outcome of sprt_match.
+
+Functions:
+    elo_to_score: Converts an Elo difference to an expected score.
+    score_to_elo: Converts an expected score to an Elo difference.
+    play_game: Plays a single game between the two players.
+    sprt_match: Plays games until the test reaches a decision.
+"""
+
+import collections
+import math
+
+from . import game
+
+
+# Pseudo count of each result added when estimating the variance of the
+# score, which is otherwise zero while every game has the same result.
+_PRIOR_COUNT = 0.5
+
+SPRTResult = collections.namedtuple(
+    'SPRTResult',
+    ('decision', 'games', 'wins', 'draws', 'losses', 'llr', 'lower_bound',
+     'upper_bound', 'confidence', 'elo', 'elo_margin'))
+SPRTResult.__doc__ = """The outcome of sprt_match.
+
+Attributes:
+    decision: 'H1' if the player under test is accepted as elo_1
+        stronger, 'H0' if it is accepted as only elo_0 stronger, or None
+        if max_games were played without a decision.
+    games: The number of games played.
+    wins, draws, losses: The results of the player under test.
+    llr: The final log-likelihood ratio.
+    lower_bound, upper_bound: The ratios at which H0 and H1 are
+        accepted.
+    confidence: The confidence reached in the hypothesis favoured by the
+        results; see SPRT.confidence.
+    elo: The estimated Elo difference in favour of the player under test.
+    elo_margin: The half width of the 95% confidence interval of elo.
+"""
+
+
+def elo_to_score(elo):
+    """Returns the expected score of a player elo points stronger."""
+    return 1 / (1 + 10 ** (-elo / 400))
+
+
+def score_to_elo(score):
+    """Returns the Elo difference giving the expected score."""
+    score = min(max(score, 1e-3), 1 - 1e-3)
+    return -400 * math.log10(1 / score - 1)
+
+
+class SPRT():
+    """Accumulates game results and tests the hypotheses.
+
+    Attributes:
+        elo_0, elo_1: The Elo differences of the hypotheses H0 and H1.
+        alpha, beta: The largest error rates of accepting H1 and H0.
+        wins, draws, losses: The results of the player under test so
+            far.
+        lower_bound, upper_bound: The log-likelihood ratios at which H0
+            and H1 are accepted.
+    """
+
+    def __init__(self, elo_0, elo_1, alpha=0.05, beta=0.05):
+        if elo_1 <= elo_0:
+            raise ValueError('elo_1 should be greater than elo_0.')
+        self.elo_0 = elo_0
+        self.elo_1 = elo_1
+        self.alpha = alpha
+        self.beta = beta
+        self.wins = 0
+        self.draws = 0
+        self.losses = 0
+        self.lower_bound = math.log(beta / (1 - alpha))
+        self.upper_bound = math.log((1 - beta) / alpha)
+
+    @property
+    def games(self):
+        return self.wins + self.draws + self.losses
+
+    def add(self, result):
+        """Records the result of a game.
+
+        Args:
+            result: 1 for a win of the player under test, -1 for a loss
+                and 0 for a draw.
+        """
+
+        if result == 1:
+            self.wins += 1
+        elif result == -1:
+            self.losses += 1
+        else:
+            self.draws += 1
+
+    def _score_stats(self):
+        mean = (self.wins + 0.5 * self.draws) / self.games
+        wins = self.wins + _PRIOR_COUNT
+        draws = self.draws + _PRIOR_COUNT
+        losses = self.losses + _PRIOR_COUNT
+        games = wins + draws + losses
+        prior_mean = (wins + 0.5 * draws) / games
+        variance = (wins * (1 - prior_mean) ** 2
+                    + draws * (0.5 - prior_mean) ** 2
+                    + losses * prior_mean ** 2) / games
+        return mean, variance
+
+    def llr(self):
+        """Returns the log-likelihood ratio of H1 against H0."""
+        if not self.games:
+            return 0.0
+        mean, variance = self._score_stats()
+        score_0 = elo_to_score(self.elo_0)
+        score_1 = elo_to_score(self.elo_1)
+        return (self.games * (score_1 - score_0)
+                * (2 * mean - score_0 - score_1) / (2 * variance))
+
+    def decision(self):
+        """Returns 'H1' or 'H0' once a hypothesis is accepted, or None."""
+        llr = self.llr()
+        if llr >= self.upper_bound:
+            return 'H1'
+        if llr <= self.lower_bound:
+            return 'H0'
+        return None
+
+    def confidence(self):
+        """Returns the confidence reached in the favoured hypothesis.
+
+        This is one minus the error rate at which the current ratio
+        would accept that hypothesis; it reaches 1 - alpha when H1 is
+        accepted and 1 - beta when H0 is accepted.
+        """
+
+        llr = self.llr()
+        if llr >= 0:
+            error = (1 - self.beta) * math.exp(-llr)
+        else:
+            error = (1 - self.alpha) * math.exp(llr)
+        return max(0.0, 1 - error)
+
+    def elo(self):
+        """Returns the estimated Elo difference and the half width of
+        its 95% confidence interval.
+        """
+        if not self.games:
+            return 0.0, float('inf')
+        mean, variance = self._score_stats()
+        margin = 1.96 * math.sqrt(variance / self.games)
+        return (score_to_elo(mean),
+                (score_to_elo(mean + margin)
+                 - score_to_elo(mean - margin)) / 2)
+
+    def result(self):
+        """Returns an SPRTResult of the results so far."""
+        elo, elo_margin = self.elo()
+        return SPRTResult(self.decision(),
+                          self.games,
+                          self.wins,
+                          self.draws,
+                          self.losses,
+                          self.llr(),
+                          self.lower_bound,
+                          self.upper_bound,
+                          self.confidence(),
+                          elo,
+                          elo_margin)
+
+
+def play_game(player_factory, opponent_factory, player_team, seed=None):
+    """Plays a single game between new instances of the two players.
+
+    Args:
+        player_factory: A callable taking no arguments and returning the
+            player under test, such as a Player subclass.
+        opponent_factory: A callable returning its opponent.
+        player_team: 1 or -1; the team of the player under test.
+        seed: An integer to seed the random module with, or None.
+
+    Returns:
+        1 if the player under test won, -1 if it lost and 0 for a draw.
+    """
+
+    player = player_factory()
+    opponent = opponent_factory()
+    if player_team == 1:
+        checkers_match = game.CheckersMatch(player, opponent, 1, False,
+                                            seed=seed)
+    else:
+        checkers_match = game.CheckersMatch(opponent, player, 1, False,
+                                            seed=seed)
+    result = checkers_match.match_loop()
+    return player_team * (result[2] - result[3])
+
+
+def sprt_match(player_factory, opponent_factory, elo_0, elo_1, alpha=0.05,
+               beta=0.05, max_games=1000, executor=None, parallel_games=4,
+               seed=None):
+    """Plays games until the test accepts a hypothesis.
+
+    The player under test alternates between the teams, starting as team
+    1. Given an executor, up to parallel_games games are played at once;
+    results are still counted in the order the games were started, so
+    that short games do not bias the test, and games still running once
+    a decision is reached are cancelled or discarded.
+
+    Args:
+        player_factory: A callable taking no arguments and returning the
+            player under test. With a process pool executor it must be
+            picklable, such as a Player subclass or a functools.partial
+            of a module level function.
+        opponent_factory: A callable returning its opponent.
+        elo_0, elo_1: The Elo differences of the hypotheses H0 and H1.
+        alpha, beta: The largest error rates of accepting H1 and H0.
+        max_games: The most games to play without a decision.
+        executor: A concurrent.futures executor to play games in, or
+            None to play them one at a time in this thread.
+        parallel_games: The most games submitted to the executor at once.
+        seed: An integer; if not None, game i is played with the random
+            module seeded with seed + i.
+
+    Returns:
+        An SPRTResult.
+    """
+
+    test = SPRT(elo_0, elo_1, alpha, beta)
+
+    def game_args(ind):
+        return (player_factory,
+                opponent_factory,
+                1 if ind % 2 == 0 else -1,
+                None if seed is None else seed + ind)
+
+    if executor is None:
+        for ind in range(max_games):
+            test.add(play_game(*game_args(ind)))
+            if test.decision() is not None:
+                break
+        return test.result()
+
+    pending = collections.deque()
+    started = 0
+    try:
+        while test.games < max_games:
+            while len(pending) < parallel_games and started < max_games:
+                pending.append(executor.submit(play_game, *game_args(started)))
+                started += 1
+            test.add(pending.popleft().result())
+            if test.decision() is not None:
+                break
+    finally:
+        for future in pending:
+            future.cancel()
+    return test.result()
@@ -0,0 +1,184 @@
+"""Collects statistics on the work done while playing checkers.
+
+Statistics are opt-in; a CheckersMatch created with collect_stats=True
+attaches a MatchStats object to each of its gamestates. Gamestate copies
+share the object of the gamestate they are copied from, so that the
+search trees built by players are counted as well. When statistics are
+not collected the stats attribute of the gamestates is None, and the
+only cost in the hot paths is checking for it.
+
+Classes:
+    MoveTimes: A histogram of the wall time taken to choose moves.
+    MatchStats: Counters of the work done over a match.
+"""
+
+
+class MoveTimes():
+    """A histogram of the wall time taken to choose moves.
+
+    Times are bucketed by powers of two microseconds; bucket i holds
+    the times of at least 2**(i-1) and less than 2**i microseconds, with
+    bucket 0 holding times under one microsecond and the last bucket
+    holding every time too large for the others.
+
+    Attributes:
+        buckets: A list of the number of moves in each bucket.
+        count: The number of moves recorded.
+        total: The total time of all recorded moves in seconds.
+        max: The longest time of any recorded move in seconds.
+    """
+
+    bucket_count = 32
+
+    def __init__(self):
+        self.buckets = [0] * self.bucket_count
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        """Records the time taken for a single move.
+
+        Args:
+            seconds: The wall time taken as a float.
+        """
+
+        bucket = int(seconds * 1e6).bit_length()
+        if bucket >= self.bucket_count:
+            bucket = self.bucket_count - 1
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    @property
+    def mean(self):
+        if not self.count:
+            return 0.0
+        return self.total / self.count
+
+    def percentile(self, fraction):
+        """Estimates a percentile of the recorded times.
+
+        Args:
+            fraction: A float in [0, 1], e.g. 0.99 for the 99th
+                percentile.
+
+        Returns:
+            The upper bound in seconds of the bucket containing the
+            requested percentile, or 0.0 if no times were recorded.
+        """
+
+        if not self.count:
+            return 0.0
+        target = fraction * self.count
+        seen = 0
+        for bucket, bucket_count in enumerate(self.buckets):
+            seen += bucket_count
+            if seen >= target and bucket_count:
+                return min(2 ** bucket / 1e6, self.max)
+        return self.max
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.mean,
+            'p50': self.percentile(0.5),
+            'p99': self.percentile(0.99),
+            'max': self.max,
+            'buckets': self.buckets[:],
+        }
+
+
+class MatchStats():
+    """Counters of the work done over a match of checkers.
+
+    Attributes:
+        games: The number of games played.
+        plys: The number of half-turns played.
+        valid_moves_calls: Calls of Gamestate.get_valid_moves, including
+            those made by get_full_moves and is_game_over.
+        full_moves_calls: Calls of Gamestate.get_full_moves, including
+            recursive calls for multiple jumps.
+        copies: Calls of Gamestate.copy.
+        nodes_expanded: Search tree nodes whose children were generated.
+        nodes_scored: Search tree nodes scored as a leaf or a branch.
+        search_depths: A dictionary from search depths in plys to the
+            number of searches made to that depth.
+        model_evals: Forward passes of a neural network player.
+        model_time: Total wall time of those forward passes in seconds.
+        move_times: A dictionary from turn (1 for team 1, -1 for team 2)
+            to a MoveTimes histogram of that team's player.
+    """
+
+    __slots__ = ('games', 'plys', 'valid_moves_calls', 'full_moves_calls',
+                 'copies', 'nodes_expanded', 'nodes_scored',
+                 'search_depths', 'model_evals', 'model_time',
+                 'move_times')
+
+    def __init__(self):
+        self.games = 0
+        self.plys = 0
+        self.valid_moves_calls = 0
+        self.full_moves_calls = 0
+        self.copies = 0
+        self.nodes_expanded = 0
+        self.nodes_scored = 0
+        self.search_depths = {}
+        self.model_evals = 0
+        self.model_time = 0.0
+        self.move_times = {1: MoveTimes(), -1: MoveTimes()}
+
+    def add_search(self, depth):
+        """Records a search made to the given depth in plys."""
+        self.search_depths[depth] = self.search_depths.get(depth, 0) + 1
+
+    @property
+    def max_search_depth(self):
+        return max(self.search_depths, default=0)
+
+    def as_dict(self):
+        """Returns the statistics as a dictionary that can be saved as
+        JSON.
+        """
+
+        return {
+            'games': self.games,
+            'plys': self.plys,
+            'valid_moves_calls': self.valid_moves_calls,
+            'full_moves_calls': self.full_moves_calls,
+            'copies': self.copies,
+            'nodes_expanded': self.nodes_expanded,
+            'nodes_scored': self.nodes_scored,
+            'search_depths': dict(sorted(self.search_depths.items())),
+            'max_search_depth': self.max_search_depth,
+            'model_evals': self.model_evals,
+            'model_time': self.model_time,
+            'move_times': {
+                'team_1': self.move_times[1].as_dict(),
+                'team_2': self.move_times[-1].as_dict(),
+            },
+        }
+
+    def summary(self):
+        """Returns a multiline string summarizing the statistics."""
+        lines = [
+            'Games: {}, plys: {}'.format(self.games, self.plys),
+            'get_valid_moves calls: {}, get_full_moves calls: {}'.format(
+                self.valid_moves_calls, self.full_moves_calls),
+            'Gamestate copies: {}'.format(self.copies),
+            'Nodes expanded: {}, scored: {}, max depth: {}'.format(
+                self.nodes_expanded, self.nodes_scored,
+                self.max_search_depth),
+            'Model evaluations: {} ({:.3f}s)'.format(self.model_evals,
+                                                     self.model_time),
+        ]
+        for team, turn in ((1, 1), (2, -1)):
+            times = self.move_times[turn]
+            lines.append(
+                'Team {} moves: {}, mean {:.6f}s, p99 {:.6f}s, max {:.6f}s'
+                .format(team, times.count, times.mean,
+                        times.percentile(0.99), times.max))
+        return '\n'.join(lines)
@@ -0,0 +1,417 @@
+"""Labels positions with a tree search teacher for supervised training.
+
+Positions are sampled from recorded games or from games of random moves
+and searched by a TreePlayer, whose scores of every move and best move
+become the labels. The search is far slower than sampling, so positions
+are labeled in shards by a pool of worker processes, one shard per task,
+and the time taken scales down with the number of workers.
+
+Each shard is a compressed NumPy file holding a fixed number of labeled
+positions, encoded as the model sees them: boards from the perspective
+of the team to move and moves by the index 4*pos + dir of their first
+step in that orientation, as in model.ModelPlayer. A shard holds the
+arrays:
+
+    boards: int8 (n, 32); the oriented boards.
+    masks: uint8 (n, 16); bitsets of the valid moves, as from
+        model.pack_mask.
+    scores: float32 (n, 128); the teacher's score of each valid move
+        for the team to move, the best full move starting with that
+        step, and 0 for invalid moves.
+    actions: uint8 (n,); the index of the best move.
+    values: float32 (n,); the score of the best move.
+    depths: uint8 (n,); the plys searched.
+
+Generation is resumable. The positions are sampled deterministically
+from the seed, and shards already in the output directory are skipped,
+so an interrupted run continues where it stopped when run again with
+the same arguments, which are checked against the manifest saved in
+the directory. Shards are written to a temporary file first, so a shard
+is either complete or missing.
+
+Example Usage:
+    python distill.py dataset --positions 1000000 --teacher medium
+    python distill.py dataset --source games.ckr --positions 200000
+
+    for batch in iter_batches('dataset', 128):
+        boards = torch.from_numpy(batch['boards'])
+
+Functions:
+    sample_positions: Yields positions sampled from games.
+    encode_position: Encodes a position as the model sees it.
+    label_positions: Searches positions with a teacher and encodes them.
+    generate: Labels positions into a sharded dataset directory.
+    shard_names: Returns the names of the shards of a dataset directory.
+    read_shards: Yields the shards of a dataset directory.
+    iter_batches: Yields shuffled batches from a dataset directory.
+    main: Command line entry point.
+"""
+
+import argparse
+import concurrent.futures
+import itertools
+import json
+import os
+import random
+
+import numpy as np
+
+import checkers
+
+
+TEACHERS = {
+    'tree': checkers.players.TreePlayer,
+    'easy': checkers.players.EasyPlayer,
+    'medium': checkers.players.MediumPlayer,
+    'hard': checkers.players.HardPlayer,
+}
+
+MANIFEST = 'manifest.json'
+SHARD_FORMAT = 'shard-{:05d}.npz'
+ARRAYS = ('boards', 'masks', 'scores', 'actions', 'values', 'depths')
+
+
+def _random_games(rng):
+    while True:
+        gamestate = checkers.game.Gamestate()
+        moves = []
+        while gamestate.is_game_over() == 2:
+            move_list = gamestate.get_full_moves()
+            move = move_list[rng.randrange(len(move_list))]
+            for ind in range(0, len(move), 2):
+                gamestate.update(move[ind:ind + 2])
+            moves.append(move)
+        yield moves
+
+
+def _recorded_games(paths):
+    for path in paths:
+        for game_record in checkers.record.read_games(path):
+            yield game_record.moves
+
+
+def sample_positions(sources, sample_rate, seed=0):
+    """Yields positions sampled from games.
+
+    Args:
+        sources: A list of paths of record files to take games from in
+            order, or an empty list for an endless supply of games of
+            random full moves.
+        sample_rate: The probability that each unfinished position of a
+            game is sampled.
+        seed: Seed for the sampling and the random games.
+
+    Yields:
+        Tuples (board, turn, ply_count, plys_since_capture) describing
+        positions at the start of a full move.
+    """
+
+    rng = random.Random(seed)
+    games = _recorded_games(sources) if sources else _random_games(rng)
+    for moves in games:
+        for gamestate, move in checkers.record.replay(moves):
+            if move is None or rng.random() >= sample_rate:
+                continue
+            yield (tuple(gamestate.board),
+                   gamestate.turn,
+                   gamestate.ply_count,
+                   gamestate.plys_since_capture)
+
+
+def _move_index(move, turn):
+    return checkers.game.MOVE_INDEX[turn][4*move[0] + move[1]]
+
+
+def encode_position(gamestate):
+    """Encodes a position as the model sees it.
+
+    Args:
+        gamestate: A Gamestate object.
+
+    Returns:
+        A pair of the oriented board as an int8 array of shape (32,) and
+        the bitset of valid moves as a uint8 array of shape (16,).
+    """
+
+    board = np.array(gamestate.board, dtype=np.int8)
+    if gamestate.turn == -1:
+        board = -board[::-1]
+    valid = np.zeros(128, dtype=bool)
+    for move in gamestate.get_valid_moves():
+        valid[_move_index(move, gamestate.turn)] = True
+    return board, np.packbits(valid, bitorder='little')
+
+
+def label_positions(positions, teacher, depth=None):
+    """Searches positions with a teacher and encodes them.
+
+    Args:
+        positions: A list of positions as yielded by sample_positions.
+        teacher: A key of TEACHERS.
+        depth: The plys to search, or None for the teacher's depth at
+            the ply count of each position.
+
+    Returns:
+        A dictionary of the arrays named in ARRAYS, with a row for each
+        position.
+    """
+
+    player = TEACHERS[teacher](False)
+    count = len(positions)
+    labels = {'boards': np.zeros((count, 32), dtype=np.int8),
+              'masks': np.zeros((count, 16), dtype=np.uint8),
+              'scores': np.zeros((count, 128), dtype=np.float32),
+              'actions': np.zeros(count, dtype=np.uint8),
+              'values': np.zeros(count, dtype=np.float32),
+              'depths': np.zeros(count, dtype=np.uint8)}
+    for row, (board, turn, ply_count, plys_since_capture) in enumerate(
+            positions):
+        gamestate = checkers.game.Gamestate()
+        gamestate.board = list(board)
+        gamestate.turn = turn
+        gamestate.ply_count = ply_count
+        gamestate.plys_since_capture = plys_since_capture
+        plys = depth
+        if plys is None:
+            if ply_count > player.late_cutoff:
+                plys = player.plys_late
+            elif ply_count > player.mid_cutoff:
+                plys = player.plys_mid
+            else:
+                plys = player.plys_ini
+        root = checkers.players.Node(gamestate)
+        player.gen_child_ply(root, plys)
+
+        scores = {}
+        for move, child in root.child_ply.items():
+            ind = _move_index(move[:2], turn)
+            scores[ind] = max(scores.get(ind, -np.inf), turn * child.score)
+        action = max(scores, key=scores.get)
+        labels['boards'][row], labels['masks'][row] = \
+            encode_position(gamestate)
+        labels['scores'][row, list(scores)] = list(scores.values())
+        labels['actions'][row] = action
+        labels['values'][row] = scores[action]
+        labels['depths'][row] = plys
+    return labels
+
+
+def _write_shard(path, positions, teacher, depth):
+    labels = label_positions(positions, teacher, depth)
+    # The temporary name keeps the .npz suffix, which np.savez_compressed
+    # would otherwise add.
+    temp_path = path + '.tmp.npz'
+    np.savez_compressed(temp_path, **labels)
+    os.replace(temp_path, path)
+    return path
+
+
+def _shards(positions, shard_size):
+    while True:
+        shard = list(itertools.islice(positions, shard_size))
+        if not shard:
+            return
+        yield shard
+
+
+def generate(directory, positions, shard_size=4096, sources=(),
+             sample_rate=0.1, teacher='medium', depth=None, seed=0,
+             workers=None):
+    """Labels positions into a sharded dataset directory.
+
+    Shards already in the directory are kept, so generation resumes
+    where an earlier run with the same arguments stopped.
+
+    Args:
+        directory: The directory to write the shards to; it is created
+            if needed.
+        positions: The number of positions to label. Fewer are labeled
+            if the recorded games run out first.
+        shard_size: The number of positions in each shard.
+        sources: Paths of record files to sample positions from, or an
+            empty sequence to sample from games of random moves.
+        sample_rate: The probability of sampling each position.
+        teacher: A key of TEACHERS.
+        depth: The plys to search, or None for the teacher's own depths.
+        seed: Seed for sampling the positions.
+        workers: The number of worker processes, or None for one per
+            CPU. With one worker, positions are labeled in this process.
+
+    Returns:
+        The number of shards in the dataset.
+
+    Raises:
+        ValueError: The directory holds a dataset generated with other
+            arguments.
+    """
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    manifest = {'positions': positions,
+                'shard_size': shard_size,
+                'sources': [os.path.abspath(path) for path in sources],
+                'sample_rate': sample_rate,
+                'teacher': teacher,
+                'depth': depth,
+                'seed': seed}
+    os.makedirs(directory, exist_ok=True)
+    manifest_path = os.path.join(directory, MANIFEST)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as manifest_file:
+            if json.load(manifest_file) != manifest:
+                raise ValueError('{} holds a dataset generated with other '
+                                 'arguments.'.format(directory))
+    else:
+        with open(manifest_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=4)
+
+    shards = _shards(itertools.islice(
+        sample_positions(list(sources), sample_rate, seed), positions),
+        shard_size)
+    written = 0
+    executor = None
+    if workers > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(workers)
+    pending = set()
+    try:
+        for ind, shard in enumerate(shards):
+            written += 1
+            path = os.path.join(directory, SHARD_FORMAT.format(ind))
+            if os.path.exists(path):
+                continue
+            if executor is None:
+                _write_shard(path, shard, teacher, depth)
+                print('Wrote {}.'.format(path))
+                continue
+            # Bound the shards waiting in memory for a worker.
+            while len(pending) >= 2 * workers:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    print('Wrote {}.'.format(future.result()))
+            pending.add(executor.submit(_write_shard, path, shard, teacher,
+                                        depth))
+        for future in concurrent.futures.as_completed(pending):
+            print('Wrote {}.'.format(future.result()))
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    return written
+
+
+def shard_names(directory):
+    """Returns the names of the shards of a dataset directory in order."""
+    return sorted(name for name in os.listdir(directory)
+                  if name.startswith('shard-') and name.endswith('.npz')
+                  and not name.endswith('.tmp.npz'))
+
+
+def read_shards(directory):
+    """Yields the shards of a dataset directory in order.
+
+    Args:
+        directory: A directory written by generate.
+
+    Yields:
+        Dictionaries of the arrays of each shard by name; those named in
+        ARRAYS for shards written by generate.
+    """
+
+    for name in shard_names(directory):
+        with np.load(os.path.join(directory, name)) as shard:
+            yield {key: shard[key] for key in shard.files}
+
+
+def iter_batches(directory, batch_size, shuffle=True, seed=None,
+                 window=None):
+    """Yields batches from a dataset directory, one shard in memory at a
+    time.
+
+    Any directory of .npz shards named like those of generate can be
+    read, as long as every array of a shard has a row per position.
+
+    Args:
+        directory: A directory written by generate.
+        batch_size: The number of positions per batch. The last batch
+            may be smaller.
+        shuffle: Whether to visit the shards in a random order and
+            shuffle the positions within each shard.
+        seed: Seed for the shuffling.
+        window: The number of shards to read, counted back from the
+            last in name order, or None to read them all.
+
+    Yields:
+        Dictionaries of the arrays of the shards by name with batch_size
+        rows, which torch.from_numpy turns into tensors without copying.
+    """
+
+    rng = np.random.default_rng(seed)
+    names = shard_names(directory)
+    if window is not None:
+        names = names[-window:]
+    if shuffle:
+        rng.shuffle(names)
+    leftover = None
+    for name in names:
+        with np.load(os.path.join(directory, name)) as shard:
+            arrays = {key: shard[key] for key in shard.files}
+        count = len(next(iter(arrays.values())))
+        if shuffle:
+            order = rng.permutation(count)
+            arrays = {key: value[order] for key, value in arrays.items()}
+        if leftover is not None:
+            arrays = {key: np.concatenate((leftover[key], value))
+                      for key, value in arrays.items()}
+        count = len(next(iter(arrays.values())))
+        full = count - count % batch_size
+        for start in range(0, full, batch_size):
+            yield {key: value[start:start + batch_size]
+                   for key, value in arrays.items()}
+        leftover = {key: value[full:] for key, value in arrays.items()}
+    if leftover is not None and len(next(iter(leftover.values()))):
+        yield leftover
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Labels positions with a tree search teacher.')
+    parser.add_argument('directory', help='dataset directory to write to')
+    parser.add_argument('--positions', type=int, default=100000,
+                        help='positions to label (default 100000)')
+    parser.add_argument('--shard-size', type=int, default=4096,
+                        help='positions per shard (default 4096)')
+    parser.add_argument('--source', action='append', default=[],
+                        help='record file to sample positions from; may '
+                             'be repeated. Games of random moves are '
+                             'used if none is given')
+    parser.add_argument('--sample-rate', type=float, default=0.1,
+                        help='probability of sampling each position '
+                             '(default 0.1)')
+    parser.add_argument('--teacher', choices=TEACHERS, default='medium',
+                        help='player searching the positions '
+                             '(default medium)')
+    parser.add_argument('--depth', type=int,
+                        help='plys to search instead of the depths of '
+                             'the teacher')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed for sampling positions (default 0)')
+    parser.add_argument('--workers', type=int,
+                        help='worker processes (default one per CPU)')
+    args = parser.parse_args(argv)
+    try:
+        shard_count = generate(args.directory,
+                               args.positions,
+                               args.shard_size,
+                               args.source,
+                               args.sample_rate,
+                               args.teacher,
+                               args.depth,
+                               args.seed,
+                               args.workers)
+    except ValueError as error:
+        parser.error(str(error))
+    print('{} holds {} shards.'.format(args.directory, shard_count))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+"""Trains the model data-parallel across processes and machines.
+
+Each rank is a process running its own Trainer. It plays its own
+self-play games into its own replay memory, a shard of the transitions
+of the whole run, and samples its batches from that shard alone. After
+the backward pass, the gradients of every rank are averaged with an
+all-reduce over torch.distributed with the gloo backend, which runs on
+CPUs. Every rank then applies the same update, so the weights stay
+identical without being sent. The effective batch is the world size
+times BATCH_SIZE * ACCUMULATION_STEPS, and GAMES_PER_GENERATION games
+are played per rank.
+
+Rank 0 trains as train.py does. The other ranks suffix the paths of
+their game records, checkpoints, metrics and disk replay memory with
+their rank, and neither validate nor save the final weights. Each rank
+plays in a single process, so ACTORS is ignored. Before every game's
+gradient steps, the ranks agree to take the fewest steps any of them
+scheduled, and none until every shard can fill a batch. The collectives
+therefore always match even though games differ in length.
+
+Ranks are started on one machine by this script, or on several by
+torchrun, which sets the environment variables read here. With
+--scaling, the script instead reports how the learner's throughput
+scales with the number of ranks: the samples trained on per second by
+all ranks, and the efficiency against that many single ranks.
+
+Example Usage:
+    python distributed.py --ranks 4 --config config.json
+    torchrun --nnodes 2 --nproc-per-node 4 --rdzv-backend c10d \
+--rdzv-endpoint HOST:29500 distributed.py --config config.json
+    python distributed.py --scaling 1 2 4
+
+Classes:
+    DistributedTrainer: A Trainer averaging its gradients across ranks.
+
+Functions:
+    rank_config: Returns the config of a rank.
+    measure_scaling: Measures the learner's throughput by rank count.
+    main: Command line entry point.
+"""
+
+import argparse
+import os
+import socket
+import time
+
+import torch
+import torch.distributed as dist
+
+import model
+import train
+
+
+# The paths of the files each rank writes for itself.
+RANK_PATHS = ('GAME_RECORD_PATH', 'CHECKPOINT_PATH', 'METRICS_PATH',
+              'REPLAY_PATH')
+
+
+def rank_config(config, rank):
+    """Returns the config of a rank.
+
+    Args:
+        config: A dictionary of constants of the model module, as from
+            train.load_config.
+        rank: The rank of the process.
+
+    Returns:
+        A copy of config in which, for ranks other than 0, the paths in
+        RANK_PATHS are suffixed with the rank.
+    """
+
+    config = dict(config)
+    if rank != 0:
+        for name in RANK_PATHS:
+            path = config.get(name, getattr(model, name))
+            if path is not None:
+                config[name] = '{}.{}'.format(path, rank)
+    return config
+
+
+class _SkippedValidation():
+    def submit(self, generation, state_dict):
+        pass
+
+    def close(self):
+        pass
+
+
+class DistributedTrainer(model.Trainer):
+    """A Trainer averaging its gradients across ranks.
+
+    The process group must be initialized before the trainer is created.
+    Rank 0's weights are broadcast to the other ranks then, so all ranks
+    start from the same model.
+
+    Attributes:
+        rank: The rank of this process.
+        world_size: The number of ranks.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.rank = dist.get_rank()
+        self.world_size = dist.get_world_size()
+        # Every process starts with the same seed, so ranks would play
+        # the same games.
+        torch.manual_seed(torch.initial_seed() + self.rank)
+        for tensor in self.model_player.model.state_dict().values():
+            dist.broadcast(tensor, 0)
+        self.target_model.load_state_dict(self.state_dict())
+
+    def reduce_gradients(self):
+        """Averages the gradients of all ranks with one all-reduce."""
+        gradients = [parameter.grad
+                     for parameter in self.model_player.model.parameters()]
+        flat = torch.cat([gradient.view(-1) for gradient in gradients])
+        dist.all_reduce(flat)
+        flat /= self.world_size
+        start = 0
+        for gradient in gradients:
+            gradient.copy_(flat[start:start + gradient.numel()]
+                           .view_as(gradient))
+            start += gradient.numel()
+
+    def optimize_steps(self, steps, losses):
+        """Takes the fewest steps scheduled by any rank, or none until the
+        memory of every rank holds a batch.
+        """
+        agreed = torch.tensor([steps, len(self.memory) >= model.BATCH_SIZE])
+        dist.all_reduce(agreed, dist.ReduceOp.MIN)
+        super().optimize_steps(int(agreed[0]) if agreed[1] else 0, losses)
+
+    def make_validator(self, metrics_writer):
+        """ Returns the validator of rank 0, or one that skips validation
+        on the other ranks, as the weights of every rank are the same.
+        """
+        if self.rank != 0:
+            return _SkippedValidation()
+        return super().make_validator(metrics_writer)
+
+    def _finish(self, metrics_writer):
+        if self.rank == 0:
+            super()._finish(metrics_writer)
+            return
+        self.stop_prefetching()
+        if isinstance(self.memory, model.DiskReplayMemory):
+            self.memory.flush()
+        metrics_writer.close()
+
+
+def _free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def _init_rank(rank, world_size, init_method, threads):
+    torch.set_num_threads(threads)
+    dist.init_process_group('gloo',
+                            init_method=init_method,
+                            rank=rank,
+                            world_size=world_size)
+
+
+def _train_rank(rank, world_size, init_method, threads, config, resume):
+    _init_rank(rank, world_size, init_method, threads)
+    try:
+        model.configure(rank_config(config, rank))
+        DistributedTrainer().train(resume=resume)
+    finally:
+        dist.destroy_process_group()
+
+
+def _scaling_rank(rank, world_size, init_method, threads, steps, results):
+    _init_rank(rank, world_size, init_method, threads)
+    try:
+        trainer = DistributedTrainer()
+        trainer.memory = model.ReplayMemory(25000)
+        size = trainer.memory.capacity
+        trainer.memory.push_batch(
+            torch.randint(-2, 3, (size, 32), dtype=torch.int8),
+            torch.randint(128, (size,), dtype=torch.uint8),
+            torch.full((size,), model.WIN_STEP),
+            torch.randint(-2, 3, (size, 32), dtype=torch.int8),
+            torch.randint(256, (size, 16), dtype=torch.uint8),
+            torch.ones(size, dtype=torch.bool))
+        losses = []
+        trainer.optimize_steps(5, losses)
+        dist.barrier()
+        start = time.perf_counter()
+        trainer.optimize_steps(steps, losses)
+        dist.barrier()
+        elapsed = time.perf_counter() - start
+        if rank == 0:
+            results.put(world_size * steps * model.BATCH_SIZE
+                        * model.ACCUMULATION_STEPS / elapsed)
+    finally:
+        dist.destroy_process_group()
+
+
+def _spawn(function, ranks, threads, *args):
+    torch.multiprocessing.spawn(
+        function,
+        args=(ranks,
+              'tcp://127.0.0.1:{}'.format(_free_port()),
+              threads) + args,
+        nprocs=ranks)
+
+
+def measure_scaling(rank_counts, steps, threads=1):
+    """Measures the learner's throughput by rank count.
+
+    Each count of ranks is started on this machine and takes steps
+    gradient steps on replay shards of random transitions.
+
+    Args:
+        rank_counts: The numbers of ranks to measure, such as (1, 2, 4).
+        steps: The gradient steps timed for each rank count.
+        threads: The threads of each rank.
+
+    Returns:
+        A dictionary mapping each rank count to a pair of the transitions
+        trained on per second by all ranks together, and the scaling
+        efficiency, that rate over the rate of one rank times the rank
+        count. The efficiency is None if one rank was not measured.
+    """
+
+    results = torch.multiprocessing.get_context('spawn').SimpleQueue()
+    rates = {}
+    for ranks in rank_counts:
+        _spawn(_scaling_rank, ranks, threads, steps, results)
+        rates[ranks] = results.get()
+    return {ranks: (rate,
+                    rate / (ranks * rates[1]) if 1 in rates else None)
+            for ranks, rate in rates.items()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Trains the model data-parallel across processes.')
+    parser.add_argument('--config',
+                        help='JSON file of hyperparameters overriding the '
+                             'constants of model.py')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue every rank from its checkpoint')
+    parser.add_argument('--ranks', type=int, default=2,
+                        help='ranks to start on this machine when not run '
+                             'by torchrun')
+    parser.add_argument('--threads', type=int,
+                        help='threads of each rank (default the CPUs of '
+                             'the machine shared among its ranks)')
+    parser.add_argument('--scaling', type=int, nargs='+', metavar='RANKS',
+                        help='measure the learner throughput with these '
+                             'rank counts instead of training')
+    parser.add_argument('--steps', type=int, default=50,
+                        help='gradient steps timed by --scaling')
+    args = parser.parse_args(argv)
+
+    config = {}
+    if args.config is not None:
+        try:
+            config = train.load_config(args.config)
+            model.configure(config)
+        except (OSError, ValueError) as error:
+            parser.error(str(error))
+
+    # torchrun sets these for each rank it starts.
+    local_ranks = int(os.environ.get('LOCAL_WORLD_SIZE', args.ranks))
+    threads = args.threads or max((os.cpu_count() or 1) // local_ranks, 1)
+    if args.scaling:
+        for ranks, (rate, efficiency) in measure_scaling(
+                args.scaling, args.steps, threads).items():
+            print('{} ranks: {:.0f} samples/s{}'.format(
+                ranks, rate, '' if efficiency is None
+                else ', efficiency {:.0%}'.format(efficiency)))
+    elif 'RANK' in os.environ:
+        _train_rank(int(os.environ['RANK']),
+                    int(os.environ['WORLD_SIZE']),
+                    'env://',
+                    threads,
+                    config,
+                    args.resume)
+    else:
+        _spawn(_train_rank, args.ranks, threads, config, args.resume)
+
+
+if __name__ == '__main__':
+    main()
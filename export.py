@@ -0,0 +1,232 @@
+"""Exports trained weights for playing and checks them against the original.
+
+Training saves the weights of the DQN for the eager module, which needs
+the model module to rebuild it. Exporting compiles them for one of the
+inference backends of the model module and saves the result as a
+TorchScript archive, which model.load_inference_player loads with the
+backend 'exported'. The quantized backend stores the weights of the Linear
+layers in int8, shrinking the file and the memory of every process
+playing with it about fourfold. The numpy backend instead saves the
+weights as a NumPy .npz file for the players of numpy_model, which play
+without importing torch.
+
+A compiled model may choose different moves from the weights it came
+from, most of all when quantized, so the export reports the fraction of
+positions on which both choose the same move. The positions are taken
+from a dataset written by distill.py, or sampled from games of random
+moves.
+
+Example Usage:
+    python export.py model_params.pt model_quantized.pt
+    python export.py model_params.pt model_frozen.pt --backend frozen
+    python export.py model_params.pt model_params.npz --backend numpy
+    python export.py model_params.pt model_quantized.pt --dataset dataset
+
+Functions:
+    sample_boards: Returns encoded positions sampled from random games.
+    dataset_boards: Returns encoded positions from a distill dataset.
+    move_agreement: Returns how often two models choose the same move.
+    archive_size: Returns the bytes taken by saving a model.
+    export_numpy: Saves weights as a NumPy .npz file.
+    export_model: Compiles saved weights and saves them for playing.
+    main: Command line entry point.
+"""
+
+import argparse
+import io
+import itertools
+import os
+
+import numpy as np
+
+import checkers
+import distill
+import numpy_model
+
+
+def sample_boards(count, seed=0):
+    """Returns encoded positions sampled from random games.
+
+    Args:
+        count: The number of positions.
+        seed: Seed for the games and the sampling.
+
+    Returns:
+        A pair of the oriented boards, an int8 array of shape (count,
+        32), and the bitsets of valid moves, a uint8 array of shape
+        (count, 16), as from distill.encode_position.
+    """
+
+    boards, masks = [], []
+    for board, turn, ply_count, plys_since_capture in itertools.islice(
+            distill.sample_positions([], 0.1, seed), count):
+        gamestate = checkers.game.Gamestate()
+        gamestate.board = list(board)
+        gamestate.turn = turn
+        board, mask = distill.encode_position(gamestate)
+        boards.append(board)
+        masks.append(mask)
+    return np.stack(boards), np.stack(masks)
+
+
+def dataset_boards(directory, count):
+    """Returns encoded positions from a distill dataset.
+
+    Args:
+        directory: A dataset directory written by distill.generate.
+        count: The most positions to return, taken from the first shards.
+
+    Returns:
+        A pair of boards and bitsets of valid moves as from
+        sample_boards.
+    """
+
+    boards, masks = [], []
+    for shard in distill.read_shards(directory):
+        boards.append(shard['boards'])
+        masks.append(shard['masks'])
+        if sum(map(len, boards)) >= count:
+            break
+    return np.concatenate(boards)[:count], np.concatenate(masks)[:count]
+
+
+def move_agreement(reference, compiled, boards, masks, batch_size=1024):
+    """Returns how often two models choose the same move.
+
+    Args:
+        reference: The model to compare against, such as the eager DQN.
+        compiled: The model to check, such as one from
+            model.compile_model or a numpy_model.NumpyDQN. Both models
+            are given a float32 CPU tensor of boards and may return a
+            tensor or an array.
+        boards: An int8 array of oriented boards of shape (n, 32).
+        masks: A uint8 array of bitsets of valid moves of shape (n, 16).
+        batch_size: The positions evaluated together.
+
+    Returns:
+        The fraction of the positions on which the best valid move of
+        both models is the same.
+    """
+
+    import torch
+
+    agreed = 0
+    with torch.inference_mode():
+        for start in range(0, len(boards), batch_size):
+            board_batch = torch.from_numpy(
+                boards[start:start + batch_size]).float()
+            valid = np.unpackbits(masks[start:start + batch_size],
+                                  axis=1,
+                                  bitorder='little').astype(bool)
+            choices = [np.where(valid, np.asarray(net(board_batch)), -2)
+                       .argmax(1) for net in (reference, compiled)]
+            agreed += np.count_nonzero(choices[0] == choices[1])
+    return agreed / len(boards)
+
+
+def archive_size(module):
+    """Returns the bytes taken by saving module, a TorchScript model or
+    the weights of an eager one.
+    """
+    import torch
+    import model
+
+    archive = io.BytesIO()
+    if isinstance(module, torch.jit.ScriptModule):
+        with model.torchscript_warnings_ignored():
+            torch.jit.save(module, archive)
+    else:
+        torch.save(module.state_dict(), archive)
+    return len(archive.getvalue())
+
+
+def export_numpy(state_dict, output):
+    """Saves weights as a NumPy .npz file.
+
+    Args:
+        state_dict: The state dict of a DQN.
+        output: The path to save the file to, kept as given even without
+            a .npz suffix.
+
+    Returns:
+        A numpy_model.NumpyDQN with the weights.
+    """
+
+    arrays = {name: tensor.cpu().numpy()
+              for name, tensor in state_dict.items()}
+    with open(output, 'wb') as output_file:
+        np.savez(output_file, **arrays)
+    return numpy_model.NumpyDQN(arrays)
+
+
+def export_model(path, output, backend, boards=None, masks=None):
+    """Compiles saved weights and saves them for playing.
+
+    Args:
+        path: The path of weights of the DQN saved by training.
+        output: The path to save the TorchScript archive to, or the .npz
+            file for the numpy backend.
+        backend: A key of model.INFERENCE_BACKENDS other than 'eager', or
+            'numpy'.
+        boards, masks: Encoded positions to measure the move agreement
+            of the exported model with the weights on, as from
+            sample_boards, or None.
+
+    Returns:
+        A dictionary with the sizes in bytes of the weights and of the
+        archive, and the move agreement if positions were given.
+
+    Raises:
+        ValueError: The backend is unknown or is 'eager', which cannot be
+            saved as TorchScript.
+    """
+
+    import torch
+    import model
+
+    if backend == 'eager':
+        raise ValueError('The eager backend cannot be exported.')
+    net = model.DQN()
+    net.load_state_dict(torch.load(path, map_location='cpu'))
+    if backend == 'numpy':
+        compiled = export_numpy(net.state_dict(), output)
+    else:
+        compiled = model.compile_model(net, backend)
+        with model.torchscript_warnings_ignored():
+            torch.jit.save(compiled, output)
+    report = {'weights_bytes': archive_size(net),
+              'exported_bytes': os.path.getsize(output)}
+    if boards is not None:
+        report['agreement'] = move_agreement(net, compiled, boards, masks)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Exports trained weights for playing.')
+    parser.add_argument('path', help='weights saved by training')
+    parser.add_argument('output', help='file to save the exported model to')
+    parser.add_argument('--backend', default='quantized',
+                        choices=('script', 'frozen', 'quantized', 'numpy'))
+    parser.add_argument('--dataset',
+                        help='distill dataset directory to check the move '
+                             'agreement on (default random positions)')
+    parser.add_argument('--positions', type=int, default=5000,
+                        help='positions to check the move agreement on')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    if args.dataset is not None:
+        boards, masks = dataset_boards(args.dataset, args.positions)
+    else:
+        boards, masks = sample_boards(args.positions, args.seed)
+    report = export_model(args.path, args.output, args.backend, boards,
+                          masks)
+    print('Exported {} bytes of weights as {} bytes to {}.'.format(
+        report['weights_bytes'], report['exported_bytes'], args.output))
+    print('Same move as the weights on {:.2%} of {} positions.'.format(
+        report['agreement'], len(boards)))
+
+
+if __name__ == '__main__':
+    main()
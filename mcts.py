@@ -0,0 +1,653 @@
+"""Self-play with a Monte Carlo tree search guided by a network.
+
+Rather than playing the move the network rates highest, as the
+ModelPlayer of the model module does, each move is chosen by a Monte
+Carlo tree search as in AlphaZero. A policy and value network gives
+the prior probabilities of the moves of every position added to the
+tree and an estimate of its value for the team to move, which replaces
+playing the game out. The visit counts of the moves at the root after
+the search are the training target of the policy, and the result of the
+game that of the value.
+
+Self-play runs the searches in worker processes, each advancing several
+games in lockstep so that one simulation of every game needs a single
+request for the network. The requests of all workers go to one
+InferenceServer thread in the main process, which gathers them into
+batches of up to MAX_BATCH positions, waiting at most BATCH_TIMEOUT
+seconds for more after the first, and runs the network once per batch.
+The searches, which are pure Python, run in parallel on as many cores as
+there are workers while the network is evaluated in large batches.
+
+The positions of each generation of self-play are saved as a shard in
+the format read by distill.iter_batches, with the arrays:
+
+    boards: int8 (n, 32); the boards as seen by the team to move.
+    masks: uint8 (n, 16); bitsets of the valid moves.
+    policies: float32 (n, 128); the visit count distribution of the
+        moves at the root, by move index as seen by the model.
+    values: float32 (n,); the result of the game for the team to move.
+
+Example Usage:
+    python mcts.py --generations 100 --games 64 --workers 4
+
+Classes:
+    PolicyValueNet: The network giving move priors and position values.
+    NetworkEvaluator: Evaluates positions with a network in this process.
+    InferenceServer: Evaluates the positions requested by workers in
+        batches.
+    InferenceClient: Requests evaluations from an InferenceServer.
+    Node: A position in the search tree.
+    MCTSPlayer: A player choosing its moves by tree search.
+
+Functions:
+    encode: Encodes a position as the network sees it.
+    play_games: Plays games of self-play, yielding their targets.
+    self_play: Plays games in worker processes sharing a server.
+    write_shard: Saves the targets of games as a shard.
+    fit: Trains the network on saved shards.
+    main: Command line entry point.
+"""
+
+import argparse
+import math
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+import checkers
+import distill
+import model
+
+
+MCTS_PATH = 'mcts_params.pt'
+SELF_PLAY_DIRECTORY = 'mcts_games'
+SIMULATIONS = 100
+C_PUCT = 1.5
+# Noise mixed into the priors of the root, so that self-play explores
+# moves the network rates poorly.
+DIRICHLET_ALPHA = 0.3
+DIRICHLET_FRACTION = 0.25
+# Plys at the start of each game whose moves are sampled in proportion
+# to their visit counts; later moves are the most visited.
+TEMPERATURE_PLYS = 20
+PARALLEL_GAMES = 8
+MAX_BATCH = 256
+BATCH_TIMEOUT = 0.002
+BATCH_SIZE = 256
+LR = 0.001
+# Shards of the most recent generations trained on after each one.
+TRAINING_WINDOW = 20
+
+TARGETS = ('boards', 'masks', 'policies', 'values')
+
+
+class PolicyValueNet(nn.Module):
+    """The fully connected trunk of model.DQN with two heads; the
+    logits of the 128 moves and the value of the position for the team
+    to move, in [-1, 1].
+    """
+    def __init__(self):
+        super().__init__()
+        self.layer1 = nn.Linear(32, 128)
+        self.layer2 = nn.Linear(128, 256)
+        self.layer3 = nn.Linear(256, 256)
+        self.policy = nn.Linear(256, 128)
+        self.value1 = nn.Linear(256, 64)
+        self.value2 = nn.Linear(64, 1)
+
+    def forward(self, x):
+        x = F.relu(self.layer1(x))
+        x = F.relu(self.layer2(x))
+        x = F.relu(self.layer3(x))
+        value = F.tanh(self.value2(F.relu(self.value1(x))))
+        return self.policy(x), value.view(-1)
+
+
+def _evaluate_batch(net, boards, masks):
+    """Returns the move priors and values of the network for boards, an
+    int8 array of shape (n, 32), where masks is a boolean array of shape
+    (n, 128) of the valid moves.
+    """
+    device = next(net.parameters()).device
+    with torch.inference_mode():
+        logits, values = net(torch.from_numpy(boards).to(device,
+                                                         torch.float32))
+        valid = torch.from_numpy(masks).to(device)
+        priors = torch.softmax(logits.masked_fill(~valid, -math.inf), 1)
+    return priors.cpu().numpy(), values.cpu().numpy()
+
+
+class NetworkEvaluator():
+    """Evaluates positions with a network in this process. Instances
+    are called like an InferenceClient.
+    """
+    def __init__(self, net):
+        self.net = net
+
+    def __call__(self, boards, masks):
+        return _evaluate_batch(self.net, boards, masks)
+
+
+class InferenceClient():
+    """Requests evaluations from an InferenceServer, from any process.
+    Instances are created by InferenceServer.client and are passed to
+    worker processes when they are started.
+    """
+    def __init__(self, client_id, requests, responses):
+        self.client_id = client_id
+        self.requests = requests
+        self.responses = responses
+
+    def __call__(self, boards, masks):
+        """Returns the priors and values of the positions, as arrays of
+        shape (n, 128) and (n,), waiting for the server to evaluate them.
+        """
+        self.requests.put((self.client_id, boards, masks))
+        return self.responses.get()
+
+
+class InferenceServer():
+    """Evaluates the positions requested by clients in batches, from a
+    background thread owning the network. Once a request arrives, others
+    are gathered until the batch holds max_batch positions or timeout
+    seconds have passed, and the network is run once for all of them.
+    The batches and positions attributes count the work done.
+    """
+    def __init__(self, net, max_batch=MAX_BATCH, timeout=BATCH_TIMEOUT):
+        self.net = net
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self.batches = 0
+        self.positions = 0
+        self._context = torch.multiprocessing.get_context('spawn')
+        self._requests = self._context.Queue()
+        self._responses = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def client(self):
+        """Returns a new InferenceClient. Clients must be created before
+        the processes using them are started.
+        """
+        responses = self._context.Queue()
+        self._responses.append(responses)
+        return InferenceClient(len(self._responses) - 1,
+                               self._requests,
+                               responses)
+
+    def _serve(self):
+        while not self._stop.is_set():
+            try:
+                requests = [self._requests.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+            count = len(requests[0][1])
+            deadline = time.perf_counter() + self.timeout
+            while count < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    requests.append(self._requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+                count += len(requests[-1][1])
+            priors, values = _evaluate_batch(
+                self.net,
+                np.concatenate([request[1] for request in requests]),
+                np.concatenate([request[2] for request in requests]))
+            start = 0
+            for client_id, boards, masks in requests:
+                end = start + len(boards)
+                self._responses[client_id].put((priors[start:end],
+                                                values[start:end]))
+                start = end
+            self.batches += 1
+            self.positions += count
+
+    def close(self):
+        """Stops the server thread."""
+        self._stop.set()
+        self._thread.join()
+
+
+def encode(gamestate, valid_moves):
+    """Returns the board of gamestate as seen by the team to move, as an
+    int8 array of shape (32,), and a boolean array of shape (128,) of
+    the valid_moves of the gamestate by their index as seen by the
+    model.
+    """
+    board = np.array(gamestate.board, dtype=np.int8)
+    if gamestate.turn == -1:
+        board = -board[::-1]
+    move_index = model.MOVE_INDEX[gamestate.turn]
+    mask = np.zeros(128, dtype=bool)
+    mask[[move_index[4*pos + dir] for pos, dir in valid_moves]] = True
+    return board, mask
+
+
+class Node():
+    """A position in the search tree. The gamestate of a node is only
+    created once the search first reaches it. The visits and value_sum
+    are from the perspective of the team that moved into the node.
+    """
+    __slots__ = ('gamestate', 'prior', 'visits', 'value_sum', 'children',
+                 'valid_moves', 'terminal_value')
+
+    def __init__(self, gamestate, prior):
+        self.gamestate = gamestate
+        self.prior = prior
+        self.visits = 0
+        self.value_sum = 0.0
+        self.children = None
+        self.valid_moves = None
+        self.terminal_value = None
+
+    def examine(self):
+        """Finds the valid moves of the node, setting terminal_value to
+        the value of a finished game for the team to move.
+        """
+        self.valid_moves = self.gamestate.get_valid_moves()
+        if not self.valid_moves:
+            self.terminal_value = -1.0
+        elif self.gamestate.plys_since_capture >= 80:
+            self.terminal_value = 0.0
+
+    def expand(self, priors):
+        """Adds a child for each valid move with its prior from priors,
+        an array of shape (128,) by the model's move index.
+        """
+        move_index = model.MOVE_INDEX[self.gamestate.turn]
+        self.children = {move: Node(None, float(priors[move_index[
+                                        4*move[0] + move[1]]]))
+                         for move in self.valid_moves}
+
+
+def _select(root, c_puct):
+    """Descends from root by the PUCT rule to a node not yet expanded,
+    returning the path of nodes from the root.
+    """
+    path = [root]
+    node = root
+    while node.children is not None and node.terminal_value is None:
+        scale = c_puct * math.sqrt(node.visits)
+        best_score = -math.inf
+        for move, child in node.children.items():
+            score = child.prior * scale / (1 + child.visits)
+            if child.visits:
+                score += child.value_sum / child.visits
+            if score > best_score:
+                best_score = score
+                best_move = move
+                best_child = child
+        if best_child.gamestate is None:
+            best_child.gamestate = node.gamestate.copy()
+            best_child.gamestate.update(best_move)
+        node = best_child
+        path.append(node)
+        if node.valid_moves is None:
+            node.examine()
+    return path
+
+
+def _backup(path, value):
+    """Adds value, the value of the last node of path for its team to
+    move, to every node on the path.
+    """
+    turn = path[-1].gamestate.turn
+    path[0].visits += 1
+    for parent, node in zip(path, path[1:]):
+        node.visits += 1
+        node.value_sum += value if parent.gamestate.turn == turn else -value
+
+
+def _add_noise(root, rng, alpha, fraction):
+    noise = rng.dirichlet([alpha] * len(root.children))
+    for child, sample in zip(root.children.values(), noise):
+        child.prior = (1 - fraction) * child.prior + fraction * sample
+
+
+def _simulate(roots, evaluate, c_puct, noise):
+    """Runs one simulation in each tree of roots, evaluating all of
+    their new leaves with a single call of evaluate. Roots expanded by
+    the simulation get Dirichlet noise if noise is a tuple
+    (rng, alpha, fraction).
+    """
+    leaves = []
+    for root in roots:
+        if root.valid_moves is None:
+            root.examine()
+        path = _select(root, c_puct)
+        if path[-1].terminal_value is not None:
+            _backup(path, path[-1].terminal_value)
+        else:
+            leaves.append(path)
+    if not leaves:
+        return
+    boards, masks = zip(*(encode(path[-1].gamestate, path[-1].valid_moves)
+                          for path in leaves))
+    priors, values = evaluate(np.stack(boards), np.stack(masks))
+    for path, node_priors, value in zip(leaves, priors, values):
+        path[-1].expand(node_priors)
+        if len(path) == 1 and noise is not None:
+            _add_noise(path[0], *noise)
+        _backup(path, float(value))
+
+
+def _visit_policy(root):
+    """Returns the visit counts of the moves of root by the model's move
+    index, normalized to sum to one.
+    """
+    move_index = model.MOVE_INDEX[root.gamestate.turn]
+    policy = np.zeros(128, dtype=np.float32)
+    for move, child in root.children.items():
+        policy[move_index[4*move[0] + move[1]]] = child.visits
+    return policy / policy.sum()
+
+
+def play_games(evaluate, claim_game, parallel_games=PARALLEL_GAMES,
+               simulations=SIMULATIONS, c_puct=C_PUCT,
+               dirichlet_alpha=DIRICHLET_ALPHA,
+               dirichlet_fraction=DIRICHLET_FRACTION,
+               temperature_plys=TEMPERATURE_PLYS, seed=None, stop=None):
+    """Plays games of self-play with tree search, advancing up to
+    parallel_games games in lockstep. Each move runs simulations
+    simulations in every game, reusing the subtree of the move played.
+
+    Args:
+        evaluate: A callable taking boards and masks as from encode,
+            stacked, and returning the priors and values of the
+            positions; an InferenceClient or a NetworkEvaluator.
+        claim_game: A callable returning True while more games should
+            be started.
+        parallel_games: The most games advanced together.
+        simulations: The simulations run for each move.
+        c_puct: The weight of the priors against the values found.
+        dirichlet_alpha, dirichlet_fraction: The concentration of the
+            noise added to the priors of the root and its weight.
+        temperature_plys: The plys at the start of each game whose
+            moves are sampled by their visit counts.
+        seed: Seed for the noise and the sampled moves.
+        stop: A callable returning True to abandon the games being
+            played, checked before each move, or None.
+
+    Yields:
+        For each game as it finishes, a dictionary of the arrays named
+        in TARGETS with a row per ply.
+    """
+
+    rng = np.random.default_rng(seed)
+    noise = (rng, dirichlet_alpha, dirichlet_fraction)
+    games = []
+    while True:
+        while len(games) < parallel_games and claim_game():
+            games.append({'root': Node(checkers.game.Gamestate(), 1.0),
+                          'boards': [],
+                          'masks': [],
+                          'policies': [],
+                          'turns': []})
+        if not games or (stop is not None and stop()):
+            return
+        for game in games:
+            root = game['root']
+            if root.children is not None:
+                _add_noise(root, *noise)
+        for simulation in range(simulations):
+            _simulate([game['root'] for game in games],
+                      evaluate,
+                      c_puct,
+                      noise)
+
+        still_active = []
+        for game in games:
+            root = game['root']
+            policy = _visit_policy(root)
+            board, mask = encode(root.gamestate, root.valid_moves)
+            game['boards'].append(board)
+            game['masks'].append(np.packbits(mask, bitorder='little'))
+            game['policies'].append(policy)
+            game['turns'].append(root.gamestate.turn)
+
+            moves = list(root.children)
+            if root.gamestate.ply_count < temperature_plys:
+                visits = np.array([root.children[move].visits
+                                   for move in moves], dtype=np.float64)
+                move = moves[rng.choice(len(moves), p=visits / visits.sum())]
+            else:
+                move = max(moves, key=lambda move: root.children[move].visits)
+            child = root.children[move]
+            if child.gamestate is None:
+                child.gamestate = root.gamestate.copy()
+                child.gamestate.update(move)
+            if child.valid_moves is None:
+                child.examine()
+            # The new root keeps its subtree but counts no visit of its
+            # own from the parent's search.
+            child.prior = 1.0
+            game['root'] = child
+            if child.terminal_value is None:
+                still_active.append(game)
+                continue
+            # The value of the final position is for its team to move.
+            final_turn = child.gamestate.turn
+            turns = np.array(game['turns'], dtype=np.float32)
+            yield {'boards': np.stack(game['boards']),
+                   'masks': np.stack(game['masks']),
+                   'policies': np.stack(game['policies']),
+                   'values': child.terminal_value * final_turn * turns}
+        games = still_active
+
+
+class MCTSPlayer(checkers.players.Player):
+    """Chooses each move by a tree search with the network evaluated in
+    this process, playing the most visited move without noise.
+    """
+    name = 'MCTS Player'
+
+    def __init__(self, verbose, net=None, simulations=SIMULATIONS,
+                 c_puct=C_PUCT):
+        self.gamestate = None
+        self.verbose = verbose
+        if net is None:
+            net = PolicyValueNet().to(model.device)
+            try:
+                net.load_state_dict(torch.load(MCTS_PATH))
+            except FileNotFoundError:
+                pass
+        self.evaluate = NetworkEvaluator(net)
+        self.simulations = simulations
+        self.c_puct = c_puct
+
+    def get_next_turn(self):
+        if self.gamestate.invalid_flag:
+            print('Invalid last move.')
+        elif self.verbose:
+            print(self.gamestate.viz_board())
+            print('Last move: %s' % (self.gamestate.prev_move,))
+
+        root = Node(self.gamestate.copy(), 1.0)
+        for simulation in range(self.simulations):
+            _simulate([root], self.evaluate, self.c_puct, None)
+        return max(root.children,
+                   key=lambda move: root.children[move].visits)
+
+
+def _claim_game(games_left):
+    with games_left.get_lock():
+        if games_left.value <= 0:
+            return False
+        games_left.value -= 1
+        return True
+
+
+def _self_play_worker(client, games_left, stop_event, results, search_args,
+                      seed):
+    try:
+        for targets in play_games(client,
+                                  lambda: _claim_game(games_left),
+                                  seed=seed,
+                                  stop=stop_event.is_set,
+                                  **search_args):
+            results.put(targets)
+    finally:
+        results.put(None)
+
+
+def self_play(server, game_count, workers, seed=None, **search_args):
+    """Plays game_count games in workers processes whose positions are
+    evaluated by server. Closing the generator early stops the workers
+    without finishing their games.
+
+    Args:
+        server: An InferenceServer.
+        game_count: The number of games to play.
+        workers: The number of worker processes.
+        seed: Seed for the searches; worker i uses seed + i.
+        **search_args: Keyword arguments for play_games.
+
+    Yields:
+        The targets of each game as it finishes, as from play_games.
+    """
+
+    context = torch.multiprocessing.get_context('spawn')
+    games_left = context.Value('q', game_count)
+    stop_event = context.Event()
+    results = context.Queue()
+    processes = [context.Process(
+                     target=_self_play_worker,
+                     args=(server.client(), games_left, stop_event, results,
+                           search_args, None if seed is None else seed + ind),
+                     daemon=True)
+                 for ind in range(workers)]
+    for process in processes:
+        process.start()
+    running = workers
+    try:
+        while running:
+            try:
+                targets = results.get(timeout=1)
+            except queue.Empty:
+                if not any(process.is_alive() for process in processes):
+                    raise RuntimeError('All self-play workers have exited.')
+                continue
+            if targets is None:
+                running -= 1
+            else:
+                yield targets
+    finally:
+        # When the games are not all received, the workers abandon their
+        # games. They cannot exit until their queued results are read.
+        stop_event.set()
+        while any(process.is_alive() for process in processes):
+            try:
+                results.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        for process in processes:
+            process.join()
+
+
+def write_shard(path, games):
+    """Saves the targets of games, a list of dictionaries from
+    play_games, as a single compressed shard at path.
+    """
+    temp_path = path + '.tmp.npz'
+    np.savez_compressed(temp_path,
+                        **{name: np.concatenate([game[name]
+                                                 for game in games])
+                           for name in TARGETS})
+    os.replace(temp_path, path)
+
+
+def fit(net, optimizer, directory, batch_size=BATCH_SIZE,
+        window=TRAINING_WINDOW):
+    """Trains the network for one pass over the last window shards of
+    directory, minimizing the cross entropy of its priors against the
+    visit policies plus the squared error of its values. Returns the
+    mean loss.
+    """
+    losses = []
+    device = next(net.parameters()).device
+    for batch in distill.iter_batches(directory, batch_size, window=window):
+        boards = torch.from_numpy(batch['boards']).to(device, torch.float32)
+        valid = torch.from_numpy(np.unpackbits(
+            batch['masks'], axis=1, bitorder='little').astype(bool))
+        policies = torch.from_numpy(batch['policies']).to(device)
+        values = torch.from_numpy(batch['values']).to(device)
+        logits, predicted = net(boards)
+        log_priors = F.log_softmax(
+            logits.masked_fill(~valid.to(device), -1e9), 1)
+        loss = (-(policies * log_priors).sum(1).mean()
+                + F.mse_loss(predicted, values))
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        losses.append(loss.item())
+    return sum(losses) / len(losses) if losses else None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Trains a policy and value network by self-play with '
+                    'tree search.')
+    parser.add_argument('--directory', default=SELF_PLAY_DIRECTORY,
+                        help='directory to save the self-play positions to')
+    parser.add_argument('--generations', type=int, default=100)
+    parser.add_argument('--games', type=int, default=64,
+                        help='games of self-play per generation')
+    parser.add_argument('--workers', type=int,
+                        default=max((os.cpu_count() or 1) - 1, 1),
+                        help='search processes (default one per CPU but '
+                             'one)')
+    parser.add_argument('--parallel-games', type=int, default=PARALLEL_GAMES,
+                        help='games advanced together by each worker')
+    parser.add_argument('--simulations', type=int, default=SIMULATIONS)
+    parser.add_argument('--max-batch', type=int, default=MAX_BATCH)
+    parser.add_argument('--batch-timeout', type=float, default=BATCH_TIMEOUT)
+    args = parser.parse_args(argv)
+
+    net = PolicyValueNet().to(model.device)
+    try:
+        net.load_state_dict(torch.load(MCTS_PATH))
+        print('Model loaded successfully.')
+    except FileNotFoundError:
+        print('No model found, using default values.')
+    optimizer = torch.optim.AdamW(net.parameters(), lr=LR)
+    os.makedirs(args.directory, exist_ok=True)
+    start_generation = len(distill.shard_names(args.directory))
+    server = InferenceServer(net, args.max_batch, args.batch_timeout)
+    try:
+        for generation in range(start_generation, args.generations):
+            start = time.perf_counter()
+            positions = server.positions
+            games = list(self_play(server,
+                                   args.games,
+                                   args.workers,
+                                   seed=generation * args.workers,
+                                   parallel_games=args.parallel_games,
+                                   simulations=args.simulations))
+            elapsed = time.perf_counter() - start
+            write_shard(os.path.join(
+                args.directory,
+                distill.SHARD_FORMAT.format(generation)), games)
+            loss = fit(net, optimizer, args.directory)
+            torch.save(net.state_dict(), MCTS_PATH)
+            print('Generation {}: {} positions evaluated per second, '
+                  'mean batch {:.1f}, loss {:.4f}'.format(
+                      generation,
+                      int((server.positions - positions) / elapsed),
+                      server.positions / max(server.batches, 1),
+                      loss))
+    finally:
+        server.close()
+
+
+if __name__ == '__main__':
+    main()
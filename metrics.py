@@ -0,0 +1,239 @@
+"""Records training metrics to a file and plots them offline.
+
+Training logs its metrics through a MetricsWriter, which appends them to
+a file from a background thread so the training loop never waits on the
+disk. The file is plotted by running this module, separately from
+training, either once or repeatedly as a viewer following a running
+training process. Only the plotting imports matplotlib.
+
+Files ending in .csv hold one row per metric, with the columns time,
+generation, metric and value. Any other file holds one JSON object per
+line, with the keys time, generation and the metrics logged together.
+
+Example Usage:
+    python metrics.py metrics.jsonl --output training.png
+    python metrics.py metrics.jsonl --follow 10
+
+Classes:
+    MetricsWriter: Appends metrics to a file from a background thread.
+
+Functions:
+    read_metrics: Reads the records of a metrics file.
+    smooth: Returns an exponential moving average of a series.
+    plot_metrics: Plots the records of a metrics file.
+    main: Command line entry point.
+"""
+
+import argparse
+import csv
+import json
+import os
+import queue
+import threading
+import time
+
+
+CSV_FIELDS = ('time', 'generation', 'metric', 'value')
+
+
+class MetricsWriter():
+    """Appends metrics to a file from a background thread.
+
+    Attributes:
+        path: The path of the metrics file.
+    """
+
+    def __init__(self, path):
+        """Opens the metrics file for appending, creating it if needed.
+
+        Args:
+            path: The path of the metrics file; a .csv suffix selects the
+                CSV format and anything else JSON lines.
+        """
+
+        self.path = path
+        self._csv = path.endswith('.csv')
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, 'a', newline='')
+        if self._csv:
+            self._csv_writer = csv.writer(self._file)
+            if new_file:
+                self._csv_writer.writerow(CSV_FIELDS)
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    def log(self, generation, **metrics):
+        """Queues metrics to be written without waiting for the disk.
+
+        Args:
+            generation: The training generation the metrics belong to.
+            **metrics: Numeric values of the metrics by name. Values of
+                None are skipped.
+        """
+
+        record = {'time': time.time(), 'generation': generation}
+        record.update((name, value) for name, value in metrics.items()
+                      if value is not None)
+        self._queue.put(record)
+
+    def _write_loop(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                return
+            self._write(record)
+            # Write everything queued meanwhile before flushing once.
+            while True:
+                try:
+                    record = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if record is None:
+                    self._file.flush()
+                    return
+                self._write(record)
+            self._file.flush()
+
+    def _write(self, record):
+        if self._csv:
+            for name, value in record.items():
+                if name not in ('time', 'generation'):
+                    self._csv_writer.writerow((record['time'],
+                                               record['generation'],
+                                               name,
+                                               value))
+        else:
+            self._file.write(json.dumps(record) + '\n')
+
+    def close(self):
+        """Writes the queued metrics and closes the file."""
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+
+
+def read_metrics(path):
+    """Reads the records of a metrics file.
+
+    A partially written last line is ignored, so the file may be read
+    while training appends to it.
+
+    Args:
+        path: The path of a file written by a MetricsWriter.
+
+    Returns:
+        A list of dictionaries in the order they were logged, each with
+        the keys time, generation and the metrics logged together.
+    """
+
+    records = []
+    with open(path, newline='') as metrics_file:
+        if path.endswith('.csv'):
+            for row in csv.DictReader(metrics_file):
+                if row['value'] is None:
+                    continue
+                key = (float(row['time']), int(row['generation']))
+                if (not records or
+                        (records[-1]['time'], records[-1]['generation'])
+                        != key):
+                    records.append({'time': key[0], 'generation': key[1]})
+                records[-1][row['metric']] = float(row['value'])
+        else:
+            for line in metrics_file:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    break
+    return records
+
+
+def smooth(values, alpha=0.1):
+    """Returns an exponential moving average of a series of values."""
+    smoothed = []
+    for value in values:
+        if not smoothed:
+            smoothed.append(value)
+        else:
+            smoothed.append(alpha * value + (1 - alpha) * smoothed[-1])
+    return smoothed
+
+
+def _series(records, name):
+    points = [(record['generation'], record[name]) for record in records
+              if name in record]
+    return [point[0] for point in points], [point[1] for point in points]
+
+
+def plot_metrics(path, figure):
+    """Plots the records of a metrics file.
+
+    The figure shows the loss with its moving average, the exploration
+    rate, the self-play speed and every validation score against the
+    generation.
+
+    Args:
+        path: The path of a file written by a MetricsWriter.
+        figure: The matplotlib figure to draw on; it is cleared first.
+    """
+
+    records = read_metrics(path)
+    figure.clear()
+    loss_axes, epsilon_axes, speed_axes, validation_axes = \
+        figure.subplots(4, 1, sharex=True)
+
+    generations, losses = _series(records, 'loss')
+    loss_axes.plot(generations, losses, alpha=0.3, label='loss')
+    loss_axes.plot(generations, smooth(losses), label='moving average')
+    loss_axes.set_ylabel('Loss')
+    loss_axes.legend()
+
+    epsilon_axes.plot(*_series(records, 'epsilon'))
+    epsilon_axes.set_ylabel('Exploration')
+
+    speed_axes.plot(*_series(records, 'games_per_second'))
+    speed_axes.set_ylabel('Games/s')
+
+    validation_names = sorted({name for record in records for name in record
+                               if name.startswith('validation_')})
+    for name in validation_names:
+        validation_axes.plot(*_series(records, name), marker='o',
+                             label=name[len('validation_'):])
+    validation_axes.set_ylabel('Validation score')
+    if validation_names:
+        validation_axes.legend()
+    validation_axes.set_xlabel('Generation')
+    figure.suptitle(path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Plots the metrics recorded during training.')
+    parser.add_argument('path', help='metrics file written by training')
+    parser.add_argument('--output',
+                        help='image file to save the plot to instead of '
+                             'showing it')
+    parser.add_argument('--follow', type=float, metavar='SECONDS',
+                        help='redraw the plot at this interval')
+    args = parser.parse_args(argv)
+
+    import matplotlib
+    if args.output is not None:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    figure = plt.figure(figsize=(8, 10))
+    plot_metrics(args.path, figure)
+    if args.output is not None:
+        figure.savefig(args.output)
+    elif args.follow:
+        plt.ion()
+        while plt.fignum_exists(figure.number):
+            plt.pause(args.follow)
+            plot_metrics(args.path, figure)
+    else:
+        plt.show()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,57 @@
+import concurrent.futures
+import contextlib
+import copy
+import fcntl
+import functools
 import math
+import os
+import queue
 import random
-import matplotlib
-import matplotlib.pyplot as plt
-from collections import namedtuple, deque
+import threading
+import time
+import warnings
+from collections import namedtuple
 from itertools import count
 
+import numpy as np
 import torch
 from torch import nn
 from torch import optim
 import torch.nn.functional as F
 
 import checkers
+import metrics as training_metrics
 
 
 PATH = 'model_params.pt'
+GAME_RECORD_PATH = 'self_play_games.ckr'
+CHECKPOINT_PATH = 'checkpoint.pt'
+# Metrics are appended as JSON lines, or as CSV if the path ends in .csv,
+# and plotted with metrics.py.
+METRICS_PATH = 'metrics.jsonl'
+# Generations between checkpoints.
+CHECKPOINT_INTERVAL = 5
 BATCH_SIZE = 128
+# Gradient steps taken for each self-play game received, or with a
+# REPLAY_RATIO, for each transition received on average.
+STEPS_PER_GAME = 1
+REPLAY_RATIO = None
+# Each gradient step accumulates the gradients of ACCUMULATION_STEPS
+# batches of BATCH_SIZE transitions, for an effective batch of their
+# product.
+ACCUMULATION_STEPS = 1
+# The target model is synced every TARGET_SYNC_STEPS gradient steps, or
+# at the start of every generation if None.
+TARGET_SYNC_STEPS = None
+# Batches sampled ahead by a background thread while the learner trains;
+# 0 samples each batch when it is needed, which keeps resumed training
+# identical to the interrupted run.
+PREFETCH_BATCHES = 0
 GAMMA = 0.8
+# Transitions hold the discounted return of the next N_STEP moves of a
+# team, bootstrapping from the state after them, or the return to the end
+# of the game if N_STEP is None.
+N_STEP = 1
 EXP_START = 0.9
 EXP_END = 0.05
 EXP_DECAY = 2000000
@@ -28,33 +64,638 @@ DRAW_REWARD = 0
 DRAW_STEP = (1 - GAMMA) * DRAW_REWARD
 LOSS_REWARD = -1
 LOSS_STEP = (1 - GAMMA) * LOSS_REWARD
+# Validation plays VALIDATION_GAMES games as each team against each of
+# the VALIDATION_OPPONENTS, every VALIDATION_INTERVAL generations, in
+# VALIDATION_WORKERS background processes.
+VALIDATION_GAMES = 5
+VALIDATION_OPPONENTS = ('random', 'easy', 'medium')
+VALIDATION_INTERVAL = 25
+VALIDATION_WORKERS = 1
+# Sequential tests of the model against an opponent stop once the games
+# show with error rates SPRT_ALPHA and SPRT_BETA whether the model is
+# SPRT_ELO_0 or SPRT_ELO_1 stronger, or after SPRT_MAX_GAMES games.
+SPRT_ELO_0 = 0
+SPRT_ELO_1 = 50
+SPRT_ALPHA = 0.05
+SPRT_BETA = 0.05
+SPRT_MAX_GAMES = 400
+# Replay memory stored in a file at REPLAY_PATH, kept between runs, or in
+# RAM if it is None.
+REPLAY_PATH = None
+REPLAY_CAPACITY = 25000
+# Prioritized replay samples transitions with probability proportional
+# to priority ** PER_ALPHA, where the priority is the last absolute TD
+# error plus PER_EPSILON. The importance-sampling exponent rises from
+# PER_BETA_START to 1 over PER_BETA_STEPS batches.
+REPLAY_PRIORITIZED = False
+PER_ALPHA = 0.6
+PER_BETA_START = 0.4
+PER_BETA_STEPS = 100000
+PER_EPSILON = 1e-3
+# Self-play games advanced together with one forward pass per move; 1
+# plays them one at a time through CheckersMatch.
+SELF_PLAY_BATCH = 16
+# Self-play actor processes; 0 plays and trains in a single process.
+ACTORS = (os.cpu_count() or 1) - 1
+WEIGHT_SYNC_INTERVAL = 10
+QUEUE_DEPTH = 64
+# Players that only play, such as in validation, run the DQN with one of
+# INFERENCE_BACKENDS: 'eager' calls the module, 'script' a TorchScript
+# trace of it, 'frozen' a trace with the weights folded in as constants
+# and optimized for inference, and 'quantized' a frozen trace with the
+# weights of its Linear layers in int8, which only runs on the CPU.
+# Processes that only play use INTRA_OP_THREADS and INTER_OP_THREADS
+# threads; None keeps torch's default.
+INFERENCE_BACKENDS = ('eager', 'script', 'frozen', 'quantized')
+INFERENCE_BACKEND = 'frozen'
+INTRA_OP_THREADS = 1
+INTER_OP_THREADS = 1
+
+# The constants above that a config file may set through configure.
+CONFIG_NAMES = (
+    'PATH', 'GAME_RECORD_PATH', 'CHECKPOINT_PATH', 'METRICS_PATH',
+    'CHECKPOINT_INTERVAL', 'BATCH_SIZE', 'STEPS_PER_GAME', 'REPLAY_RATIO',
+    'ACCUMULATION_STEPS', 'TARGET_SYNC_STEPS', 'PREFETCH_BATCHES',
+    'GAMMA', 'N_STEP', 'EXP_START', 'EXP_END', 'EXP_DECAY', 'GENERATIONS',
+    'GAMES_PER_GENERATION', 'LR', 'WIN_REWARD', 'DRAW_REWARD',
+    'LOSS_REWARD', 'VALIDATION_GAMES', 'VALIDATION_OPPONENTS',
+    'VALIDATION_INTERVAL', 'VALIDATION_WORKERS', 'SPRT_ELO_0', 'SPRT_ELO_1',
+    'SPRT_ALPHA', 'SPRT_BETA', 'SPRT_MAX_GAMES',
+    'REPLAY_PATH', 'REPLAY_CAPACITY', 'REPLAY_PRIORITIZED', 'PER_ALPHA',
+    'PER_BETA_START', 'PER_BETA_STEPS', 'PER_EPSILON', 'SELF_PLAY_BATCH',
+    'ACTORS', 'WEIGHT_SYNC_INTERVAL', 'QUEUE_DEPTH', 'INFERENCE_BACKEND',
+    'INTRA_OP_THREADS', 'INTER_OP_THREADS',
+)
 
-plt.ion()
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-print('Using {}.'.format(device))
 
-# The named tuple Tranisiton stores all information needed to trade the
-# on past states.
-Transition = namedtuple('Transition',
-                        ('state', 'action', 'reward', 'next_state', 'mask'))
+# Opponents available for validation.
+OPPONENTS = {
+    'random': checkers.players.RandomPlayer,
+    'easy': checkers.players.EasyPlayer,
+    'medium': checkers.players.MediumPlayer,
+    'hard': checkers.players.HardPlayer,
+}
+
+# The named tuple Batch stores a batch of transitions sampled from replay
+# memory, stacked along the first dimension. Rows with a False entry in
+# non_final are transitions that ended the game; their next_state and
+# mask rows are meaningless. Prioritized replay also gives the
+# importance-sampling weights of the rows and the indices to pass back
+# to update_priorities; both are None for uniform sampling.
+Batch = namedtuple('Batch', ('state', 'action', 'reward', 'next_state',
+                             'mask', 'non_final', 'weights', 'indices'),
+                   defaults=(None, None))
+
+# The model sees every board from the perspective of team 1, with moves
+# indexed as in checkers.game.MOVE_INDEX; MOVE_TUPLES maps indices to
+# move tuples.
+DIR_TRANSLATOR = checkers.game.DIR_TRANSLATOR
+MOVE_INDEX = checkers.game.MOVE_INDEX
+MOVE_TUPLES = tuple(divmod(ind, 4) for ind in range(128))
+
+# Bit values of each of the 8 moves packed into a byte of a mask bitset.
+MASK_BITS = torch.tensor([1, 2, 4, 8, 16, 32, 64, 128], dtype=torch.uint8)
+
+
+def configure(config):
+    """ Sets the constants named in CONFIG_NAMES from the dictionary
+    config, such as one loaded from a JSON config file, and recomputes
+    the rewards per step from GAMMA. Raises ValueError for any other
+    name, leaving every constant unchanged.
+    """
+    unknown = sorted(set(config) - set(CONFIG_NAMES))
+    if unknown:
+        raise ValueError('Unknown config names: {}.'.format(
+            ', '.join(unknown)))
+    for name, value in config.items():
+        if isinstance(value, list):
+            value = tuple(value)
+        globals()[name] = value
+    global WIN_STEP, DRAW_STEP, LOSS_STEP
+    WIN_STEP = (1 - GAMMA) * WIN_REWARD
+    DRAW_STEP = (1 - GAMMA) * DRAW_REWARD
+    LOSS_STEP = (1 - GAMMA) * LOSS_REWARD
+
+
+def current_config():
+    """ Returns a dictionary of the constants named in CONFIG_NAMES. """
+    return {name: globals()[name] for name in CONFIG_NAMES}
+
+
+def pack_mask(mask):
+    """ Packs masks as returned by ModelPlayer.get_mask, with 0 for valid
+    moves and -2 for invalid moves, into bitsets of valid moves. Takes a
+    tensor of shape (n, 128) and returns a uint8 tensor of shape (n, 16).
+    """
+    valid = (mask == 0).view(-1, 16, 8).to(torch.uint8)
+    return (valid * MASK_BITS.to(mask.device)).sum(2, dtype=torch.uint8)
+
+
+def unpack_mask(bitsets):
+    """ Unpacks bitsets from pack_mask into a float tensor of shape
+    (n, 128) with 0 for valid moves and -2 for invalid moves.
+    """
+    valid = (bitsets.unsqueeze(2) & MASK_BITS.to(bitsets.device)).ne(0)
+    return valid.view(-1, 128).logical_not().to(torch.float32) * -2
 
 
 class ReplayMemory():
     """ The ReplayMemory class defines an object that stores transition
     data then outputs them to be trained on in random batches. This
     reduces correlation between transitions to better train the model.
+
+    Transitions are stored in preallocated tensors used as a ring buffer,
+    so the oldest transitions are overwritten once capacity is reached.
+    Boards are stored as int8, actions as uint8 and masks as 16 byte
+    bitsets, which is under 100 bytes per transition, and a batch is
+    assembled by indexing each tensor once.
     """
     def __init__(self, capacity):
-        self.memory = deque([], maxlen=capacity)
+        self.capacity = capacity
+        self.position = 0
+        self.size = 0
+        self.states = torch.zeros((capacity, 32),
+                                  dtype=torch.int8,
+                                  device=device)
+        self.actions = torch.zeros(capacity, dtype=torch.uint8, device=device)
+        self.rewards = torch.zeros(capacity,
+                                   dtype=torch.float32,
+                                   device=device)
+        self.next_states = torch.zeros((capacity, 32),
+                                       dtype=torch.int8,
+                                       device=device)
+        self.masks = torch.zeros((capacity, 16),
+                                 dtype=torch.uint8,
+                                 device=device)
+        self.non_final = torch.zeros(capacity, dtype=torch.bool, device=device)
 
-    def push(self, *args):
-        self.memory.append(Transition(*args))
+    def push(self, state, action, reward, next_state, mask):
+        """ Stores a transition. The state and next_state are oriented
+        board tensors with 32 entries, action a tensor holding the move
+        index, reward a tensor holding the reward and mask the tensor
+        from ModelPlayer.get_mask for next_state. The next_state and mask
+        are None if the transition ended the game.
+        """
+        ind = self.position
+        self.states[ind] = state.view(32)
+        self.actions[ind] = action.view(())
+        self.rewards[ind] = reward.view(())
+        if next_state is None:
+            self.non_final[ind] = False
+        else:
+            self.non_final[ind] = True
+            self.next_states[ind] = next_state.view(32)
+            self.masks[ind] = pack_mask(mask.view(1, 128))[0]
+        self.position = (ind + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
 
     def sample(self, batch_size):
-        return random.sample(self.memory, batch_size)
+        """ Returns a Batch of batch_size transitions chosen uniformly at
+        random with replacement, so a batch may hold a transition more
+        than once and may be larger than the memory.
+        """
+        indices = torch.randint(self.size, (batch_size,), device=device)
+        return Batch(self.states[indices].to(torch.float32),
+                     self.actions[indices].to(torch.int64).unsqueeze(1),
+                     self.rewards[indices],
+                     self.next_states[indices].to(torch.float32),
+                     unpack_mask(self.masks[indices]),
+                     self.non_final[indices])
+
+    def push_batch(self, states, actions, rewards, next_states, masks,
+                   non_final):
+        """ Stores a batch of transitions already in the compact storage
+        format, as returned by pack_transitions.
+        """
+        count = len(states)
+        indices = torch.arange(self.position,
+                               self.position + count,
+                               device=device) % self.capacity
+        self.states[indices] = states.to(device)
+        self.actions[indices] = actions.to(device)
+        self.rewards[indices] = rewards.to(device)
+        self.next_states[indices] = next_states.to(device)
+        self.masks[indices] = masks.to(device)
+        self.non_final[indices] = non_final.to(device)
+        self.position = (self.position + count) % self.capacity
+        self.size = min(self.size + count, self.capacity)
+
+    def state_dict(self):
+        """ Returns the stored transitions and write position. """
+        return {'position': self.position,
+                'size': self.size,
+                'states': self.states,
+                'actions': self.actions,
+                'rewards': self.rewards,
+                'next_states': self.next_states,
+                'masks': self.masks,
+                'non_final': self.non_final}
+
+    def load_state_dict(self, state_dict):
+        self.position = state_dict['position']
+        self.size = state_dict['size']
+        for name in ('states', 'actions', 'rewards', 'next_states', 'masks',
+                     'non_final'):
+            getattr(self, name).copy_(state_dict[name])
+
+    def nbytes(self):
+        """ Returns the memory used by the buffers in bytes. """
+        return sum(buffer.element_size() * buffer.nelement()
+                   for buffer in (self.states, self.actions, self.rewards,
+                                  self.next_states, self.masks,
+                                  self.non_final))
 
     def __len__(self):
-        return len(self.memory)
+        return self.size
+
+
+class SumTree():
+    """ A binary tree stored in a flat array where every node holds the
+    sum of its two children, used to sample leaves with probability
+    proportional to their values. Node 1 is the root, the children of
+    node i are 2i and 2i + 1, and the leaves start at index leaf_count.
+    Sampling and updating a batch both take O(log n) steps, each
+    vectorized over the batch with numpy, whose per call overhead is
+    much lower than that of torch for arrays this small.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.leaf_count = 1 << max(capacity - 1, 1).bit_length()
+        self.depth = self.leaf_count.bit_length() - 1
+        self.tree = np.zeros(2 * self.leaf_count, dtype=np.float64)
+
+    def total(self):
+        return self.tree[1]
+
+    def update(self, indices, values):
+        """ Sets the leaves at the numpy array indices to values and
+        updates their ancestors. Later entries win when indices repeat.
+        """
+        nodes = indices + self.leaf_count
+        self.tree[nodes] = values
+        for level in range(self.depth):
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, prefix_sums):
+        """ Returns the leaf indices whose cumulative value ranges contain
+        each of the numpy array prefix_sums, along with the leaf values.
+        """
+        nodes = np.ones(len(prefix_sums), dtype=np.int64)
+        for level in range(self.depth):
+            left = 2 * nodes
+            left_sums = self.tree[left]
+            # Rounding must not lead into a subtree without any value.
+            go_right = ((prefix_sums >= left_sums)
+                        & (self.tree[left + 1] > 0))
+            prefix_sums = np.where(go_right,
+                                   prefix_sums - left_sums,
+                                   prefix_sums)
+            nodes = left + go_right
+        return nodes - self.leaf_count, self.tree[nodes]
+
+
+class PrioritizedReplayMemory(ReplayMemory):
+    """ A ReplayMemory sampling transitions in proportion to their
+    priorities, kept in a SumTree. New transitions get the highest
+    priority seen so far, so each is likely to be sampled at least once,
+    and Trainer.optimize_model sets the priorities of sampled transitions
+    from their TD errors with update_priorities. Sampled batches carry
+    importance-sampling weights correcting for the non-uniform sampling,
+    normalized by the largest weight in the batch. The alpha, beta_start
+    and beta_steps default to PER_ALPHA, PER_BETA_START and PER_BETA_STEPS
+    when None.
+    """
+    def __init__(self,
+                 capacity,
+                 alpha=None,
+                 beta_start=None,
+                 beta_steps=None):
+        if alpha is None:
+            alpha = PER_ALPHA
+        if beta_start is None:
+            beta_start = PER_BETA_START
+        if beta_steps is None:
+            beta_steps = PER_BETA_STEPS
+        super().__init__(capacity)
+        self.alpha = alpha
+        self.beta_start = beta_start
+        self.beta_steps = beta_steps
+        self.sample_count = 0
+        self.max_priority = 1.0
+        self.priorities = SumTree(capacity)
+
+    @property
+    def beta(self):
+        progress = min(self.sample_count / self.beta_steps, 1.0)
+        return self.beta_start + (1 - self.beta_start) * progress
+
+    def push(self, state, action, reward, next_state, mask):
+        ind = self.position
+        super().push(state, action, reward, next_state, mask)
+        self.priorities.update(np.array([ind]),
+                               self.max_priority ** self.alpha)
+
+    def push_batch(self, states, actions, rewards, next_states, masks,
+                   non_final):
+        indices = np.arange(self.position,
+                            self.position + len(states)) % self.capacity
+        super().push_batch(states, actions, rewards, next_states, masks,
+                           non_final)
+        self.priorities.update(indices, self.max_priority ** self.alpha)
+
+    def sample(self, batch_size):
+        """ Returns a Batch of batch_size transitions, one drawn from each
+        of batch_size equal ranges of the total priority.
+        """
+        segment = self.priorities.total() / batch_size
+        prefix_sums = (np.arange(batch_size)
+                       + np.random.random(batch_size)) * segment
+        indices, priorities = self.priorities.find(prefix_sums)
+        probabilities = priorities / self.priorities.total()
+        weights = (self.size * probabilities) ** -self.beta
+        weights = torch.from_numpy(weights / weights.max()).to(torch.float32)
+        self.sample_count += 1
+        device_indices = torch.from_numpy(indices).to(device)
+        return Batch(self.states[device_indices].to(torch.float32),
+                     self.actions[device_indices].to(torch.int64).unsqueeze(1),
+                     self.rewards[device_indices],
+                     self.next_states[device_indices].to(torch.float32),
+                     unpack_mask(self.masks[device_indices]),
+                     self.non_final[device_indices],
+                     weights.to(device),
+                     indices)
+
+    def update_priorities(self, indices, td_errors):
+        """ Sets the priorities of the transitions at indices, as given in
+        a sampled Batch, from their absolute TD errors.
+        """
+        priorities = (td_errors.detach().abs().cpu().to(torch.float64)
+                      .numpy() + PER_EPSILON)
+        self.max_priority = max(self.max_priority, priorities.max())
+        self.priorities.update(indices, priorities ** self.alpha)
+
+    def state_dict(self):
+        state_dict = super().state_dict()
+        state_dict.update({'priorities': torch.from_numpy(
+                               self.priorities.tree),
+                           'max_priority': self.max_priority,
+                           'sample_count': self.sample_count})
+        return state_dict
+
+    def load_state_dict(self, state_dict):
+        super().load_state_dict(state_dict)
+        self.priorities.tree[:] = state_dict['priorities'].numpy()
+        self.max_priority = state_dict['max_priority']
+        self.sample_count = state_dict['sample_count']
+
+
+class DiskReplayMemory():
+    """ A replay memory with the interface of ReplayMemory whose
+    transitions are kept in a memory-mapped file of fixed-size records,
+    so its capacity is limited by disk space rather than RAM and its
+    contents survive restarts. Opening an existing file resumes from the
+    transitions it holds.
+
+    Several processes may open the same file and append to it at once;
+    appends hold an exclusive lock on the file while reserving and
+    writing their records. Sampling takes no lock, so it may read
+    records being overwritten by a concurrent append.
+    """
+    MAGIC = b'CKRM'
+    VERSION = 1
+    HEADER = np.dtype([('magic', 'S4'),
+                       ('version', '<u4'),
+                       ('capacity', '<i8'),
+                       ('position', '<i8'),
+                       ('size', '<i8')])
+    HEADER_BYTES = 64
+    RECORD = np.dtype([('state', 'i1', (32,)),
+                       ('next_state', 'i1', (32,)),
+                       ('action', 'u1'),
+                       ('reward', '<f4'),
+                       ('mask', 'u1', (16,)),
+                       ('non_final', '?')])
+
+    def __init__(self, path, capacity):
+        """ Opens the replay file at path, creating it with room for
+        capacity transitions if it does not exist. Raises ValueError if
+        the file is not a replay file or has a different capacity.
+        """
+        self.path = path
+        self.capacity = capacity
+        self._lock_file = open(path, 'a+b')
+        with self._locked():
+            if os.fstat(self._lock_file.fileno()).st_size == 0:
+                header = np.zeros(1, dtype=self.HEADER)
+                header['magic'] = self.MAGIC
+                header['version'] = self.VERSION
+                header['capacity'] = capacity
+                self._lock_file.write(header.tobytes().ljust(
+                    self.HEADER_BYTES, b'\0'))
+                self._lock_file.truncate(self.HEADER_BYTES
+                                         + capacity * self.RECORD.itemsize)
+                self._lock_file.flush()
+        self.header = np.memmap(path, dtype=self.HEADER, mode='r+', shape=1)
+        if (self.header['magic'][0] != self.MAGIC
+                or self.header['version'][0] != self.VERSION):
+            raise ValueError('{} is not a replay memory file.'.format(path))
+        if self.header['capacity'][0] != capacity:
+            raise ValueError('{} holds {} transitions, not {}.'.format(
+                path, self.header['capacity'][0], capacity))
+        self.records = np.memmap(path,
+                                 dtype=self.RECORD,
+                                 mode='r+',
+                                 offset=self.HEADER_BYTES,
+                                 shape=capacity)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def push(self, state, action, reward, next_state, mask):
+        """ Stores a transition; see ReplayMemory.push. """
+        self.push_batch(*pack_transitions(
+            [(state, action, reward, next_state, mask)]))
+
+    def push_batch(self, states, actions, rewards, next_states, masks,
+                   non_final):
+        """ Stores a batch of transitions already in the compact storage
+        format, as returned by pack_transitions.
+        """
+        count = len(states)
+        with self._locked():
+            position = int(self.header['position'][0])
+            indices = np.arange(position, position + count) % self.capacity
+            self.records['state'][indices] = states.cpu().numpy()
+            self.records['next_state'][indices] = next_states.cpu().numpy()
+            self.records['action'][indices] = actions.cpu().numpy()
+            self.records['reward'][indices] = rewards.cpu().numpy()
+            self.records['mask'][indices] = masks.cpu().numpy()
+            self.records['non_final'][indices] = non_final.cpu().numpy()
+            self.header['position'] = (position + count) % self.capacity
+            self.header['size'] = min(int(self.header['size'][0]) + count,
+                                      self.capacity)
+
+    def sample(self, batch_size):
+        """ Returns a Batch of batch_size transitions chosen uniformly at
+        random with replacement.
+        """
+        indices = np.sort(np.random.randint(len(self), size=batch_size))
+        records = self.records[indices]
+
+        def field(name):
+            tensor = torch.from_numpy(np.ascontiguousarray(records[name]))
+            if device.type == 'cuda':
+                # Copies from pinned memory do not block the thread, which
+                # may be the one of a BatchPrefetcher.
+                tensor = tensor.pin_memory()
+            return tensor.to(device, non_blocking=True)
+
+        return Batch(field('state').to(torch.float32),
+                     field('action').to(torch.int64).unsqueeze(1),
+                     field('reward'),
+                     field('next_state').to(torch.float32),
+                     unpack_mask(field('mask')),
+                     field('non_final'))
+
+    def state_dict(self):
+        """ Returns the write position at the time; the transitions
+        themselves stay in the file.
+        """
+        return {'position': int(self.header['position'][0]),
+                'size': int(self.header['size'][0])}
+
+    def load_state_dict(self, state_dict):
+        """ Leaves the file as it is. Records appended after the state was
+        taken have overwritten older ones in place, and other processes
+        may be appending to the file, so rewinding the write position
+        cannot restore the earlier contents. The memory continues with
+        every transition in the file instead, and resumed training does
+        not repeat the interrupted run exactly.
+        """
+
+    def flush(self):
+        """ Writes changes to the records through to the file. """
+        self.records.flush()
+        self.header.flush()
+
+    def close(self):
+        self.flush()
+        self._lock_file.close()
+
+    def nbytes(self):
+        """ Returns the size of the stored records in bytes. """
+        return self.capacity * self.RECORD.itemsize
+
+    def __len__(self):
+        return int(self.header['size'][0])
+
+
+def make_replay_memory():
+    """ Returns the replay memory used for training; a DiskReplayMemory
+    at REPLAY_PATH, a PrioritizedReplayMemory if REPLAY_PRIORITIZED is
+    set, or a ReplayMemory otherwise.
+    """
+    if REPLAY_PATH is not None:
+        if REPLAY_PRIORITIZED:
+            raise ValueError('Prioritized replay is only kept in RAM.')
+        return DiskReplayMemory(REPLAY_PATH, REPLAY_CAPACITY)
+    if REPLAY_PRIORITIZED:
+        return PrioritizedReplayMemory(REPLAY_CAPACITY,
+                                       PER_ALPHA,
+                                       PER_BETA_START,
+                                       PER_BETA_STEPS)
+    return ReplayMemory(REPLAY_CAPACITY)
+
+
+class BatchPrefetcher():
+    """ Samples batches from a replay memory in a background thread, so
+    that the learner finds the next batch ready when it finishes a step.
+    Up to depth batches wait in a queue; once it is full the thread waits
+    for the learner. While the thread runs, transitions are pushed and
+    priorities updated through the prefetcher, which holds a lock shared
+    with the sampling. Batches are sampled from the memory as it was when
+    they were queued, so with prioritized replay they may miss the latest
+    priority updates.
+
+    The sampled and requested attributes count the batches sampled and
+    taken by the learner, and starved those the learner had to wait for
+    as none was ready.
+    """
+    def __init__(self, memory, batch_size, depth):
+        self.memory = memory
+        self.batch_size = batch_size
+        self.sampled = 0
+        self.requested = 0
+        self.starved = 0
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(depth)
+        self._stop = threading.Event()
+        self._error = None
+        self._thread = threading.Thread(target=self._sample_loop,
+                                        daemon=True)
+        self._thread.start()
+
+    def _sample_loop(self):
+        try:
+            while not self._stop.is_set():
+                with self._lock:
+                    batch = None
+                    if len(self.memory) >= self.batch_size:
+                        batch = self.memory.sample(self.batch_size)
+                if batch is None:
+                    self._stop.wait(0.01)
+                    continue
+                self.sampled += 1
+                while not self._stop.is_set():
+                    try:
+                        self._queue.put(batch, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+        except Exception as error:
+            self._error = error
+
+    def get(self):
+        """ Returns the next Batch, waiting for one if none is ready, or
+        None if the memory holds fewer than batch_size transitions. Errors
+        raised while sampling are raised here.
+        """
+        if len(self.memory) < self.batch_size:
+            return None
+        self.requested += 1
+        try:
+            return self._queue.get_nowait()
+        except queue.Empty:
+            self.starved += 1
+        while True:
+            if self._error is not None:
+                raise self._error
+            try:
+                return self._queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    def push_batch(self, *transitions):
+        """ Pushes a batch of transitions to the memory. """
+        with self._lock:
+            self.memory.push_batch(*transitions)
+
+    def update_priorities(self, indices, td_errors):
+        """ Updates the priorities of a prioritized memory. """
+        with self._lock:
+            self.memory.update_priorities(indices, td_errors)
+
+    def close(self):
+        """ Stops the sampling thread, discarding the queued batches. """
+        self._stop.set()
+        self._thread.join()
 
 
 class DQN(nn.Module):
@@ -76,67 +717,190 @@ class DQN(nn.Module):
         return (F.tanh(self.layer5(x)))
 
 
+@contextlib.contextmanager
+def torchscript_warnings_ignored():
+    """ Ignores the deprecation warnings of TorchScript and quantization
+    within the context. Both are deprecated in favor of torch.compile and
+    torch.export, which need a compiler toolchain and take far longer to
+    start.
+    """
+    with warnings.catch_warnings():
+        for category in (DeprecationWarning, FutureWarning, UserWarning):
+            warnings.simplefilter('ignore', category)
+        yield
+
+
+def compile_model(net, backend):
+    """ Returns net prepared for inference with the backend, one of
+    INFERENCE_BACKENDS. The compiled model takes the same input as net,
+    but the frozen and quantized backends copy the weights, so it must
+    be compiled again after they change. Raises ValueError for an unknown
+    backend, or for the quantized backend if net is not on the CPU.
+    """
+    if backend not in INFERENCE_BACKENDS:
+        raise ValueError('Unknown inference backend {!r}, expected one '
+                         'of {}.'.format(backend,
+                                         ', '.join(INFERENCE_BACKENDS)))
+    net.eval()
+    if backend == 'eager':
+        return net
+    net_device = next(net.parameters()).device
+    example = torch.zeros((1, 32), device=net_device)
+    with torchscript_warnings_ignored():
+        with torch.no_grad():
+            if backend == 'quantized':
+                if net_device.type != 'cpu':
+                    raise ValueError('The quantized backend only runs on '
+                                     'the CPU.')
+                # Activations are quantized on the fly for each batch.
+                net = torch.ao.quantization.quantize_dynamic(
+                    copy.deepcopy(net), {nn.Linear}, dtype=torch.qint8)
+            traced = torch.jit.trace(net, example)
+        if backend == 'script':
+            return traced
+        if backend == 'quantized':
+            # The fusions of optimize_for_inference do not apply to the
+            # quantized layers and slow down large batches.
+            return torch.jit.freeze(traced)
+        return torch.jit.optimize_for_inference(traced)
+
+
+def set_inference_threads(intra_op, inter_op):
+    """ Sets the threads torch uses within and across operations, leaving
+    either unchanged if it is None. The inter-op threads can only be
+    changed before any inference has run in the process.
+    """
+    if intra_op is not None:
+        torch.set_num_threads(intra_op)
+    if inter_op is not None and torch.get_num_interop_threads() != inter_op:
+        torch.set_num_interop_threads(inter_op)
+
+
+@functools.lru_cache(maxsize=None)
+def load_inference_model(path, backend):
+    """ Returns the DQN with the weights saved at path, compiled for the
+    backend, or the TorchScript model saved at path by export.py if the
+    backend is 'exported'. The file is only read and compiled once per
+    process, and the model is shared by every caller.
+    """
+    if backend == 'exported':
+        with torchscript_warnings_ignored():
+            return torch.jit.load(path, map_location=device)
+    net = DQN().to(device)
+    net.load_state_dict(torch.load(path, map_location=device))
+    return compile_model(net, backend)
+
+
+def load_inference_player(verbose=False,
+                          path=None,
+                          backend=None,
+                          intra_op_threads=None,
+                          inter_op_threads=None):
+    """ Returns a ModelPlayer for playing with the model saved at path,
+    loaded as by load_inference_model, after setting the threads of the
+    process. Arguments that are None are taken from PATH,
+    INFERENCE_BACKEND, INTRA_OP_THREADS and INTER_OP_THREADS when called.
+    """
+    if path is None:
+        path = PATH
+    if backend is None:
+        backend = INFERENCE_BACKEND
+    if intra_op_threads is None:
+        intra_op_threads = INTRA_OP_THREADS
+    if inter_op_threads is None:
+        inter_op_threads = INTER_OP_THREADS
+    set_inference_threads(intra_op_threads, inter_op_threads)
+    return ModelPlayer(verbose, load_inference_model(path, backend))
+
+
 class ModelPlayer(checkers.players.Player):
     """ This subclass uses the provided neural network to decide on the
     next move to be played.
     """
     name = 'AI Player'
 
-    def __init__(self, verbose):
+    def __init__(self, verbose, model=None):
+        """ The player uses model, a DQN or one compiled by compile_model,
+        or a new DQN if it is None.
+        """
         self.gamestate = None
         self.verbose = verbose
-        self.model = DQN().to(device)
-    
+        self.model = DQN().to(device) if model is None else model
+        self.allocate_buffers()
+
+    def compile(self, backend):
+        """ Replaces the model with a copy compiled for the backend, after
+        which its weights are no longer trained or loaded.
+        """
+        self.model = compile_model(self.model, backend)
+
+    def allocate_buffers(self):
+        """ Allocates the tensors reused by orient_board and get_mask,
+        along with numpy views of them that are written to directly.
+        """
+        self.board_buffer = torch.empty((1, 32), dtype=torch.float32)
+        self.mask_buffer = torch.empty((1, 128), dtype=torch.int64)
+        self._board_array = self.board_buffer.numpy()[0]
+        self._mask_array = self.mask_buffer.numpy()[0]
+
     def to_tuple(self, index):
         """ This method takes in a 2d tensor containing the index of a
         move and converts it into a tuple containing the move used by
         the checkers package.
         """
-        pos = int(index.item() // 4)
-        dir = int(index.item() % 4)
-        return (pos, dir)
+        return MOVE_TUPLES[index.item()]
 
     def orient_board(self):
         """ The model always takes in a board from team 1 perspective.
         If the model is playing for team 2, it must reverse the board to
-        appear as the same state but for team 1.
+        appear as the same state but for team 1. The returned tensor is
+        overwritten by the next call, so it must be cloned to be kept.
         """
-        # FIXME: use numpy array for board?
-        board_tensor = torch.tensor([self.gamestate.board],
-                                    dtype=torch.float32,
-                                    device=device)
         if self.gamestate.turn == 1:
-            return board_tensor
+            self._board_array[:] = self.gamestate.board
         else:
-            board_tensor.mul_(-1)
-            return board_tensor.flip(1)
-    
+            self._board_array[::-1] = self.gamestate.board
+            np.negative(self._board_array, out=self._board_array)
+        if device.type == 'cpu':
+            return self.board_buffer
+        return self.board_buffer.to(device)
+
     def orient_move(self, move):
-        dir_translator = {0: 2,
-                           1: 3,
-                           2: 0,
-                           3: 1}
         if self.gamestate.turn == 1:
             return move
         else:
-            return (31 - move[0], dir_translator[move[1]])
-    
+            return (31 - move[0], DIR_TRANSLATOR[move[1]])
+
     def get_mask(self):
         """ This method returns a 2d array of values corresponding to
         valid moves. Invalid moves have -2, valid has 0. Can be added to
-        neural net output to mask out invalid moves.
-        """
-        valid_moves = self.gamestate.get_valid_moves()
-        valid_ind = []
-        for move in valid_moves:
-            if self.gamestate.turn == 1:
-                valid_ind.append(move[0]*4 + move[1])
-            else:
-                oriented_move = self.orient_move(move)
-                valid_ind.append(oriented_move[0]*4 + oriented_move[1])
-        mask = tuple(map(lambda s: s not in valid_ind, range(128)))
-        return torch.tensor([mask], dtype=torch.int64, device=device) * -2
-    
+        neural net output to mask out invalid moves. The returned tensor
+        is overwritten by the next call, so it must be cloned to be kept.
+        """
+        move_index = MOVE_INDEX[self.gamestate.turn]
+        self._mask_array.fill(-2)
+        self._mask_array[[move_index[4*pos + dir] for pos, dir
+                          in self.gamestate.get_valid_moves()]] = 0
+        if device.type == 'cpu':
+            return self.mask_buffer
+        return self.mask_buffer.to(device)
+
+    def evaluate(self, board_tensor):
+        """ Runs the model on an oriented board in inference mode,
+        recording the evaluation in the match statistics if they are
+        being collected.
+        """
+        stats = self.gamestate.stats
+        if stats is None:
+            with torch.inference_mode():
+                return self.model(board_tensor)
+        start = time.perf_counter()
+        with torch.inference_mode():
+            move_weights = self.model(board_tensor)
+        stats.model_evals += 1
+        stats.model_time += time.perf_counter() - start
+        return move_weights
+
     def get_next_turn(self):
         if self.gamestate.invalid_flag:
             print('Invalid last move.')
@@ -145,10 +909,9 @@ class ModelPlayer(checkers.players.Player):
             print('Last move: %s' % (self.gamestate.prev_move,))
 
         mask = self.get_mask()
-        with torch.no_grad():
-            move_weights = self.model(self.orient_board())
-            move_ind = (move_weights + mask).max(1, keepdim=True)[1]
-            chosen_move = self.orient_move(self.to_tuple(move_ind))
+        move_weights = self.evaluate(self.orient_board())
+        move_ind = (move_weights + mask).max(1, keepdim=True)[1]
+        chosen_move = self.orient_move(self.to_tuple(move_ind))
         return chosen_move
 
 
@@ -166,6 +929,7 @@ class TrainPlayer(ModelPlayer):
         self.verbose = verbose
         self.iters = 0
         self.temp_memory = [[], []]  # FIXME Tensor?
+        self.allocate_buffers()
 
         # Attempt to initialize model parameters from PATH
         self.model = DQN().to(device)
@@ -196,227 +960,911 @@ class TrainPlayer(ModelPlayer):
             print(self.gamestate.viz_board())
             print('Last move: %s' % (self.gamestate.prev_move,))
 
-        mask = self.get_mask()
-        # Compute current threshold of exponential distribution
-        exp_current = EXP_END + (EXP_START - EXP_END)\
-            * math.exp(-1 * self.iters / EXP_DECAY)
+        # The stored board and mask outlive the reused buffers.
+        mask = self.get_mask().clone()
+        board = self.orient_board().clone()
+        exp_current = exploration_threshold(self.iters)
         self.iters += 1
 
         if random.random() > exp_current:
-            with torch.no_grad():
-                move_weights = self.model(self.orient_board())
-                move_ind = (move_weights + mask).max(1, keepdim=True)[1]
-                chosen_move = self.orient_move(self.to_tuple(move_ind))
+            move_weights = self.evaluate(board)
+            move_ind = (move_weights + mask).max(1, keepdim=True)[1]
+            chosen_move = self.orient_move(self.to_tuple(move_ind))
         else:
             move_list = self.gamestate.get_valid_moves()
             chosen_move = move_list[random.randrange(len(move_list))]
-            move_ind = self.to_tensor(chosen_move)
+            move_ind = self.to_tensor(self.orient_move(chosen_move))
         if self.gamestate.turn == 1:
-            self.temp_memory[0].append((self.orient_board(), mask, move_ind))
+            self.temp_memory[0].append((board, mask, move_ind))
         else:
-            self.temp_memory[1].append((self.orient_board(), mask, move_ind))
+            self.temp_memory[1].append((board, mask, move_ind))
         return chosen_move
 
 
-model_player = TrainPlayer(False)
-validate_player = ModelPlayer(False)
-target_model = DQN().to(device)
-optimizer = optim.AdamW(model_player.model.parameters(), lr=LR, amsgrad=True)
-memory = ReplayMemory(25000)
+def exploration_threshold(iters):
+    """ Returns the probability of a random move after iters moves of
+    training, following the exponentially decaying schedule.
+    """
+    return EXP_END + (EXP_START - EXP_END) * math.exp(-1 * iters / EXP_DECAY)
 
 
-def optimize_model():
-    if len(memory) < BATCH_SIZE:
-        return
-    transitions = memory.sample(BATCH_SIZE)
+class LockstepSelfPlay():
+    """ Plays several games of self-play at once with the model and
+    exploration schedule of a TrainPlayer. Each step makes one move in
+    every active game, evaluating all their boards with a single forward
+    pass and choosing between the greedy and random moves for all games
+    at once. The moves are stored in the same per team layout as the
+    temp_memory of the TrainPlayer, and turned into transitions by
+    game_transitions once a game ends.
+    """
+    def __init__(self, player, parallel_games, recorder=None):
+        """ The player is the TrainPlayer whose model is used and whose
+        iters attribute is advanced by one per move made. Up to
+        parallel_games games are played at once. If a recorder such as a
+        GameWriter is given, finished games are written to it.
+        """
+        self.player = player
+        self.parallel_games = parallel_games
+        self.recorder = recorder
 
-    batch = Transition(*zip(*transitions))
+    def _new_game(self):
+        return {'gamestate': checkers.game.Gamestate(),
+                'temp_memory': [[], []],
+                'moves': []}
 
-    non_final_mask = torch.tensor(tuple(map(lambda s: s is not None,
-                                            batch.next_state)),
-                                  dtype=torch.bool,
-                                  device=device)
-    next_states = torch.cat([s for s in batch.next_state if s is not None])
-    state_batch = torch.cat(batch.state)
-    mask_batch = torch.cat([s for s in batch.mask if s is not None])
-    action_batch = torch.cat(batch.action)
-    reward_batch = torch.cat(batch.reward)
-
-    q_values = model_player.model(state_batch).gather(1, action_batch)
-
-    v_values = torch.zeros(BATCH_SIZE, device=device)
-    with torch.no_grad():
-        v_values[non_final_mask] = (target_model(next_states)
-                                    + mask_batch).max(1)[0]
-
-    expected_q_values = (v_values * GAMMA) + reward_batch
-
-    criterion = nn.SmoothL1Loss()
-    loss = criterion(q_values, expected_q_values.unsqueeze(1))
-
-    optimizer.zero_grad()
-    loss.backward()
-
-    torch.nn.utils.clip_grad_value_(model_player.model.parameters(), 100)
-    optimizer.step()
-
-    return loss.item()
-
-
-def plot_loss(prev_points, new_points, final=False):
-    ALPHA = 0.002
-    plt.clf()
-    plt.xlabel('Episodes')
-    plt.ylabel('Loss')
-    if not final:
-        plt.title('Training')
-        for point in new_points:
-            if not prev_points:
-                prev_points.append(point)
-            else:
-                prev_points.append(ALPHA * point + (1 - ALPHA) * prev_points[-1])
-        if len(prev_points) >= 10000:
-            plt.xlim(left=len(prev_points) - 10000, right=len(prev_points))
-        plt.plot(prev_points)
-        plt.pause(1)
-        return prev_points
+    def games(self, game_count):
+        """ Plays game_count games, yielding (transitions, match_result)
+        for each game as it finishes, where transitions are the tensors
+        returned by game_transitions and match_result is as returned by
+        CheckersMatch.match_loop for a single game.
+        """
+        active = [self._new_game()
+                  for ind in range(min(game_count, self.parallel_games))]
+        started = len(active)
+        while active:
+            count = len(active)
+            boards = []
+            mask_rows = []
+            mask_cols = []
+            for row, game in enumerate(active):
+                gamestate = game['gamestate']
+                if gamestate.turn == 1:
+                    boards.append(gamestate.board)
+                else:
+                    boards.append([-piece for piece in gamestate.board[::-1]])
+                for pos, dir in gamestate.get_valid_moves():
+                    mask_rows.append(row)
+                    mask_cols.append(
+                        MOVE_INDEX[gamestate.turn][4*pos + dir])
+            states = torch.tensor(boards, dtype=torch.float32, device=device)
+            masks = torch.full((count, 128), -2,
+                               dtype=torch.int64,
+                               device=device)
+            masks[mask_rows, mask_cols] = 0
+
+            thresholds = torch.tensor(
+                [exploration_threshold(self.player.iters + ind)
+                 for ind in range(count)],
+                device=device)
+            self.player.iters += count
+            explore = torch.rand(count, device=device) <= thresholds
+            with torch.no_grad():
+                greedy = (self.player.model(states) + masks).max(1)[1]
+            random_moves = torch.multinomial((masks == 0).to(torch.float32),
+                                             1).view(-1)
+            actions = torch.where(explore, random_moves, greedy)
+
+            still_active = []
+            for row, (game, action) in enumerate(zip(active,
+                                                     actions.tolist())):
+                gamestate = game['gamestate']
+                team = 0 if gamestate.turn == 1 else 1
+                game['temp_memory'][team].append(
+                    (states[row:row + 1].clone(),
+                     masks[row:row + 1].clone(),
+                     actions[row:row + 1].view(1, 1).clone()))
+                gamestate.update(
+                    MOVE_TUPLES[MOVE_INDEX[gamestate.turn][action]])
+                if gamestate.cont is None:
+                    game['moves'].append(gamestate.prev_move)
+
+                result = gamestate.is_game_over()
+                if result == 2:
+                    still_active.append(game)
+                    continue
+                match_result = (float(result == 1) + 0.5 * (result == 0),
+                                float(result == -1) + 0.5 * (result == 0),
+                                int(result == 1),
+                                int(result == -1),
+                                int(result == 0))
+                if self.recorder is not None:
+                    self.recorder.write(game['moves'],
+                                        result,
+                                        self.player.name,
+                                        self.player.name)
+                yield (game_transitions(game['temp_memory'], match_result),
+                       match_result)
+                if started < game_count:
+                    still_active.append(self._new_game())
+                    started += 1
+            active = still_active
+
+
+def validation_scores(state_dict, game_count, opponents, backend=None):
+    """ Plays a ModelPlayer with the weights in state_dict, compiled for
+    the inference backend or INFERENCE_BACKEND if it is None, against
+    each of the opponents, named by keys of OPPONENTS, for game_count
+    games as each team. Returns a dictionary of the total score against
+    each.
+    """
+    player = load_model_player(state_dict, backend)
+    scores = {}
+    for name in opponents:
+        opponent = OPPONENTS[name](False)
+        checkers_match = checkers.game.CheckersMatch(player,
+                                                     opponent,
+                                                     game_count,
+                                                     False)
+        score = checkers_match.match_loop()[0]
+        checkers_match = checkers.game.CheckersMatch(opponent,
+                                                     player,
+                                                     game_count,
+                                                     False)
+        scores[name] = score + checkers_match.match_loop()[1]
+    return scores
+
+
+def print_validation(generation, game_count, scores):
+    if generation is None:
+        print('Validation out of {} games:'.format(game_count * 2))
+    else:
+        print('Validation of generation {} out of {} games:'.format(
+            generation, game_count * 2))
+    print(', '.join('{}: {}'.format(name.capitalize(), score)
+                    for name, score in scores.items()) + '\n')
+
+
+def validate_model(state_dict, game_count, opponents=None):
+    """ Validates the weights in state_dict in this process against the
+    opponents, VALIDATION_OPPONENTS if None, printing and returning the
+    scores.
+    """
+    if opponents is None:
+        opponents = VALIDATION_OPPONENTS
+    scores = validation_scores(state_dict, game_count, opponents)
+    print_validation(None, game_count, scores)
+    return scores
+
+
+def log_validation(metrics_writer, generation, game_count, scores):
+    """ Logs validation scores as fractions of the games played, so that
+    validations of different lengths are comparable.
+    """
+    metrics_writer.log(generation,
+                       **{'validation_' + name: score / (2 * game_count)
+                          for name, score in scores.items()})
+
+
+def load_model_player(state_dict, backend=None):
+    """ Returns a ModelPlayer with the weights in state_dict, compiled for
+    the inference backend or INFERENCE_BACKEND if it is None.
+    """
+    player = ModelPlayer(False)
+    player.model.load_state_dict(state_dict)
+    player.compile(INFERENCE_BACKEND if backend is None else backend)
+    return player
+
+
+def sprt_validate(state_dict, opponent, workers=None):
+    """ Tests the weights in state_dict against the opponent, a key of
+    OPPONENTS, with a sequential probability ratio test, playing games in
+    workers processes, VALIDATION_WORKERS if None, if there is more than
+    one. Prints and returns the SPRTResult.
+    """
+    if workers is None:
+        workers = VALIDATION_WORKERS
+    player_factory = functools.partial(
+        load_model_player, snapshot(state_dict), INFERENCE_BACKEND)
+    test_args = (player_factory,
+                 OPPONENTS[opponent],
+                 SPRT_ELO_0,
+                 SPRT_ELO_1,
+                 SPRT_ALPHA,
+                 SPRT_BETA,
+                 SPRT_MAX_GAMES)
+    if workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(
+                workers,
+                mp_context=torch.multiprocessing.get_context('spawn'),
+                initializer=_init_validation_worker,
+                initargs=(INTRA_OP_THREADS, INTER_OP_THREADS)) as executor:
+            result = checkers.sprt.sprt_match(*test_args,
+                                              executor=executor,
+                                              parallel_games=workers)
+    else:
+        result = checkers.sprt.sprt_match(*test_args)
+    print('SPRT against {}: {} after {} games (+{} ={} -{}), '
+          'confidence {:.3f}, Elo {:+.0f} +/- {:.0f}'.format(
+              opponent, result.decision, result.games, result.wins,
+              result.draws, result.losses, result.confidence, result.elo,
+              result.elo_margin))
+    return result
+
+
+def _init_validation_worker(intra_op_threads, inter_op_threads):
+    set_inference_threads(intra_op_threads, inter_op_threads)
+
+
+class BackgroundValidator():
+    """ Validates snapshots of the weights in separate processes while
+    training continues. Results are printed as they arrive, tagged with
+    the generation the weights were taken from, and collected in the
+    results attribute as (generation, scores) pairs. Given a
+    MetricsWriter, they are also logged to it. The game count, opponents
+    and workers default to VALIDATION_GAMES, VALIDATION_OPPONENTS and
+    VALIDATION_WORKERS when None.
+    """
+    def __init__(self,
+                 game_count=None,
+                 opponents=None,
+                 workers=None,
+                 metrics_writer=None):
+        if game_count is None:
+            game_count = VALIDATION_GAMES
+        if opponents is None:
+            opponents = VALIDATION_OPPONENTS
+        if workers is None:
+            workers = VALIDATION_WORKERS
+        self.game_count = game_count
+        self.metrics_writer = metrics_writer
+        self.opponents = tuple(opponents)
+        self.results = []
+        self._results_lock = threading.Lock()
+        self._executor = concurrent.futures.ProcessPoolExecutor(
+            workers,
+            mp_context=torch.multiprocessing.get_context('spawn'),
+            initializer=_init_validation_worker,
+            initargs=(INTRA_OP_THREADS, INTER_OP_THREADS))
+
+    def submit(self, generation, state_dict):
+        """ Starts validating a copy of the weights in state_dict. """
+        future = self._executor.submit(
+            validation_scores,
+            snapshot(state_dict),
+            self.game_count,
+            self.opponents,
+            INFERENCE_BACKEND)
+        future.add_done_callback(
+            lambda done: self._report(generation, done))
+
+    def _report(self, generation, future):
+        try:
+            scores = future.result()
+        except Exception as error:
+            print('Validation of generation {} failed: {!r}'.format(
+                generation, error))
+            return
+        with self._results_lock:
+            self.results.append((generation, scores))
+        print_validation(generation, self.game_count, scores)
+        if self.metrics_writer is not None:
+            log_validation(self.metrics_writer,
+                           generation,
+                           self.game_count,
+                           scores)
+
+    def close(self):
+        """ Waits for the submitted validations to finish and be
+        reported.
+        """
+        self._executor.shutdown(wait=True)
+
+
+def game_transitions(temp_memory, match_result):
+    """ Turns the moves stored by a TrainPlayer over a game of self-play
+    into transitions for both teams at once, returned in the compact
+    storage format taken by ReplayMemory.push_batch. Every move but the
+    last of a team is rewarded with the step reward of the team's result
+    and the last with its full reward. Each transition holds the
+    discounted return of the rewards of the next N_STEP moves of the
+    team and the state after them, or the return to the end of the game
+    if N_STEP is None; Trainer.optimize_model discounts the value of that
+    state by GAMMA ** N_STEP.
+    """
+    if match_result[2] == 1:
+        results = ((WIN_STEP, WIN_REWARD), (LOSS_STEP, LOSS_REWARD))
+    elif match_result[3] == 1:
+        results = ((LOSS_STEP, LOSS_REWARD), (WIN_STEP, WIN_REWARD))
     else:
-        plt.title('Final Results')
-        plt.xlim(left=0, right=len(prev_points))
-        plt.plot(prev_points)
-        plt.show()
-
-
-def validate_model(game_count):
-    validate_player.model.load_state_dict(model_player.model.state_dict())
-    
-    random_player = checkers.players.RandomPlayer(False)
-    easy_player = checkers.players.EasyPlayer(False)
-    medium_player = checkers.players.MediumPlayer(False)
-
-    random_score = 0
-    checkers_match = checkers.game.CheckersMatch(validate_player,
-                                                 random_player,
-                                                 game_count,
-                                                 False)
-    result = checkers_match.match_loop()
-    random_score += result[0]
-    checkers_match = checkers.game.CheckersMatch(random_player,
-                                                 validate_player,
-                                                 game_count,
-                                                 False)
-    result = checkers_match.match_loop()
-    random_score += result[1]
-
-    easy_score = 0
-    checkers_match = checkers.game.CheckersMatch(validate_player,
-                                                 easy_player,
-                                                 game_count,
-                                                 False)
-    result = checkers_match.match_loop()
-    easy_score += result[0]
-    checkers_match = checkers.game.CheckersMatch(easy_player,
-                                                 validate_player,
-                                                 game_count,
-                                                 False)
-    result = checkers_match.match_loop()
-    easy_score += result[1]
-
-    medium_score = 0
-    checkers_match = checkers.game.CheckersMatch(validate_player,
-                                                 medium_player,
-                                                 game_count,
-                                                 False)
-    result = checkers_match.match_loop()
-    medium_score += result[0]
-    checkers_match = checkers.game.CheckersMatch(medium_player,
-                                                 validate_player,
-                                                 game_count,
-                                                 False)
-    result = checkers_match.match_loop()
-    medium_score += result[1]
-
-    print('Validation out of {} games:'. format(game_count * 2))
-    print('Random: {}, Easy: {}, Medium: {}\n'.format(random_score,
-                                                    easy_score,
-                                                    medium_score))
-
-
-# Training loop
-loss_list = []
-for generation in range(GENERATIONS):
-    new_loss_list = []
-    if generation % 25 == 0:
-        print('Generation: ({}/{})'.format(generation, GENERATIONS))
-        print('Validating...')
-        validate_model(5)
-    # Sync model parameters
-    target_model.load_state_dict(model_player.model.state_dict())
-    for game in range(GAMES_PER_GENERATION):
-        checkers_match = checkers.game.CheckersMatch(model_player,
-                                                     model_player,
+        results = ((DRAW_STEP, DRAW_REWARD), (DRAW_STEP, DRAW_REWARD))
+    lengths = [len(team_memory) for team_memory in temp_memory]
+    n_step = N_STEP or max(lengths)
+    moves = temp_memory[0] + temp_memory[1]
+    states = torch.cat([move[0] for move in moves])
+    masks = torch.cat([move[1] for move in moves])
+    actions = torch.cat([move[2] for move in moves]).view(-1)
+
+    # The rewards of each team are followed by n_step zeros, so that no
+    # return reaches into the moves of the other team.
+    rewards = torch.zeros(sum(lengths) + 2 * n_step, device=device)
+    rows = []
+    next_rows = []
+    non_final = []
+    start = 0
+    offset = 0
+    for length, (step_reward, last_reward) in zip(lengths, results):
+        rewards[start:start + length - 1] = step_reward
+        rewards[start + length - 1] = last_reward
+        moves_ahead = torch.arange(length, device=device) + n_step
+        rows.append(torch.arange(start, start + length, device=device))
+        next_rows.append(offset + moves_ahead.clamp(max=length - 1))
+        non_final.append(moves_ahead < length)
+        start += length + n_step
+        offset += length
+    discounts = GAMMA ** torch.arange(n_step, device=device)
+    returns = (rewards.unfold(0, n_step, 1) @ discounts)[torch.cat(rows)]
+    next_rows = torch.cat(next_rows)
+    non_final = torch.cat(non_final)
+    next_states = states[next_rows] * non_final.unsqueeze(1)
+    next_masks = masks[next_rows] * non_final.unsqueeze(1)
+    return (states.to(torch.int8).cpu(),
+            actions.to(torch.uint8).cpu(),
+            returns.to(torch.float32).cpu(),
+            next_states.to(torch.int8).cpu(),
+            pack_mask(next_masks).cpu(),
+            non_final.cpu())
+
+
+def pack_transitions(transitions):
+    """ Stacks a list of transitions, each a tuple of arguments for
+    ReplayMemory.push, into the compact tensors stored by ReplayMemory,
+    as arguments for ReplayMemory.push_batch. This is the form
+    game_transitions returns and transitions are sent in between
+    processes.
+    """
+    blank_state = torch.zeros((1, 32), device=device)
+    blank_mask = torch.zeros((1, 128), dtype=torch.int64, device=device)
+    states, actions, rewards, next_states, masks = zip(*transitions)
+    non_final = torch.tensor([s is not None for s in next_states],
+                             dtype=torch.bool)
+    next_states = [blank_state if s is None else s for s in next_states]
+    masks = [blank_mask if s is None else s for s in masks]
+    return (torch.cat(states).to(torch.int8).cpu(),
+            torch.cat(actions).view(-1).to(torch.uint8).cpu(),
+            torch.cat(rewards).to(torch.float32).cpu(),
+            torch.cat(next_states).to(torch.int8).cpu(),
+            pack_mask(torch.cat(masks)).cpu(),
+            non_final)
+
+
+def actor_loop(actor_id, shared_model, weight_version, iters,
+               transition_queue, stop_event, sync_interval, config):
+    """ Runs self-play games in an actor process until stop_event is set,
+    sending the packed transitions of each game to the learner through
+    transition_queue. Games are played in rounds of sync_interval games,
+    and the actor's model is reloaded from shared_model between rounds
+    when the learner has published new weights. The exploration schedule
+    follows the shared move counter iters, so it decays with the moves
+    made by all actors together. The constants of the learner are
+    applied from config, as the actor imports this module afresh.
+    """
+    configure(config)
+    torch.set_num_threads(1)
+    player = TrainPlayer(False)
+    local_version = None
+    game_writer = checkers.record.GameWriter(
+        '{}.{}'.format(GAME_RECORD_PATH, actor_id))
+    try:
+        while not stop_event.is_set():
+            if weight_version.value != local_version:
+                with weight_version.get_lock():
+                    player.model.load_state_dict(shared_model.state_dict())
+                    local_version = weight_version.value
+            start_iters = iters.value
+            player.iters = start_iters
+            for transitions, match_result in self_play_games(
+                    player, sync_interval, game_writer):
+                transition_queue.put(transitions)
+            with iters.get_lock():
+                iters.value += player.iters - start_iters
+    finally:
+        game_writer.close()
+
+
+def self_play_games(player, game_count, recorder):
+    """ Plays game_count games of the TrainPlayer player against itself,
+    yielding (transitions, match_result) as each game finishes. Games are
+    played SELF_PLAY_BATCH at a time with LockstepSelfPlay, or one at a
+    time through CheckersMatch if it is 1.
+    """
+    if SELF_PLAY_BATCH > 1:
+        yield from LockstepSelfPlay(player,
+                                    SELF_PLAY_BATCH,
+                                    recorder).games(game_count)
+        return
+    for game in range(game_count):
+        checkers_match = checkers.game.CheckersMatch(player,
+                                                     player,
                                                      1,
-                                                     False)
+                                                     False,
+                                                     recorder=recorder)
         match_result = checkers_match.match_loop()
-        if match_result[2] == 1:
-            reward_1 = WIN_STEP
-            reward_2 = LOSS_STEP
-            last_reward_1 = WIN_REWARD
-            last_reward_2 = LOSS_REWARD
-        elif match_result[3] == 1:
-            reward_1 = LOSS_STEP
-            reward_2 = WIN_STEP
-            last_reward_1 = LOSS_REWARD
-            last_reward_2 = WIN_REWARD
+        transitions = game_transitions(player.temp_memory, match_result)
+        player.temp_memory = [[], []]
+        yield transitions, match_result
+
+
+def snapshot(value):
+    """ Returns a copy of value, which may be nested in dictionaries,
+    lists and tuples, with every tensor detached and copied to the CPU.
+    The copy is unaffected by further training.
+    """
+    if isinstance(value, torch.Tensor):
+        return value.detach().to('cpu', copy=True)
+    if isinstance(value, dict):
+        return {key: snapshot(entry) for key, entry in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(snapshot(entry) for entry in value)
+    return value
+
+
+class CheckpointWriter():
+    """ Writes training states to a checkpoint file from a background
+    thread, so that training does not wait on the disk. Each state is
+    written to a temporary file that then replaces the checkpoint, so the
+    checkpoint is always complete. If a new state is saved before the
+    previous one has been written, only the newest is written.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._pending = None
+        self._closed = False
+        self._error = None
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    def _write_loop(self):
+        while True:
+            with self._condition:
+                while self._pending is None and not self._closed:
+                    self._condition.wait()
+                if self._pending is None:
+                    return
+                state = self._pending
+                self._pending = None
+            temp_path = self.path + '.tmp'
+            try:
+                torch.save(state, temp_path)
+                os.replace(temp_path, self.path)
+            except OSError as error:
+                self._error = error
+
+    def _raise_error(self):
+        if self._error is not None:
+            error = self._error
+            self._error = None
+            raise error
+
+    def save(self, state):
+        """ Queues a state from training_state to be written. Raises any
+        error from writing a previous state.
+        """
+        self._raise_error()
+        with self._condition:
+            self._pending = state
+            self._condition.notify()
+
+    def close(self):
+        """ Waits for the last queued state to be written. """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+        self._raise_error()
+
+
+class LearnerSchedule():
+    """ Decides how many gradient steps the learner takes for each game
+    received. With a replay_ratio, it takes that many steps per
+    transition on average, carrying fractions of a step over to the next
+    game, so the transitions are each sampled about replay_ratio *
+    BATCH_SIZE * ACCUMULATION_STEPS times however fast games arrive.
+    Otherwise it takes steps_per_game steps per game.
+    """
+    def __init__(self, replay_ratio, steps_per_game):
+        self.replay_ratio = replay_ratio
+        self.steps_per_game = steps_per_game
+        self.owed = 0.0
+
+    def steps(self, transitions):
+        """ Returns the steps to take for a game of transitions
+        transitions.
+        """
+        if self.replay_ratio is None:
+            return self.steps_per_game
+        self.owed += self.replay_ratio * transitions
+        steps = int(self.owed)
+        self.owed -= steps
+        return steps
+
+
+class Trainer():
+    """ Owns the state of a training run; the TrainPlayer whose model is
+    trained, the target model, the optimizer and the replay memory. They
+    are built from the module constants when the Trainer is created, so
+    configure should be called before.
+    """
+    def __init__(self):
+        self.model_player = TrainPlayer(False)
+        self.target_model = DQN().to(device)
+        self.optimizer = optim.AdamW(self.model_player.model.parameters(),
+                                     lr=LR,
+                                     amsgrad=True)
+        self.memory = make_replay_memory()
+        self.prefetcher = None
+        self.schedule = LearnerSchedule(REPLAY_RATIO, STEPS_PER_GAME)
+        # Gradient steps taken and the seconds spent taking them.
+        self.steps = 0
+        self.learner_time = 0.0
+        self._logged = (0, 0.0)
+
+    @property
+    def replay(self):
+        """ The prefetcher while one is running and otherwise the replay
+        memory, through which transitions are pushed and priorities
+        updated.
+        """
+        return self.memory if self.prefetcher is None else self.prefetcher
+
+    def start_prefetching(self, depth):
+        """ Samples the batches of optimize_model ahead in a background
+        BatchPrefetcher holding up to depth of them.
+        """
+        self.prefetcher = BatchPrefetcher(self.memory, BATCH_SIZE, depth)
+        self._prefetch_counts = (0, 0)
+
+    def stop_prefetching(self):
+        """ Stops the BatchPrefetcher started by start_prefetching. """
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+            self.prefetcher = None
+
+    def next_batch(self):
+        """ Returns the next Batch to train on, or None if the memory
+        holds fewer than BATCH_SIZE transitions.
+        """
+        if self.prefetcher is not None:
+            return self.prefetcher.get()
+        if len(self.memory) < BATCH_SIZE:
+            return None
+        return self.memory.sample(BATCH_SIZE)
+
+    def batch_loss(self, batch):
+        """ Returns the loss of the model on batch, updating the
+        priorities of its transitions in a prioritized memory.
+        """
+        q_values = self.model_player.model(batch.state).gather(1,
+                                                               batch.action)
+
+        with torch.no_grad():
+            v_values = (self.target_model(batch.next_state)
+                        + batch.mask).max(1)[0]
+        v_values = torch.where(batch.non_final, v_values, 0)
+
+        expected_q_values = (v_values * GAMMA ** (N_STEP or 1)
+                             + batch.reward)
+
+        if batch.weights is None:
+            criterion = nn.SmoothL1Loss()
+            loss = criterion(q_values, expected_q_values.unsqueeze(1))
         else:
-            reward_1 = DRAW_STEP
-            reward_2 = DRAW_STEP
-            last_reward_1 = DRAW_REWARD
-            last_reward_2 = DRAW_REWARD
-        reward_1 = torch.tensor([reward_1],
-                                dtype=torch.int64,
-                                device=device)
-        last_reward_1 = torch.tensor([last_reward_1],
-                                     dtype=torch.int64,
-                                     device=device)
-        reward_2 = torch.tensor([reward_2],
-                                dtype=torch.int64,
-                                device=device)
-        last_reward_2 = torch.tensor([last_reward_2],
-                                     dtype=torch.int64,
-                                     device=device)
-
-        for ind in range(len(model_player.temp_memory[0]) - 1):
-            memory.push(model_player.temp_memory[0][ind][0],
-                        model_player.temp_memory[0][ind][2],
-                        reward_1,
-                        model_player.temp_memory[0][ind + 1][0],
-                        model_player.temp_memory[0][ind + 1][1])
-        memory.push(model_player.temp_memory[0][-1][0],
-                    model_player.temp_memory[0][-1][2],
-                    last_reward_1,
-                    None,
-                    None)
-        for ind in range(len(model_player.temp_memory[1]) - 1):
-            memory.push(model_player.temp_memory[1][ind][0],
-                        model_player.temp_memory[1][ind][2],
-                        reward_2,
-                        model_player.temp_memory[1][ind + 1][0],
-                        model_player.temp_memory[1][ind + 1][1])
-        memory.push(model_player.temp_memory[1][-1][0],
-                    model_player.temp_memory[1][-1][2],
-                    last_reward_2,
-                    None,
-                    None)
-        model_player.temp_memory = [[], []]
-
-        new_loss = optimize_model()
-        if new_loss is not None:
-            new_loss_list.append(new_loss)
-    loss_list = plot_loss(loss_list, new_loss_list, False)
-
-torch.save(model_player.model.state_dict(), PATH)
-print('Running final validation...')
-validate_model(50)
-plt.ioff()
-plot_loss(loss_list, [], True)
+            losses = F.smooth_l1_loss(q_values,
+                                      expected_q_values.unsqueeze(1),
+                                      reduction='none')
+            loss = (losses.view(-1) * batch.weights).mean()
+            self.replay.update_priorities(
+                batch.indices, q_values.view(-1) - expected_q_values)
+        return loss
+
+    def optimize_model(self):
+        """ Takes a gradient step on ACCUMULATION_STEPS batches, syncing
+        the target model every TARGET_SYNC_STEPS steps. Returns the mean
+        loss of the batches, or None if the memory holds too few
+        transitions to sample them.
+        """
+        if len(self.memory) < BATCH_SIZE:
+            return
+        self.optimizer.zero_grad()
+        total_loss = 0
+        # The memory only grows, so every batch can be sampled.
+        for accumulation in range(ACCUMULATION_STEPS):
+            loss = self.batch_loss(self.next_batch()) / ACCUMULATION_STEPS
+            loss.backward()
+            total_loss += loss.item()
+        self.reduce_gradients()
+
+        torch.nn.utils.clip_grad_value_(self.model_player.model.parameters(),
+                                        100)
+        self.optimizer.step()
+        self.steps += 1
+        if (TARGET_SYNC_STEPS is not None
+                and self.steps % TARGET_SYNC_STEPS == 0):
+            self.target_model.load_state_dict(self.state_dict())
+
+        return total_loss
+
+    def reduce_gradients(self):
+        """ Combines the gradients of a step before they are applied;
+        subclasses training in several processes average them here.
+        """
+
+    def optimize_steps(self, steps, losses):
+        """ Takes steps gradient steps, appending their losses to the list
+        losses.
+        """
+        start = time.perf_counter()
+        for step in range(steps):
+            loss = self.optimize_model()
+            if loss is not None:
+                losses.append(loss)
+        self.learner_time += time.perf_counter() - start
+
+    def training_state(self, generation):
+        """ Returns a snapshot of everything needed to continue training
+        at the start of the given generation.
+        """
+        rng = {'random': random.getstate(),
+               'numpy': np.random.get_state(),
+               'torch': torch.get_rng_state()}
+        if torch.cuda.is_available():
+            rng['cuda'] = torch.cuda.get_rng_state_all()
+        return snapshot({'generation': generation,
+                         'model': self.model_player.model.state_dict(),
+                         'target_model': self.target_model.state_dict(),
+                         'optimizer': self.optimizer.state_dict(),
+                         'iters': self.model_player.iters,
+                         'steps': self.steps,
+                         'owed_steps': self.schedule.owed,
+                         'memory': self.memory.state_dict(),
+                         'rng': rng})
+
+    def load_checkpoint(self, path):
+        """ Restores the training state saved at path by a
+        CheckpointWriter. Returns the generation to continue from.
+        """
+        state = torch.load(path, map_location=device, weights_only=False)
+        self.model_player.model.load_state_dict(state['model'])
+        self.target_model.load_state_dict(state['target_model'])
+        self.optimizer.load_state_dict(state['optimizer'])
+        self.model_player.iters = state['iters']
+        # Checkpoints written before steps were counted lack them.
+        self.steps = state.get('steps', 0)
+        self.schedule.owed = state.get('owed_steps', 0.0)
+        self._logged = (self.steps, self.learner_time)
+        self.memory.load_state_dict(state['memory'])
+        random.setstate(state['rng']['random'])
+        np.random.set_state(state['rng']['numpy'])
+        torch.set_rng_state(state['rng']['torch'])
+        if 'cuda' in state['rng'] and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(state['rng']['cuda'])
+        print('Resuming from generation {}.'.format(state['generation']))
+        return state['generation']
+
+    def state_dict(self):
+        """ Returns the current weights of the trained model. """
+        return self.model_player.model.state_dict()
+
+    def log_generation(self, metrics_writer, generation, losses, start_time,
+                       transitions, separate_actors):
+        """ Logs the metrics of a finished generation; its mean loss, the
+        exploration rate reached, the self-play games played and replay
+        samples trained on per second, and while prefetching, the
+        fraction of batches the learner had to wait for. The throughput
+        of the learner and of self-play are also logged separately. The
+        learner's counts only the time spent taking gradient steps. The
+        actors' counts the transitions received over the rest of the
+        generation, or over all of it with separate_actors.
+        """
+        elapsed = time.time() - start_time
+        steps = self.steps - self._logged[0]
+        learner_time = self.learner_time - self._logged[1]
+        self._logged = (self.steps, self.learner_time)
+        samples = steps * BATCH_SIZE * ACCUMULATION_STEPS
+        actor_time = elapsed if separate_actors else elapsed - learner_time
+        starvation = None
+        if self.prefetcher is not None:
+            requested = self.prefetcher.requested - self._prefetch_counts[0]
+            starved = self.prefetcher.starved - self._prefetch_counts[1]
+            self._prefetch_counts = (self.prefetcher.requested,
+                                     self.prefetcher.starved)
+            if requested:
+                starvation = starved / requested
+        metrics_writer.log(
+            generation,
+            loss=sum(losses) / len(losses) if losses else None,
+            epsilon=exploration_threshold(self.model_player.iters),
+            games_per_second=GAMES_PER_GENERATION / elapsed,
+            samples_per_second=samples / elapsed,
+            prefetch_starvation=starvation,
+            learner_steps_per_second=(steps / learner_time
+                                      if steps else None),
+            learner_samples_per_second=(samples / learner_time
+                                        if steps else None),
+            actor_transitions_per_second=transitions / actor_time,
+            iters=self.model_player.iters,
+            replay_size=len(self.memory))
+
+    def make_validator(self, metrics_writer):
+        """ Returns the validator that the weights are submitted to every
+        VALIDATION_INTERVAL generations, logging to metrics_writer.
+        """
+        return BackgroundValidator(VALIDATION_GAMES,
+                                   VALIDATION_OPPONENTS,
+                                   VALIDATION_WORKERS,
+                                   metrics_writer)
+
+    def _start(self, resume):
+        start_generation = 0
+        if resume:
+            start_generation = self.load_checkpoint(CHECKPOINT_PATH)
+        metrics_writer = training_metrics.MetricsWriter(METRICS_PATH)
+        if PREFETCH_BATCHES > 0:
+            self.start_prefetching(PREFETCH_BATCHES)
+        return (start_generation,
+                CheckpointWriter(CHECKPOINT_PATH),
+                metrics_writer,
+                self.make_validator(metrics_writer))
+
+    def _finish(self, metrics_writer):
+        self.stop_prefetching()
+        torch.save(self.state_dict(), PATH)
+        if isinstance(self.memory, DiskReplayMemory):
+            self.memory.flush()
+        print('Running final validation...')
+        scores = validate_model(self.state_dict(), 50, VALIDATION_OPPONENTS)
+        log_validation(metrics_writer, GENERATIONS, 50, scores)
+        metrics_writer.close()
+
+    def train(self, resume=False):
+        """ Trains the model, alternating between self-play games and
+        optimization steps in a single process. A checkpoint is written
+        every CHECKPOINT_INTERVAL generations; with resume, training
+        continues from the checkpoint exactly as the interrupted run
+        would have, unless PREFETCH_BATCHES or REPLAY_PATH is set.
+        """
+        (start_generation,
+         checkpoint_writer,
+         metrics_writer,
+         validator) = self._start(resume)
+        game_writer = checkers.record.GameWriter(GAME_RECORD_PATH)
+        for generation in range(start_generation, GENERATIONS):
+            start_time = time.time()
+            new_loss_list = []
+            transition_count = 0
+            if generation % VALIDATION_INTERVAL == 0:
+                print('Generation: ({}/{})'.format(generation, GENERATIONS))
+                validator.submit(generation, self.state_dict())
+            if TARGET_SYNC_STEPS is None:
+                # Sync model parameters
+                self.target_model.load_state_dict(self.state_dict())
+            for transitions, match_result in self_play_games(
+                    self.model_player, GAMES_PER_GENERATION, game_writer):
+                self.replay.push_batch(*transitions)
+                transition_count += len(transitions[0])
+                self.optimize_steps(self.schedule.steps(len(transitions[0])),
+                                    new_loss_list)
+            self.log_generation(metrics_writer,
+                                generation,
+                                new_loss_list,
+                                start_time,
+                                transition_count,
+                                False)
+            game_writer.flush()
+            if (generation + 1) % CHECKPOINT_INTERVAL == 0:
+                checkpoint_writer.save(self.training_state(generation + 1))
+
+        game_writer.close()
+        checkpoint_writer.close()
+        validator.close()
+        self._finish(metrics_writer)
+
+    def train_actor_learner(self,
+                            actor_count,
+                            sync_interval,
+                            queue_depth,
+                            resume=False):
+        """ Trains the model with self-play games generated by
+        actor_count actor processes, while this process is the learner
+        owning the replay memory and optimizer. Gradient steps are taken
+        for each game received as scheduled by the LearnerSchedule, as in
+        train. The learner publishes its weights to the actors every
+        sync_interval games, and at most queue_depth games wait in the
+        queue before the actors block.
+        Checkpoints are written and resumed as in train, though the games
+        played after resuming differ as the actors are not synchronized
+        with the learner.
+        """
+        (start_generation,
+         checkpoint_writer,
+         metrics_writer,
+         validator) = self._start(resume)
+        ctx = torch.multiprocessing.get_context('spawn')
+        shared_model = DQN()
+        shared_model.load_state_dict(self.state_dict())
+        shared_model.share_memory()
+        weight_version = ctx.Value('q', 0)
+        iters = ctx.Value('q', self.model_player.iters)
+        transition_queue = ctx.Queue(queue_depth)
+        stop_event = ctx.Event()
+        actors = [ctx.Process(target=actor_loop,
+                              args=(actor_id, shared_model, weight_version,
+                                    iters, transition_queue, stop_event,
+                                    sync_interval, current_config()),
+                              daemon=True)
+                  for actor_id in range(actor_count)]
+        for actor in actors:
+            actor.start()
+
+        games = 0
+        try:
+            for generation in range(start_generation, GENERATIONS):
+                start_time = time.time()
+                new_loss_list = []
+                transition_count = 0
+                if generation % VALIDATION_INTERVAL == 0:
+                    print('Generation: ({}/{})'.format(generation,
+                                                       GENERATIONS))
+                    validator.submit(generation, self.state_dict())
+                if TARGET_SYNC_STEPS is None:
+                    # Sync model parameters
+                    self.target_model.load_state_dict(self.state_dict())
+                for game in range(GAMES_PER_GENERATION):
+                    while True:
+                        try:
+                            packed = transition_queue.get(timeout=1)
+                            break
+                        except queue.Empty:
+                            if not any(actor.is_alive() for actor in actors):
+                                raise RuntimeError('All actors have exited.')
+                    self.replay.push_batch(*packed)
+                    transition_count += len(packed[0])
+                    self.optimize_steps(self.schedule.steps(len(packed[0])),
+                                        new_loss_list)
+                    games += 1
+                    if games % sync_interval == 0:
+                        with weight_version.get_lock():
+                            shared_model.load_state_dict(self.state_dict())
+                            weight_version.value += 1
+                self.model_player.iters = iters.value
+                self.log_generation(metrics_writer,
+                                    generation,
+                                    new_loss_list,
+                                    start_time,
+                                    transition_count,
+                                    True)
+                if (generation + 1) % CHECKPOINT_INTERVAL == 0:
+                    checkpoint_writer.save(
+                        self.training_state(generation + 1))
+        finally:
+            stop_event.set()
+            # Actors may be blocked on a full queue, so keep draining it.
+            # Games from actors that have already exited can no longer be
+            # received, as their tensors were shared through the actors.
+            while any(actor.is_alive() for actor in actors):
+                try:
+                    transition_queue.get(timeout=0.1)
+                except (queue.Empty, OSError):
+                    pass
+            for actor in actors:
+                actor.join()
+            self.stop_prefetching()
+            checkpoint_writer.close()
+            validator.close()
+        self.model_player.iters = iters.value
+        self._finish(metrics_writer)
+
+
+if __name__ == '__main__':
+    import train
+    train.main()
@@ -0,0 +1,221 @@
+"""Plays with trained weights using NumPy alone.
+
+The DQN is five dense layers, so playing with it needs nothing beyond
+matrix products. This module evaluates weights exported by export.py
+with --backend numpy without importing torch, which takes most of the
+startup time and memory of a process playing with the model module. It
+suits pools of processes playing matches, where every worker would
+otherwise import torch.
+
+Boards and moves are encoded as model.ModelPlayer encodes them, and the
+outputs match those of the DQN up to float32 rounding.
+
+Example Usage:
+    python export.py model_params.pt model_params.npz --backend numpy
+
+    player = NumpyPlayer(path='model_params.npz')
+    factory = functools.partial(NumpyPlayer, False, 'model_params.npz')
+
+Classes:
+    NumpyDQN: Evaluates batches of boards with the weights of a DQN.
+    NumpyPlayer: Plays the move the network values most.
+    NumpyTreePlayer: Searches with the network scoring the leaves.
+
+Functions:
+    load_network: Returns the network saved at a path, loaded once.
+    encode: Encodes a position as the network sees it.
+"""
+
+import functools
+
+import numpy as np
+
+import checkers
+
+
+NUMPY_PATH = 'model_params.npz'
+# The names of the weights of each layer in order, as in the state dict
+# of the DQN.
+LAYERS = ('layer1', 'layer2', 'layer3', 'layer4', 'layer5')
+
+# As model.MOVE_INDEX: the network sees the board of team 2 reversed and
+# negated.
+MOVE_INDEX = checkers.game.MOVE_INDEX
+
+
+class NumpyDQN():
+    """Evaluates batches of boards with the weights of a DQN.
+
+    Attributes:
+        weights: A list of pairs of the transposed weight matrix and the
+            bias of each layer, as float32 arrays.
+    """
+
+    def __init__(self, arrays):
+        """Takes the weights of a DQN.
+
+        Args:
+            arrays: A mapping of the names of the DQN's state dict, such
+                as layer1.weight, to arrays, such as a loaded .npz file.
+        """
+
+        self.weights = [
+            (np.ascontiguousarray(arrays[name + '.weight'].T,
+                                  dtype=np.float32),
+             np.asarray(arrays[name + '.bias'], dtype=np.float32))
+            for name in LAYERS]
+
+    def __call__(self, boards):
+        """Returns the values of every move of boards, an array of shape
+        (n, 32) of oriented boards, as a float32 array of shape (n, 128).
+        """
+
+        x = np.asarray(boards, dtype=np.float32)
+        for weight, bias in self.weights[:-1]:
+            x = x @ weight
+            x += bias
+            np.maximum(x, 0, out=x)
+        weight, bias = self.weights[-1]
+        x = x @ weight
+        x += bias
+        return np.tanh(x, out=x)
+
+
+@functools.lru_cache(maxsize=None)
+def load_network(path):
+    """Returns the NumpyDQN saved at path by export.py. The file is only
+    read once per process, and the network is shared by every caller.
+    """
+
+    with np.load(path) as arrays:
+        return NumpyDQN(arrays)
+
+
+def encode(gamestate):
+    """Encodes a position as the network sees it.
+
+    Args:
+        gamestate: A Gamestate object.
+
+    Returns:
+        A pair of the board from the perspective of the team to move as a
+        float32 array of shape (32,), and a boolean array of shape (128,)
+        of the valid moves by the index the network gives them.
+    """
+
+    board = np.array(gamestate.board, dtype=np.float32)
+    if gamestate.turn == -1:
+        board = -board[::-1]
+    move_index = MOVE_INDEX[gamestate.turn]
+    valid = np.zeros(128, dtype=bool)
+    valid[[move_index[4*pos + dir]
+           for pos, dir in gamestate.get_valid_moves()]] = True
+    return board, valid
+
+
+class NumpyPlayer(checkers.players.Player):
+    """Plays the move the network values most, as model.ModelPlayer.
+
+    Attributes:
+        net: The NumpyDQN played with.
+    """
+
+    name = 'NumPy AI Player'
+
+    def __init__(self, verbose=False, path=NUMPY_PATH, net=None):
+        """Initializes the player.
+
+        Args:
+            verbose: See parent class.
+            path: The path of the weights, loaded if net is None.
+            net: A NumpyDQN to play with, or None.
+        """
+
+        self.gamestate = None
+        self.verbose = verbose
+        self.net = load_network(path) if net is None else net
+
+    def get_next_turn(self):
+        if self.gamestate.invalid_flag:
+            print('Invalid last move.')
+        elif self.verbose:
+            print(self.gamestate.viz_board())
+            print('Last move: %s' % (self.gamestate.prev_move,))
+
+        board, valid = encode(self.gamestate)
+        move_weights = self.net(board[np.newaxis])[0]
+        index = np.where(valid, move_weights, -2).argmax()
+        return divmod(MOVE_INDEX[self.gamestate.turn][index], 4)
+
+
+class NumpyTreePlayer(checkers.players.TreePlayer):
+    """Searches with the network scoring the leaves.
+
+    A leaf is worth the value of the best move for the team to move,
+    times value_scale, from the perspective of team 1 as the scores of
+    TreePlayer are. The leaves below each node of the last ply are
+    scored together in one batch.
+
+    Attributes:
+        net: The NumpyDQN scoring the leaves.
+        value_scale: The score of a leaf whose best move has value 1.
+        See parent class for the others.
+    """
+
+    name = 'NumPy Tree Player'
+    plys_ini = 2
+    plys_mid = 2
+    plys_late = 3
+    value_scale = 10
+
+    def __init__(self, verbose=False, path=NUMPY_PATH, net=None):
+        """Initializes the player.
+
+        Args:
+            verbose: See parent class.
+            path: The path of the weights, loaded if net is None.
+            net: A NumpyDQN to score with, or None.
+        """
+
+        super().__init__(verbose)
+        self.net = load_network(path) if net is None else net
+
+    def score_leaves(self, nodes):
+        """Scores nodes, a list of Node instances, with one evaluation.
+
+        Args:
+            nodes: The leaves to score.
+        """
+
+        encoded = [encode(node.gamestate) for node in nodes]
+        move_weights = self.net(np.stack([board for board, _ in encoded]))
+        valid = np.stack([valid for _, valid in encoded])
+        values = np.where(valid, move_weights, -2).max(1)
+        for node, value, node_valid in zip(nodes, values, valid):
+            if node.gamestate.stats is not None:
+                node.gamestate.stats.nodes_scored += 1
+            if node_valid.any():
+                node.score = node.gamestate.turn * self.value_scale * value
+            else:
+                node.score = -node.gamestate.turn * self.victory_score
+
+    def score_leaf(self, node):
+        self.score_leaves([node])
+
+    def gen_child_ply(self, node, plys):
+        if plys > 1 or node.child_ply:
+            return super().gen_child_ply(node, plys)
+        if node.gamestate.stats is not None:
+            node.gamestate.stats.nodes_expanded += 1
+        move_list = node.gamestate.get_full_moves()
+        if not move_list:
+            node.terminal = True
+            return [-1 * node.gamestate.turn * self.victory_score]
+        for move in move_list:
+            next_gamestate = node.gamestate.copy()
+            for ind in range(len(move) // 2):
+                next_gamestate.update(move[ind * 2:(ind+1) * 2])
+            node.child_ply[move] = checkers.players.Node(next_gamestate)
+        children = list(node.child_ply.values())
+        self.score_leaves(children)
+        return [child.score for child in children]
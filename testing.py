@@ -1,5 +1,25 @@
+import asyncio
+import concurrent.futures
+import functools
+import itertools
+import os
+import random
+import subprocess
+import sys
+import tempfile
 import unittest
+import benchmark
 import checkers
+import checkers.engine
+import checkers.server
+import distill
+import distributed
+import export
+import mcts
+import metrics
+import model
+import numpy_model
+import numpy as np
 import torch
 import matplotlib.pyplot as plt
 
@@ -276,6 +296,1038 @@ Team 2 turn.')
                                                            (17, 1),
                                                            (18, 1)])
 
+
+class TestStats(unittest.TestCase):
+    def test_move_times(self):
+        move_times = checkers.stats.MoveTimes()
+        self.assertEqual(move_times.percentile(0.5), 0.0)
+        move_times.add(0.0000005)
+        move_times.add(0.003)
+        move_times.add(100000.0)
+        self.assertEqual(move_times.count, 3)
+        self.assertEqual(move_times.buckets[0], 1)
+        self.assertEqual(move_times.buckets[12], 1)
+        self.assertEqual(move_times.buckets[-1], 1)
+        self.assertEqual(move_times.max, 100000.0)
+        self.assertEqual(move_times.percentile(0.5), 2 ** 12 / 1e6)
+
+    def test_match_stats(self):
+        test_match = checkers.game.CheckersMatch(
+            checkers.players.RandomPlayer(False),
+            checkers.players.EasyPlayer(False),
+            2,
+            False)
+        test_match.match_loop()
+        self.assertIsNone(test_match.stats)
+
+        test_match = checkers.game.CheckersMatch(
+            checkers.players.RandomPlayer(False),
+            checkers.players.EasyPlayer(False),
+            2,
+            False,
+            collect_stats=True)
+        test_match.match_loop()
+        stats = test_match.stats
+        self.assertEqual(stats.games, 2)
+        self.assertGreater(stats.plys, 0)
+        self.assertGreater(stats.valid_moves_calls, stats.full_moves_calls)
+        self.assertGreater(stats.copies, 0)
+        self.assertGreater(stats.nodes_expanded, 0)
+        self.assertGreater(stats.nodes_scored, stats.nodes_expanded)
+        self.assertIn(stats.max_search_depth, (2, 3))
+        self.assertGreaterEqual(stats.move_times[1].count,
+                                stats.plys // 2)
+        self.assertGreaterEqual(stats.move_times[-1].count,
+                                stats.plys // 2)
+        self.assertEqual(stats.model_evals, 0)
+        self.assertEqual(stats.as_dict()['games'], 2)
+
+
+class TestRecord(unittest.TestCase):
+    def test_encode_moves(self):
+        moves = ((10, 3), (22, 0), (13, 3, 22, 2), (31, 1))
+        encoded = checkers.record.encode_moves(moves)
+        self.assertEqual(len(encoded), 5)
+        self.assertEqual(checkers.record.decode_moves(encoded), moves)
+        self.assertEqual(checkers.record.decode_moves(b''), ())
+
+    def test_write_read(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'games.ckr')
+            with checkers.record.GameWriter(path) as writer:
+                test_match = checkers.game.CheckersMatch(
+                    checkers.players.RandomPlayer(False),
+                    checkers.players.RandomPlayer(False),
+                    3,
+                    False,
+                    recorder=writer,
+                    seed=7)
+                test_match.match_loop()
+            with checkers.record.GameWriter(path) as writer:
+                writer.write(((8, 3),), 0, 'First', 'Second')
+            records = list(checkers.record.read_games(path))
+            self.assertEqual(len(records), 4)
+            self.assertEqual([record.seed for record in records],
+                             [7, 8, 9, None])
+            self.assertEqual(records[3],
+                             (((8, 3),), 0, 'First', 'Second', None))
+            self.assertEqual(records[0].player_1, 'Random Player')
+            for record in records[:3]:
+                gamestate, move = list(
+                    checkers.record.replay(record.moves))[-1]
+                self.assertIsNone(move)
+                self.assertEqual(gamestate.is_game_over(), record.result)
+
+            # Games are reproducible from their seed.
+            with checkers.record.GameWriter(path) as writer:
+                test_match = checkers.game.CheckersMatch(
+                    checkers.players.RandomPlayer(False),
+                    checkers.players.RandomPlayer(False),
+                    1,
+                    False,
+                    recorder=writer,
+                    seed=8)
+                test_match.match_loop()
+            records = list(checkers.record.read_games(path))
+            self.assertEqual(records[4].moves, records[1].moves)
+
+            # A partially written game is ignored, then removed.
+            with open(path, 'ab') as record_file:
+                record_file.write(b'\x01\x00\x05')
+            self.assertEqual(len(list(checkers.record.read_games(path))), 5)
+            with checkers.record.GameWriter(path) as writer:
+                writer.write(((9, 2),), 1, 'First', 'Second')
+            records = list(checkers.record.read_games(path))
+            self.assertEqual(len(records), 6)
+            self.assertEqual(records[5].moves, ((9, 2),))
+
+    def test_long_names(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'games.ckr')
+            with checkers.record.GameWriter(path) as writer:
+                writer.write((), 0, 'é' * 200, 'Second')
+            record, = checkers.record.read_games(path)
+            self.assertEqual(record.player_1, 'é' * 127)
+            self.assertEqual(record.player_2, 'Second')
+
+    def test_truncated_header(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'games.ckr')
+            for contents in (b'', checkers.record.MAGIC):
+                with open(path, 'wb') as record_file:
+                    record_file.write(contents)
+                with self.assertRaises(ValueError):
+                    list(checkers.record.read_games(path))
+
+
+class TestEngine(unittest.TestCase):
+    def test_search(self):
+        lines = []
+        engine = checkers.engine.Engine(lines.append)
+        self.assertTrue(engine.handle('isready'))
+        engine.handle('position start moves 10,3 22,0')
+        engine.handle('go depth 3')
+        engine.wait()
+        self.assertEqual(lines[0], 'readyok')
+        self.assertEqual([line.split()[2] for line in lines[1:4]],
+                         ['1', '2', '3'])
+        self.assertTrue(lines[4].startswith('bestmove '))
+        gamestate = checkers.game.Gamestate()
+        gamestate.update((10, 3))
+        gamestate.update((22, 0))
+        best_move = checkers.engine.parse_move(lines[4].split()[1])
+        self.assertIn(best_move, gamestate.get_full_moves())
+
+        # The tree is reused, including by shallower searches.
+        nodes = engine.stats.nodes_scored
+        engine.handle('position start moves 10,3 22,0')
+        engine.handle('go depth 2')
+        engine.wait()
+        engine.handle('isready')
+        self.assertEqual(lines[-1], 'readyok')
+        self.assertLess(engine.stats.nodes_scored - nodes, 20)
+
+        lines.clear()
+        engine.handle('position board 1,1,1 turn 1')
+        engine.handle('position start moves 9,9')
+        engine.handle('position board 0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,'
+                      '0,0,0,0,0,1,0,0,-1,-1,0,0,-1,0,-1,0 turn 1')
+        engine.handle('go')
+        self.assertFalse(engine.handle('quit'))
+        self.assertTrue(lines[0].startswith('error'))
+        self.assertTrue(lines[1].startswith('error'))
+        self.assertEqual(lines[2], 'bestmove none')
+
+
+class TestServer(unittest.TestCase):
+    def test_load_test(self):
+        async def serve_and_load(path):
+            executor = concurrent.futures.ThreadPoolExecutor(2)
+            server = checkers.server.GameServer(executor)
+            serve_task = asyncio.create_task(server.serve(path=path))
+            while not os.path.exists(path):
+                await asyncio.sleep(0.01)
+            engine_report = await checkers.server.load_test(
+                4, 2, 'random', path=path)
+            client_report = await checkers.server.load_test(
+                4, 1, 'client', path=path)
+            serve_task.cancel()
+            executor.shutdown()
+            return server, engine_report, client_report
+
+        with tempfile.TemporaryDirectory() as directory:
+            server, engine_report, client_report = asyncio.run(
+                serve_and_load(os.path.join(directory, 'server.sock')))
+        self.assertEqual(engine_report['games'], 8)
+        self.assertEqual(client_report['games'], 2)
+        self.assertEqual(server.matches_played, 6)
+        self.assertEqual(server.games_played, 10)
+        self.assertGreater(engine_report['latency_p99'], 0)
+
+    def test_engine_move(self):
+        player = checkers.players.EasyPlayer(False)
+        gamestate = checkers.game.Gamestate()
+        for _ in range(3):
+            full_move, player = checkers.server.engine_move(player,
+                                                            gamestate)
+            self.assertIn(full_move, gamestate.get_full_moves())
+            for ind in range(0, len(full_move), 2):
+                gamestate.update(full_move[ind:ind + 2])
+            reply = gamestate.get_full_moves()[0]
+            for ind in range(0, len(reply), 2):
+                gamestate.update(reply[ind:ind + 2])
+            # The search tree is kept and follows the reply.
+            root = player.parent_node.child_ply[reply]
+            checkers.server.engine_move(player, gamestate.copy())
+            self.assertIn(player.parent_node, root.child_ply.values())
+            gamestate = checkers.game.Gamestate()
+
+    def test_client_disconnect(self):
+        async def serve_and_disconnect(path):
+            server = checkers.server.GameServer(None)
+            serve_task = asyncio.create_task(server.serve(path=path))
+            while not os.path.exists(path):
+                await asyncio.sleep(0.01)
+
+            async def play_client(team):
+                reader, writer = await asyncio.open_unix_connection(path)
+                writer.write('play client {}\n'.format(team).encode())
+                await writer.drain()
+                return reader, writer
+
+            # A waiting client that leaves is not paired.
+            _, writer = await play_client(1)
+            while server._waiting is None:
+                await asyncio.sleep(0.01)
+            writer.close()
+            while server._waiting is not None:
+                await asyncio.sleep(0.01)
+
+            # The opponent of a client leaving mid-match is told so.
+            reader_1, writer_1 = await play_client(1)
+            while server._waiting is None:
+                await asyncio.sleep(0.01)
+            reader_2, writer_2 = await play_client(2)
+            self.assertEqual(await reader_1.readline(), b'game 0\n')
+            line = (await reader_1.readline()).decode().split()
+            self.assertEqual(line[0], 'turn')
+            writer_2.close()
+            writer_1.write('move {}\n'.format(line[2]).encode())
+            self.assertEqual(await reader_1.readline(),
+                             b'error opponent disconnected\n')
+            writer_1.write(b'play random 1\n')
+            self.assertEqual(await reader_1.readline(), b'game 0\n')
+            writer_1.close()
+            serve_task.cancel()
+            return server
+
+        with tempfile.TemporaryDirectory() as directory:
+            server = asyncio.run(serve_and_disconnect(
+                os.path.join(directory, 'server.sock')))
+        self.assertEqual(server.matches_played, 0)
+
+
+class TestReplayMemory(unittest.TestCase):
+    def test_pack_mask(self):
+        mask = torch.full((2, 128), -2, dtype=torch.int64)
+        mask[0, (0, 9, 127)] = 0
+        mask[1, 64:] = 0
+        bitsets = model.pack_mask(mask)
+        self.assertEqual(bitsets.shape, (2, 16))
+        self.assertEqual(bitsets.dtype, torch.uint8)
+        self.assertTrue(torch.equal(model.unpack_mask(bitsets),
+                                    mask.to(torch.float32)))
+
+    def test_push_sample(self):
+        memory = model.ReplayMemory(3)
+        mask = torch.full((1, 128), -2, dtype=torch.int64)
+        mask[0, 5] = 0
+        for ind in range(4):
+            board = torch.full((1, 32), ind % 3 - 1, dtype=torch.float32)
+            memory.push(board,
+                        torch.tensor([[ind]]),
+                        torch.tensor([float(ind)]),
+                        None if ind == 3 else -board,
+                        None if ind == 3 else mask)
+        self.assertEqual(len(memory), 3)
+        batch = memory.sample(64)
+        self.assertEqual(batch.state.shape, (64, 32))
+        self.assertEqual(batch.action.shape, (64, 1))
+        self.assertEqual(batch.mask.shape, (64, 128))
+        self.assertEqual(set(batch.action.view(-1).tolist()), {1, 2, 3})
+        for row in range(64):
+            action = batch.action[row, 0].item()
+            self.assertEqual(batch.reward[row].item(), action)
+            self.assertEqual(batch.state[row, 0].item(), action % 3 - 1)
+            self.assertEqual(batch.non_final[row].item(), action != 3)
+            if action != 3:
+                self.assertEqual(batch.next_state[row, 0].item(),
+                                 1 - action % 3)
+                self.assertTrue(torch.equal(batch.mask[row],
+                                            mask[0].to(torch.float32)))
+
+    def test_push_batch(self):
+        mask = torch.full((1, 128), -2, dtype=torch.int64)
+        mask[0, 3] = 0
+        transitions = [(torch.full((1, 32), float(ind % 3 - 1)),
+                        torch.tensor([[ind]]),
+                        torch.tensor([ind]),
+                        torch.zeros((1, 32)),
+                        mask)
+                       for ind in range(4)]
+        transitions.append((torch.ones((1, 32)),
+                            torch.tensor([[4]]),
+                            torch.tensor([-1]),
+                            None,
+                            None))
+        single_memory = model.ReplayMemory(4)
+        for transition in transitions:
+            single_memory.push(*transition)
+        batch_memory = model.ReplayMemory(4)
+        batch_memory.push_batch(*model.pack_transitions(transitions[:2]))
+        batch_memory.push_batch(*model.pack_transitions(transitions[2:]))
+        self.assertEqual(len(batch_memory), 4)
+        self.assertEqual(batch_memory.position, single_memory.position)
+        for name in ('states', 'actions', 'rewards', 'non_final'):
+            self.assertTrue(torch.equal(getattr(batch_memory, name),
+                                        getattr(single_memory, name)))
+        non_final = single_memory.non_final
+        self.assertTrue(torch.equal(batch_memory.masks[non_final],
+                                    single_memory.masks[non_final]))
+
+
+class TestPrioritizedReplayMemory(unittest.TestCase):
+    def test_sum_tree(self):
+        tree = model.SumTree(5)
+        tree.update(np.arange(5), np.array([1., 0., 2., 0., 5.]))
+        self.assertEqual(tree.total(), 8)
+        indices, values = tree.find(np.array([0, 0.99, 1, 2.5, 3, 7.9]))
+        self.assertEqual(indices.tolist(), [0, 0, 2, 2, 4, 4])
+        self.assertEqual(values.tolist(), [1, 1, 2, 2, 5, 5])
+        tree.update(np.array([4, 1]), np.array([1., 3.]))
+        self.assertEqual(tree.total(), 7)
+        indices, values = tree.find(np.array([1.5, 6.9]))
+        self.assertEqual(indices.tolist(), [1, 4])
+
+    def test_priorities(self):
+        memory = model.PrioritizedReplayMemory(8)
+        mask = torch.zeros((1, 128), dtype=torch.int64)
+        transitions = [(torch.zeros((1, 32)),
+                        torch.tensor([[ind]]),
+                        torch.tensor([0.]),
+                        torch.zeros((1, 32)),
+                        mask)
+                       for ind in range(8)]
+        memory.push_batch(*model.pack_transitions(transitions))
+        batch = memory.sample(8)
+        self.assertTrue(torch.equal(batch.weights, torch.ones(8)))
+        errors = torch.ones(8)
+        errors[batch.action.view(-1) == 3] = 100
+        memory.update_priorities(batch.indices, errors)
+        batch = memory.sample(64)
+        actions = batch.action.view(-1)
+        # Transition 3 holds 100 ** 0.6 of about 22.8 total priority.
+        self.assertTrue(40 <= (actions == 3).sum().item() <= 48)
+        # The rarely sampled transitions have the largest weights.
+        self.assertTrue(torch.all(batch.weights[actions != 3] == 1))
+        self.assertTrue(torch.all(batch.weights[actions == 3] < 1))
+
+
+class TestDiskReplayMemory(unittest.TestCase):
+    def test_push_sample_resume(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'replay.mem')
+            mask = torch.full((1, 128), -2, dtype=torch.int64)
+            mask[0, 9] = 0
+            transitions = [(torch.full((1, 32), float(ind % 5 - 2)),
+                            torch.tensor([[ind]]),
+                            torch.tensor([float(ind)]),
+                            torch.full((1, 32), float(2 - ind % 5)),
+                            mask)
+                           for ind in range(5)]
+            transitions.append((torch.ones((1, 32)),
+                                torch.tensor([[5]]),
+                                torch.tensor([-1.0]),
+                                None,
+                                None))
+            # Two writers sharing the file, as separate processes would.
+            memory = model.DiskReplayMemory(path, 4)
+            other = model.DiskReplayMemory(path, 4)
+            memory.push_batch(*model.pack_transitions(transitions[:3]))
+            other.push(*transitions[3])
+            other.push_batch(*model.pack_transitions(transitions[4:]))
+            self.assertEqual(len(memory), 4)
+            memory.close()
+            other.close()
+
+            memory = model.DiskReplayMemory(path, 4)
+            self.assertEqual(len(memory), 4)
+            batch = memory.sample(64)
+            self.assertEqual(batch.state.shape, (64, 32))
+            self.assertEqual(batch.action.shape, (64, 1))
+            self.assertEqual(batch.mask.shape, (64, 128))
+            self.assertEqual(set(batch.action.view(-1).tolist()), {2, 3, 4, 5})
+            for row in range(64):
+                action = batch.action[row, 0].item()
+                self.assertEqual(batch.reward[row].item(),
+                                 -1 if action == 5 else action)
+                self.assertEqual(batch.non_final[row].item(), action != 5)
+                if action != 5:
+                    self.assertEqual(batch.state[row, 0].item(),
+                                     action % 5 - 2)
+                    self.assertEqual(batch.next_state[row, 0].item(),
+                                     2 - action % 5)
+                    self.assertTrue(torch.equal(batch.mask[row],
+                                                mask[0].to(torch.float32)))
+
+            # Loading an earlier state keeps the records appended since.
+            state = memory.state_dict()
+            memory.push(*transitions[0])
+            memory.load_state_dict(state)
+            self.assertEqual(memory.state_dict(),
+                             {'position': (state['position'] + 1) % 4,
+                              'size': 4})
+            memory.close()
+            with self.assertRaises(ValueError):
+                model.DiskReplayMemory(path, 8)
+
+
+class TestCheckpoint(unittest.TestCase):
+    def test_save_load(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'checkpoint.pt')
+            config = model.current_config()
+            try:
+                model.configure({'REPLAY_RATIO': 0.25})
+                trainer = model.Trainer()
+            finally:
+                model.configure(config)
+            iters = trainer.model_player.iters
+            # The fraction of a step carried over to the next game is saved.
+            self.assertEqual(trainer.schedule.steps(7), 1)
+            writer = model.CheckpointWriter(path)
+            writer.save(trainer.training_state(3))
+            expected = [random.random(), torch.rand(1).item()]
+            writer.close()
+            self.assertFalse(os.path.exists(path + '.tmp'))
+
+            trainer.model_player.iters += 10
+            trainer.schedule.steps(1)
+            with torch.no_grad():
+                weight = next(trainer.model_player.model.parameters())
+                saved_weight = weight.clone()
+                weight.add_(1)
+            self.assertEqual(trainer.load_checkpoint(path), 3)
+            self.assertEqual(trainer.model_player.iters, iters)
+            self.assertEqual(trainer.schedule.owed, 0.75)
+            self.assertTrue(torch.equal(weight, saved_weight))
+            self.assertEqual([random.random(), torch.rand(1).item()], expected)
+
+
+class TestBatchPrefetcher(unittest.TestCase):
+    def test_prefetch(self):
+        memory = model.PrioritizedReplayMemory(1000)
+        prefetcher = model.BatchPrefetcher(memory, 16, 3)
+        try:
+            self.assertIsNone(prefetcher.get())
+            benchmark.fill_replay(prefetcher, 100)
+            for step in range(10):
+                batch = prefetcher.get()
+                self.assertEqual(batch.state.shape, (16, 32))
+                self.assertEqual(len(batch.indices), 16)
+                prefetcher.update_priorities(batch.indices,
+                                             torch.rand(16))
+            self.assertEqual(prefetcher.requested, 10)
+            self.assertLessEqual(prefetcher.starved, 10)
+            self.assertGreaterEqual(prefetcher.sampled, 10)
+        finally:
+            prefetcher.close()
+
+    def test_trainer(self):
+        trainer = model.Trainer()
+        trainer.memory = model.ReplayMemory(1000)
+        trainer.start_prefetching(2)
+        try:
+            self.assertIs(trainer.replay, trainer.prefetcher)
+            benchmark.fill_replay(trainer.replay, 500)
+            losses = []
+            trainer.optimize_steps(3, losses)
+            self.assertEqual(len(losses), 3)
+        finally:
+            trainer.stop_prefetching()
+        self.assertIs(trainer.replay, trainer.memory)
+
+
+class TestLearnerSchedule(unittest.TestCase):
+    def test_steps(self):
+        schedule = model.LearnerSchedule(None, 3)
+        self.assertEqual([schedule.steps(count) for count in (10, 50)],
+                         [3, 3])
+        schedule = model.LearnerSchedule(0.25, 3)
+        self.assertEqual([schedule.steps(count) for count in (10, 3, 7)],
+                         [2, 1, 2])
+        self.assertAlmostEqual(schedule.owed, 0)
+
+    def test_accumulation(self):
+        config = model.current_config()
+        try:
+            model.configure({'BATCH_SIZE': 8,
+                             'ACCUMULATION_STEPS': 2,
+                             'TARGET_SYNC_STEPS': 2})
+            trainer = model.Trainer()
+            trainer.memory = model.ReplayMemory(100)
+            benchmark.fill_replay(trainer.memory, 100)
+            batches = [trainer.memory.sample(8) for ind in range(2)]
+            reference = model.Trainer()
+            reference.model_player.model.load_state_dict(
+                trainer.state_dict())
+            reference.target_model.load_state_dict(
+                trainer.target_model.state_dict())
+
+            trainer.next_batch = iter(batches).__next__
+            loss = trainer.optimize_model()
+            combined = model.Batch(*(torch.cat(fields) for fields in
+                                     zip(*(batch[:6] for batch in batches))))
+            reference_loss = reference.batch_loss(combined)
+            reference_loss.backward()
+            self.assertAlmostEqual(loss, reference_loss.item(), places=5)
+            # The gradients are kept after the step.
+            for weight, reference_weight in zip(
+                    trainer.model_player.model.parameters(),
+                    reference.model_player.model.parameters()):
+                self.assertTrue(torch.allclose(weight.grad,
+                                               reference_weight.grad,
+                                               atol=1e-6))
+
+            self.assertEqual(trainer.steps, 1)
+            self.assertFalse(torch.equal(
+                trainer.target_model.layer1.weight,
+                trainer.model_player.model.layer1.weight))
+            del trainer.next_batch
+            losses = []
+            trainer.optimize_steps(1, losses)
+            self.assertEqual(trainer.steps, 2)
+            self.assertEqual(len(losses), 1)
+            self.assertTrue(torch.equal(
+                trainer.target_model.layer1.weight,
+                trainer.model_player.model.layer1.weight))
+        finally:
+            model.configure(config)
+
+
+class TestDistributed(unittest.TestCase):
+    def test_rank_config(self):
+        config = {'CHECKPOINT_PATH': 'run.pt', 'BATCH_SIZE': 64}
+        self.assertEqual(distributed.rank_config(config, 0), config)
+        config = distributed.rank_config(config, 2)
+        self.assertEqual(config['CHECKPOINT_PATH'], 'run.pt.2')
+        self.assertEqual(config['METRICS_PATH'], model.METRICS_PATH + '.2')
+        self.assertEqual(config['BATCH_SIZE'], 64)
+        self.assertNotIn('REPLAY_PATH', config)
+
+    def test_single_rank(self):
+        torch.distributed.init_process_group(
+            'gloo',
+            init_method='tcp://127.0.0.1:{}'.format(distributed._free_port()),
+            rank=0,
+            world_size=1)
+        try:
+            trainer = distributed.DistributedTrainer()
+            trainer.memory = model.ReplayMemory(1000)
+            losses = []
+            trainer.optimize_steps(2, losses)
+            self.assertEqual(losses, [])
+            benchmark.fill_replay(trainer.memory, 500)
+            trainer.optimize_steps(2, losses)
+            self.assertEqual(len(losses), 2)
+            self.assertEqual(trainer.steps, 2)
+        finally:
+            torch.distributed.destroy_process_group()
+
+    def test_scaling(self):
+        rate, efficiency = distributed.measure_scaling((2,), 2)[2]
+        self.assertGreater(rate, 0)
+        self.assertIsNone(efficiency)
+
+
+class TestConfig(unittest.TestCase):
+    def test_configure(self):
+        config = model.current_config()
+        try:
+            model.configure({'GAMMA': 0.5,
+                             'VALIDATION_GAMES': 3,
+                             'VALIDATION_OPPONENTS': ['random'],
+                             'PER_ALPHA': 0.3})
+            self.assertEqual(model.PrioritizedReplayMemory(4).alpha, 0.3)
+            self.assertEqual(model.WIN_STEP, 0.5)
+            self.assertEqual(model.VALIDATION_OPPONENTS, ('random',))
+            validator = model.BackgroundValidator()
+            validator.close()
+            self.assertEqual(validator.game_count, 3)
+            self.assertEqual(validator.opponents, ('random',))
+            with self.assertRaises(ValueError):
+                model.configure({'GAMMA': 0.9, 'GAMMMA': 0.9})
+            self.assertEqual(model.GAMMA, 0.5)
+        finally:
+            model.configure(config)
+        self.assertEqual(model.current_config(), config)
+        self.assertAlmostEqual(model.WIN_STEP,
+                               (1 - model.GAMMA) * model.WIN_REWARD)
+
+
+class TestBackgroundValidator(unittest.TestCase):
+    def test_validation(self):
+        validator = model.BackgroundValidator(1, ('random', 'easy'), 1)
+        validator.submit(7, model.DQN().state_dict())
+        validator.close()
+        self.assertEqual(len(validator.results), 1)
+        generation, scores = validator.results[0]
+        self.assertEqual(generation, 7)
+        self.assertEqual(list(scores), ['random', 'easy'])
+        for score in scores.values():
+            self.assertTrue(0 <= score <= 2)
+
+
+class TestModelPlayer(unittest.TestCase):
+    def test_encoding(self):
+        player = model.ModelPlayer(False)
+        for gamestate in benchmark.sample_positions(100):
+            player.gamestate = gamestate
+            board, mask = benchmark.legacy_encode(gamestate)
+            self.assertTrue(torch.equal(player.orient_board(), board))
+            self.assertTrue(torch.equal(player.get_mask(), mask))
+            for pos, dir in gamestate.get_valid_moves():
+                oriented = player.orient_move((pos, dir))
+                self.assertEqual(
+                    model.MOVE_INDEX[gamestate.turn][4*pos + dir],
+                    4*oriented[0] + oriented[1])
+                self.assertEqual(player.orient_move(oriented), (pos, dir))
+
+    def test_inference_backends(self):
+        net = model.DQN()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'model_params.pt')
+            torch.save(net.state_dict(), path)
+            boards = torch.randint(-3, 4, (64, 32)).float()
+            with torch.inference_mode():
+                expected = net(boards)
+            eager = model.ModelPlayer(False, net)
+            positions = benchmark.sample_positions(50)
+            for backend in ('eager', 'script', 'frozen'):
+                compiled = model.load_inference_model(path, backend)
+                self.assertIs(model.load_inference_model(path, backend),
+                              compiled)
+                with torch.inference_mode():
+                    self.assertTrue(torch.allclose(compiled(boards), expected,
+                                                   atol=1e-5))
+                player = model.load_inference_player(False, path, backend,
+                                                     None, None)
+                for gamestate in positions:
+                    eager.gamestate = gamestate
+                    player.gamestate = gamestate
+                    self.assertEqual(player.get_next_turn(),
+                                     eager.get_next_turn())
+            config = model.current_config()
+            try:
+                model.configure({'PATH': path, 'INFERENCE_BACKEND': 'eager'})
+                self.assertIs(model.load_inference_player().model,
+                              model.load_inference_model(path, 'eager'))
+            finally:
+                model.configure(config)
+            with self.assertRaises(ValueError):
+                model.compile_model(net, 'onnx')
+
+    def test_export(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'model_params.pt')
+            output = os.path.join(directory, 'model_quantized.pt')
+            torch.save(model.DQN().state_dict(), path)
+            boards, masks = export.sample_boards(500)
+            report = export.export_model(path, output, 'quantized', boards,
+                                         masks)
+            self.assertLess(report['exported_bytes'],
+                            report['weights_bytes'] / 3)
+            self.assertGreater(report['agreement'], 0.9)
+            player = model.load_inference_player(False, output, 'exported')
+            reference = model.load_inference_model(path, 'eager')
+            self.assertEqual(export.move_agreement(reference, player.model,
+                                                   boards, masks),
+                             report['agreement'])
+            player.gamestate = checkers.game.Gamestate()
+            self.assertIn(player.get_next_turn(),
+                          player.gamestate.get_valid_moves())
+
+
+class TestNumpyModel(unittest.TestCase):
+    def setUp(self):
+        self.net = model.DQN()
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, 'model_params.npz')
+        self.numpy_net = export.export_numpy(self.net.state_dict(),
+                                             self.path)
+
+    def test_outputs(self):
+        boards = torch.randint(-3, 4, (64, 32)).float()
+        with torch.inference_mode():
+            expected = self.net(boards).numpy()
+        loaded = numpy_model.load_network(self.path)
+        self.assertIs(numpy_model.load_network(self.path), loaded)
+        for net in (self.numpy_net, loaded):
+            self.assertTrue(np.allclose(net(boards.numpy()), expected,
+                                        atol=1e-5))
+        player = numpy_model.NumpyPlayer(path=self.path)
+        reference = model.ModelPlayer(False, self.net)
+        for gamestate in benchmark.sample_positions(100):
+            player.gamestate = gamestate
+            reference.gamestate = gamestate
+            self.assertEqual(player.get_next_turn(),
+                             reference.get_next_turn())
+
+    def test_tree_player(self):
+        player = numpy_model.NumpyTreePlayer(net=self.numpy_net)
+        for gamestate in benchmark.sample_positions(10):
+            node = checkers.players.Node(gamestate)
+            batched = player.gen_child_ply(node, 1)
+            for child, score in zip(node.child_ply.values(), batched):
+                single = checkers.players.Node(child.gamestate)
+                player.score_leaf(single)
+                self.assertAlmostEqual(single.score, score, places=5)
+        factory = functools.partial(numpy_model.NumpyTreePlayer, False,
+                                    self.path)
+        with concurrent.futures.ProcessPoolExecutor(1) as executor:
+            result = executor.submit(checkers.sprt.play_game,
+                                     factory,
+                                     checkers.players.RandomPlayer,
+                                     1,
+                                     0).result()
+        self.assertIn(result, (-1, 0, 1))
+
+    def test_no_torch(self):
+        subprocess.run([sys.executable, '-c',
+                        'import sys, numpy_model; '
+                        'assert "torch" not in sys.modules'],
+                       check=True,
+                       cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestGameTransitions(unittest.TestCase):
+    def test_returns(self):
+        mask = torch.full((1, 128), -2, dtype=torch.int64)
+        temp_memory = [[(torch.full((1, 32), float(ind)),
+                         mask,
+                         torch.tensor([[ind]]))
+                        for ind in range(start, start + length)]
+                       for start, length in ((0, 3), (10, 2))]
+        n_step = model.N_STEP
+        gamma = model.GAMMA
+        win = model.WIN_STEP
+        loss = model.LOSS_STEP
+        try:
+            model.N_STEP = 1
+            transitions = model.game_transitions(temp_memory, (1, 0, 1, 0, 0))
+            states, actions, rewards, next_states, masks, non_final = \
+                transitions
+            self.assertEqual(states[:, 0].tolist(), [0, 1, 2, 10, 11])
+            self.assertEqual(actions.tolist(), [0, 1, 2, 10, 11])
+            self.assertEqual(rewards.dtype, torch.float32)
+            self.assertTrue(torch.allclose(
+                rewards, torch.tensor([win, win, model.WIN_REWARD,
+                                       loss, model.LOSS_REWARD])))
+            self.assertEqual(next_states[:, 0].tolist(), [1, 2, 0, 11, 0])
+            self.assertEqual(non_final.tolist(),
+                             [True, True, False, True, False])
+
+            model.N_STEP = 2
+            rewards, next_states, masks, non_final = \
+                model.game_transitions(temp_memory, (1, 0, 1, 0, 0))[2:]
+            self.assertTrue(torch.allclose(
+                rewards, torch.tensor([win + gamma * win,
+                                       win + gamma * model.WIN_REWARD,
+                                       model.WIN_REWARD,
+                                       loss + gamma * model.LOSS_REWARD,
+                                       model.LOSS_REWARD])))
+            self.assertEqual(next_states[:, 0].tolist(), [2, 0, 0, 0, 0])
+            self.assertEqual(non_final.tolist(),
+                             [True, False, False, False, False])
+
+            model.N_STEP = None
+            rewards, next_states, masks, non_final = \
+                model.game_transitions(temp_memory, (0, 1, 0, 1, 0))[2:]
+            self.assertAlmostEqual(
+                rewards[0].item(),
+                loss + gamma * loss + gamma ** 2 * model.LOSS_REWARD,
+                places=6)
+            self.assertFalse(non_final.any())
+        finally:
+            model.N_STEP = n_step
+
+
+class TestLockstepSelfPlay(unittest.TestCase):
+    def test_matches_train_player(self):
+        # Without exploration both drivers play the same greedy game.
+        exp_start, exp_end = model.EXP_START, model.EXP_END
+        model.EXP_START = model.EXP_END = 0
+        try:
+            player = model.TrainPlayer(False)
+            checkers_match = checkers.game.CheckersMatch(player,
+                                                         player,
+                                                         1,
+                                                         False)
+            match_result = checkers_match.match_loop()
+            iters = player.iters
+            expected = player.temp_memory
+
+            player.iters = 0
+            self_play = model.LockstepSelfPlay(player, 3)
+            games = list(self_play.games(4))
+        finally:
+            model.EXP_START, model.EXP_END = exp_start, exp_end
+
+        self.assertEqual(len(games), 4)
+        self.assertEqual(player.iters, 4 * iters)
+        expected = expected[0] + expected[1]
+        for transitions, result in games:
+            self.assertEqual(result, match_result)
+            self.assertEqual(len(transitions[0]), len(expected))
+        states, actions = games[0][0][:2]
+        self.assertTrue(torch.equal(
+            states, torch.cat([move[0] for move in expected]).to(torch.int8)))
+        self.assertTrue(torch.equal(
+            actions,
+            torch.cat([move[2] for move in expected]).view(-1).to(
+                torch.uint8)))
+
+    def test_exploration(self):
+        player = model.TrainPlayer(False)
+        with tempfile.TemporaryDirectory() as directory:
+            writer_path = os.path.join(directory, 'games.ckr')
+            with checkers.record.GameWriter(writer_path) as writer:
+                self_play = model.LockstepSelfPlay(player, 4, writer)
+                games = list(self_play.games(6))
+            records = list(checkers.record.read_games(writer_path))
+            self.assertEqual(len(records), 6)
+            for (transitions, match_result), record in zip(games, records):
+                self.assertEqual(match_result[2] - match_result[3],
+                                 record.result)
+                states, actions, rewards, next_states, masks, non_final = \
+                    transitions
+                self.assertEqual(states.shape, (len(actions), 32))
+                self.assertEqual(next_states.shape, (len(actions), 32))
+                self.assertEqual(masks.shape, (len(actions), 16))
+                self.assertEqual(int(non_final.logical_not().sum()), 2)
+                for gamestate, move in checkers.record.replay(record.moves):
+                    pass
+                self.assertEqual(gamestate.is_game_over(), record.result)
+
+
+class TestSPRT(unittest.TestCase):
+    def test_sprt(self):
+        self.assertAlmostEqual(checkers.sprt.elo_to_score(0), 0.5)
+        self.assertAlmostEqual(
+            checkers.sprt.score_to_elo(checkers.sprt.elo_to_score(120)), 120)
+        test = checkers.sprt.SPRT(0, 50)
+        self.assertIsNone(test.decision())
+        for ind in range(400):
+            test.add(ind % 2 * 2 - 1)
+        self.assertEqual(test.games, 400)
+        self.assertLess(test.llr(), 0)
+        self.assertEqual(test.decision(), 'H0')
+        self.assertGreaterEqual(test.confidence(), 0.95)
+        self.assertAlmostEqual(test.elo()[0], 0)
+        with self.assertRaises(ValueError):
+            checkers.sprt.SPRT(10, 0)
+
+    def test_sprt_match(self):
+        result = checkers.sprt.sprt_match(checkers.players.EasyPlayer,
+                                          checkers.players.RandomPlayer,
+                                          0,
+                                          100,
+                                          seed=0)
+        self.assertEqual(result.decision, 'H1')
+        self.assertLess(result.games, 30)
+        self.assertEqual(result.games,
+                         result.wins + result.draws + result.losses)
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            parallel_result = checkers.sprt.sprt_match(
+                checkers.players.EasyPlayer,
+                checkers.players.RandomPlayer,
+                0,
+                100,
+                executor=executor,
+                seed=0)
+        self.assertEqual(parallel_result.decision, 'H1')
+
+
+class TestMetrics(unittest.TestCase):
+    def test_write_read(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for name in ('metrics.jsonl', 'metrics.csv'):
+                path = os.path.join(directory, name)
+                writer = metrics.MetricsWriter(path)
+                writer.log(0, loss=0.5, epsilon=0.9)
+                writer.log(0, validation_random=1.5, validation_easy=None)
+                writer.close()
+                writer = metrics.MetricsWriter(path)
+                writer.log(1, loss=0.25, epsilon=0.8)
+                writer.close()
+                generations = {}
+                for record in metrics.read_metrics(path):
+                    generation = record.pop('generation')
+                    generations.setdefault(generation, {}).update(record)
+                self.assertEqual(set(generations), {0, 1})
+                self.assertEqual(generations[0]['loss'], 0.5)
+                self.assertEqual(generations[0]['epsilon'], 0.9)
+                self.assertEqual(generations[0]['validation_random'], 1.5)
+                self.assertNotIn('validation_easy', generations[0])
+                self.assertEqual(generations[1]['loss'], 0.25)
+            self.assertEqual(metrics.smooth([1, 2, 2], 0.5), [1, 1.5, 1.75])
+
+    def test_plot(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'metrics.jsonl')
+            writer = metrics.MetricsWriter(path)
+            for generation in range(3):
+                writer.log(generation, loss=1 / (generation + 1), epsilon=0.5,
+                           games_per_second=10.0)
+            writer.log(0, validation_random=1.0)
+            writer.close()
+            output = path + '.png'
+            metrics.main([path, '--output', output])
+            self.assertGreater(os.path.getsize(output), 0)
+
+
+class TestDistill(unittest.TestCase):
+    def test_labels(self):
+        positions = list(itertools.islice(
+            distill.sample_positions([], 0.2, seed=3), 20))
+        labels = distill.label_positions(positions, 'easy', 2)
+        player = model.ModelPlayer(False)
+        for row, (board, turn, ply_count, plys_since_capture) in enumerate(
+                positions):
+            gamestate = checkers.game.Gamestate()
+            gamestate.board = list(board)
+            gamestate.turn = turn
+            player.gamestate = gamestate
+            self.assertEqual(labels['boards'][row].tolist(),
+                             player.orient_board().view(-1).tolist())
+            mask = torch.from_numpy(labels['masks'][row:row + 1])
+            self.assertTrue(torch.equal(model.unpack_mask(mask)[0],
+                                        player.get_mask().view(-1)))
+            valid = np.unpackbits(labels['masks'][row], bitorder='little')
+            action = labels['actions'][row]
+            self.assertEqual(valid[action], 1)
+            self.assertEqual(labels['values'][row],
+                             labels['scores'][row, action])
+            self.assertEqual(labels['values'][row],
+                             labels['scores'][row][valid == 1].max())
+
+    def test_generate(self):
+        with tempfile.TemporaryDirectory() as directory:
+            args = (directory, 25, 10, [], 0.2, 'easy', 1, 0, 1)
+            self.assertEqual(distill.generate(*args), 3)
+            shards = list(distill.read_shards(directory))
+            self.assertEqual([len(shard['actions']) for shard in shards],
+                             [10, 10, 5])
+            os.remove(os.path.join(directory, distill.SHARD_FORMAT.format(1)))
+            self.assertEqual(distill.generate(*args), 3)
+            for shard, resumed in zip(shards, distill.read_shards(directory)):
+                for name in distill.ARRAYS:
+                    self.assertTrue(np.array_equal(shard[name], resumed[name]))
+            with self.assertRaises(ValueError):
+                distill.generate(directory, 25, 10, [], 0.2, 'easy', 2, 0, 1)
+            batches = list(distill.iter_batches(directory, 8, seed=0))
+            self.assertEqual([len(batch['values']) for batch in batches],
+                             [8, 8, 8, 1])
+            self.assertEqual(
+                sorted(np.concatenate([batch['values'] for batch in batches])),
+                sorted(np.concatenate([shard['values'] for shard in shards])))
+
+
+class TestMCTS(unittest.TestCase):
+    def test_play_games(self):
+        torch.manual_seed(0)
+        evaluate = mcts.NetworkEvaluator(mcts.PolicyValueNet())
+        claims = iter([True, True])
+        games = list(mcts.play_games(evaluate,
+                                     lambda: next(claims, False),
+                                     parallel_games=2,
+                                     simulations=4,
+                                     seed=0))
+        self.assertEqual(len(games), 2)
+        for game in games:
+            self.assertEqual(set(game), set(mcts.TARGETS))
+            valid = np.unpackbits(game['masks'], axis=1, bitorder='little')
+            self.assertTrue(np.allclose(game['policies'].sum(1), 1))
+            self.assertTrue(np.all(game['policies'][valid == 0] == 0))
+            self.assertTrue(set(np.abs(game['values']).tolist()) <= {0, 1})
+            self.assertEqual(len(game['values']), len(game['boards']))
+
+    def test_inference_server(self):
+        torch.manual_seed(0)
+        net = mcts.PolicyValueNet()
+        server = mcts.InferenceServer(net, max_batch=64, timeout=0.05)
+        clients = [server.client() for ind in range(4)]
+        gamestate = checkers.game.Gamestate()
+        board, mask = mcts.encode(gamestate, gamestate.get_valid_moves())
+        boards = np.stack([board] * 3)
+        masks = np.stack([mask] * 3)
+        with concurrent.futures.ThreadPoolExecutor(4) as executor:
+            results = list(executor.map(lambda client: client(boards, masks),
+                                        clients))
+        server.close()
+        self.assertLess(server.batches, 4)
+        self.assertEqual(server.positions, 12)
+        expected = mcts.NetworkEvaluator(net)(boards, masks)
+        for priors, values in results:
+            self.assertTrue(np.allclose(priors, expected[0], atol=1e-6))
+            self.assertTrue(np.allclose(values, expected[1], atol=1e-6))
+            self.assertTrue(np.all(priors[~masks] == 0))
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_compare(self):
+        baseline = {
+            'rate': {'value': 100.0, 'higher_is_better': True},
+            'latency': {'value': 10.0, 'higher_is_better': False},
+            'removed': {'value': 1.0, 'higher_is_better': True},
+        }
+        results = {
+            'rate': {'value': 80.0, 'higher_is_better': True},
+            'latency': {'value': 10.5, 'higher_is_better': False},
+        }
+        comparison = benchmark.compare(results, baseline, 0.1,
+                                       {'latency': 0.01})
+        self.assertEqual(set(comparison), {'rate', 'latency'})
+        self.assertAlmostEqual(comparison['rate']['slowdown'], 0.25)
+        self.assertTrue(comparison['rate']['regression'])
+        self.assertAlmostEqual(comparison['latency']['slowdown'], 0.05)
+        self.assertTrue(comparison['latency']['regression'])
+        comparison = benchmark.compare(results, baseline, 0.3)
+        self.assertFalse(comparison['rate']['regression'])
+        self.assertFalse(comparison['latency']['regression'])
+
+
 def plot_loss(prev_points, new_points, final=False):
     ALPHA = 0.002
     plt.clf()
@@ -0,0 +1,83 @@
+"""Trains the model from the command line.
+
+The hyperparameters are the constants of the model module. A JSON config
+file mapping any of the names in model.CONFIG_NAMES to values overrides
+their defaults, so runs with different settings need no edits to the
+code. torch is only imported once the arguments have been checked, so
+asking for help or passing a bad config file fails quickly.
+
+Example Usage:
+    python train.py --print-config > config.json
+    python train.py --config config.json
+    python train.py --config config.json --resume
+
+Functions:
+    load_config: Reads a config file.
+    main: Command line entry point.
+"""
+
+import argparse
+import json
+
+
+def load_config(path):
+    """Reads a config file.
+
+    Args:
+        path: The path of a JSON file holding an object that maps
+            constant names of the model module to their values.
+
+    Returns:
+        A dictionary of the values by name.
+
+    Raises:
+        ValueError: The file does not hold a JSON object.
+    """
+
+    with open(path) as config_file:
+        config = json.load(config_file)
+    if not isinstance(config, dict):
+        raise ValueError('{} does not hold a JSON object.'.format(path))
+    return config
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Trains the model.')
+    parser.add_argument('--config',
+                        help='JSON file of hyperparameters overriding the '
+                             'constants of model.py')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue training from the checkpoint')
+    parser.add_argument('--print-config', action='store_true',
+                        help='print the hyperparameters as JSON and exit')
+    args = parser.parse_args(argv)
+
+    config = {}
+    if args.config is not None:
+        try:
+            config = load_config(args.config)
+        except (OSError, ValueError) as error:
+            parser.error(str(error))
+
+    import model
+    try:
+        model.configure(config)
+    except ValueError as error:
+        parser.error(str(error))
+    if args.print_config:
+        print(json.dumps(model.current_config(), indent=4))
+        return
+
+    print('Using {}.'.format(model.device))
+    trainer = model.Trainer()
+    if model.ACTORS > 0:
+        trainer.train_actor_learner(model.ACTORS,
+                                    model.WEIGHT_SYNC_INTERVAL,
+                                    model.QUEUE_DEPTH,
+                                    resume=args.resume)
+    else:
+        trainer.train(resume=args.resume)
+
+
+if __name__ == '__main__':
+    main()